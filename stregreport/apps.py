@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import m2m_changed, post_delete
+
+from stregreport.signals import after_product_categories_change, after_sale_delete, after_sales_refunded
+from stregsystem.signals import sales_refunded
 
 
 class StregreportConfig(AppConfig):
     name = 'stregreport'
+
+    def ready(self):
+        from stregsystem.models import Product, Sale
+
+        post_delete.connect(after_sale_delete, sender=Sale)
+        sales_refunded.connect(after_sales_refunded, sender=Sale)
+        m2m_changed.connect(after_product_categories_change, sender=Product.categories.through)
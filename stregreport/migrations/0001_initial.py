@@ -0,0 +1,75 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ("stregsystem", "0005_access_pattern_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RankYear",
+            fields=[
+                ("year", models.IntegerField(primary_key=True, serialize=False)),
+                ("from_time", models.DateTimeField()),
+                ("to_time", models.DateTimeField()),
+                ("last_sale_id", models.IntegerField(default=0)),
+                ("complete", models.BooleanField(default=False)),
+                ("dirty", models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RankSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("value", models.IntegerField(default=0)),
+                (
+                    "category",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.category",
+                    ),
+                ),
+                (
+                    "member",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.member",
+                    ),
+                ),
+                (
+                    "year",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregreport.rankyear",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="ranksnapshot",
+            index=models.Index(
+                fields=["year", "category", "-value"],
+                name="stregreport_year_id_06f96c_idx",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="ranksnapshot",
+            unique_together={("year", "category", "member")},
+        ),
+    ]
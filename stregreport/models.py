@@ -0,0 +1,136 @@
+import datetime
+from collections import defaultdict
+
+from django.db import models, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from stregsystem.models import Category, Member, Sale
+
+
+class RankYear(models.Model):
+    """
+    The state of the rank snapshots of a fjule party year.
+
+    Closed years are built once. The ongoing year catches up from the id of the last sale it has counted, so only the
+    sales since the last time the ranks were shown are aggregated. Refunds and changes to the product categories mark
+    the year dirty, which rebuilds it from scratch.
+    """
+
+    # Only count sales this old, so a purchase that is still being committed can't end up behind the watermark
+    SETTLE_TIME = datetime.timedelta(minutes=1)
+
+    year = models.IntegerField(primary_key=True)
+    from_time = models.DateTimeField()
+    to_time = models.DateTimeField()
+    last_sale_id = models.IntegerField(default=0)
+    complete = models.BooleanField(default=False)
+    dirty = models.BooleanField(default=False)
+
+    def __str__(self):
+        return str(self.year)
+
+    @classmethod
+    @transaction.atomic
+    def up_to_date(cls, year, from_time, to_time):
+        """
+        Returns the rank year, after counting the sales it hasn't counted yet.
+        """
+        # Lock the year, so two requests don't count the same sales
+        rank_year, _ = cls.objects.select_for_update().get_or_create(
+            year=year, defaults={'from_time': from_time, 'to_time': to_time}
+        )
+        if rank_year.dirty:
+            rank_year.ranksnapshot_set.all().delete()
+            rank_year.last_sale_id = 0
+            rank_year.complete = False
+            rank_year.dirty = False
+            rank_year.save()
+        if rank_year.complete:
+            return rank_year
+
+        settled = min(timezone.now() - cls.SETTLE_TIME, to_time)
+        last_sale_id = (
+            Sale.objects.filter(timestamp__lte=settled).order_by('-id').values_list('id', flat=True).first() or 0
+        )
+        if last_sale_id > rank_year.last_sale_id:
+            rank_year.count_sales(rank_year.last_sale_id, last_sale_id)
+            rank_year.last_sale_id = last_sale_id
+        rank_year.complete = settled >= to_time
+        rank_year.save()
+        return rank_year
+
+    def count_sales(self, after_id, until_id):
+        sales = Sale.objects.filter(
+            id__gt=after_id, id__lte=until_id, timestamp__gt=self.from_time, timestamp__lte=self.to_time
+        )
+        added = defaultdict(int)
+        for member_id, category_id, count in (
+            sales.filter(product__categories__isnull=False)
+            .values_list('member_id', 'product__categories')
+            .annotate(count=Count('id'))
+            .order_by()
+        ):
+            added[(category_id, member_id)] += count
+        for member_id, amount in sales.values_list('member_id').annotate(amount=Sum('price')).order_by():
+            added[(None, member_id)] += amount
+        if not added:
+            return
+
+        if after_id == 0:
+            existing = {}
+        else:
+            existing = {
+                (snapshot.category_id, snapshot.member_id): snapshot
+                for snapshot in self.ranksnapshot_set.filter(member__in={member_id for _, member_id in added})
+            }
+        changed = []
+        created = []
+        for (category_id, member_id), value in added.items():
+            snapshot = existing.get((category_id, member_id))
+            if snapshot is None:
+                created.append(RankSnapshot(year=self, category_id=category_id, member_id=member_id, value=value))
+            else:
+                snapshot.value += value
+                changed.append(snapshot)
+        RankSnapshot.objects.bulk_create(created)
+        RankSnapshot.objects.bulk_update(changed, ['value'])
+
+    def top(self, category, limit=10):
+        """
+        Returns the snapshots of the members who bought the most of the category, or who spent the most money if the
+        category is None.
+        """
+        snapshots = self.ranksnapshot_set.filter(category=category)
+        if category is None:
+            snapshots = snapshots.filter(member__active=True)
+        return snapshots.select_related('member').order_by('-value', 'member__phone_number')[:limit]
+
+    @classmethod
+    def mark_dirty(cls, timestamp=None, until=None):
+        """
+        Marks the years containing the timestamp for rebuilding, or every year if it is None.
+        With until, the years containing any time from timestamp to until are marked, in the same single update.
+        """
+        years = cls.objects.all()
+        if timestamp is not None:
+            years = years.filter(from_time__lt=until or timestamp, to_time__gte=timestamp)
+        years.update(dirty=True)
+
+
+class RankSnapshot(models.Model):
+    """
+    The number of products in a category a member bought in a fjule party year,
+    or the amount of money they spent when category is null.
+    """
+
+    year = models.ForeignKey(RankYear, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True)
+    member = models.ForeignKey(Member, on_delete=models.CASCADE)
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("year", "category", "member")
+        indexes = [
+            models.Index(fields=["year", "category", "-value"]),
+        ]
@@ -0,0 +1,21 @@
+def after_sale_delete(sender, instance, **kwargs):
+    from stregsystem.models import Sale
+    from .models import RankYear
+
+    # Refunds mark their years dirty together, see after_sales_refunded
+    if Sale.refunding_in_bulk():
+        return
+    RankYear.mark_dirty(instance.timestamp)
+
+
+def after_sales_refunded(sender, sales, **kwargs):
+    from .models import RankYear
+
+    timestamps = [sale.timestamp for sale in sales]
+    RankYear.mark_dirty(min(timestamps), until=max(timestamps))
+
+
+def after_product_categories_change(sender, **kwargs):
+    from .models import RankYear
+
+    RankYear.mark_dirty()
@@ -1,6 +1,18 @@
-from django.test import TestCase
+import csv
+import datetime
+import json
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from freezegun import freeze_time
+
 from stregreport import views
+from stregreport.models import RankYear
+from stregsystem.models import Category, Member, Payment, Product, Sale
 
 
 class ParseIdStringTests(TestCase):
@@ -68,3 +80,209 @@ class SalesReportTests(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed("admin/stregsystem/report/sales.html")
+
+
+class RanksTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Øl")
+        self.product = Product.objects.create(name="Pilsner", price=600, active=True)
+        self.product.categories.add(self.category)
+        self.member = Member.objects.create(phone_number="ranked", email="ranked@example.com", balance=10000)
+        self.user = User.objects.create_superuser("ranks", "ranks@example.com", "ranks")
+
+    def sell(self, timestamp, count=1):
+        with freeze_time(timestamp):
+            return [Sale.objects.create(member=self.member, product=self.product, price=600) for _ in range(count)]
+
+    def ranks(self, year):
+        request = RequestFactory().get("/admin/stregsystem/report/ranks/{}".format(year))
+        request.user = self.user
+        response = views.ranks(request, str(year))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def values(self, year, category):
+        return [(snapshot.member, snapshot.value) for snapshot in RankYear.objects.get(year=year).top(category)]
+
+    def test_closed_year_is_built_once(self):
+        self.sell(datetime.datetime(2016, 3, 1, 12, tzinfo=datetime.timezone.utc), count=3)
+
+        self.assertContains(self.ranks(2016), "ranked")
+        self.assertTrue(RankYear.objects.get(year=2016).complete)
+        self.assertEqual(self.values(2016, self.category), [(self.member, 3)])
+        self.assertEqual(self.values(2016, None), [(self.member, 1800)])
+
+        with CaptureQueriesContext(connection) as context:
+            self.ranks(2016)
+        self.assertFalse(any("stregsystem_sale" in query["sql"] for query in context.captured_queries))
+
+    def test_ongoing_year_catches_up(self):
+        from_time = views.fjule_party(2016)
+        self.sell(from_time + datetime.timedelta(days=10), count=2)
+
+        with freeze_time(from_time + datetime.timedelta(days=20)):
+            self.ranks(2017)
+            self.assertEqual(self.values(2017, self.category), [(self.member, 2)])
+            self.assertFalse(RankYear.objects.get(year=2017).complete)
+
+        self.sell(from_time + datetime.timedelta(days=30))
+        with freeze_time(from_time + datetime.timedelta(days=30)):
+            # The sale hasn't settled yet
+            self.ranks(2017)
+            self.assertEqual(self.values(2017, self.category), [(self.member, 2)])
+        with freeze_time(from_time + datetime.timedelta(days=30, minutes=2)):
+            self.ranks(2017)
+            self.assertEqual(self.values(2017, self.category), [(self.member, 3)])
+
+    def test_deleted_sale_rebuilds_year(self):
+        sales = self.sell(datetime.datetime(2016, 3, 1, 12, tzinfo=datetime.timezone.utc), count=2)
+        self.ranks(2016)
+
+        sales[0].delete()
+        self.assertTrue(RankYear.objects.get(year=2016).dirty)
+
+        self.ranks(2016)
+        self.assertEqual(self.values(2016, self.category), [(self.member, 1)])
+        self.assertEqual(self.values(2016, None), [(self.member, 600)])
+
+    def test_refund_rebuilds_its_year(self):
+        sales = self.sell(datetime.datetime(2016, 3, 1, 12, tzinfo=datetime.timezone.utc), count=2)
+        self.sell(datetime.datetime(2018, 3, 1, 12, tzinfo=datetime.timezone.utc))
+        self.ranks(2016)
+        self.ranks(2018)
+
+        Sale.refund(Sale.objects.filter(id__in=[sale.id for sale in sales]))
+
+        self.assertTrue(RankYear.objects.get(year=2016).dirty)
+        self.assertFalse(RankYear.objects.get(year=2018).dirty)
+        self.ranks(2016)
+        self.assertEqual(self.values(2016, self.category), [])
+
+    def test_category_change_rebuilds_year(self):
+        self.sell(datetime.datetime(2016, 3, 1, 12, tzinfo=datetime.timezone.utc))
+        self.ranks(2016)
+        other = Category.objects.create(name="Sodavand")
+
+        self.product.categories.set([other])
+
+        self.assertContains(self.ranks(2016), "Sodavand")
+        self.assertEqual(self.values(2016, self.category), [])
+        self.assertEqual(self.values(2016, other), [(self.member, 1)])
+
+
+class DailyTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("daily", "daily@example.com", "daily")
+        self.category = Category.objects.create(name="Øl")
+        self.product = Product.objects.create(name="Pilsner", price=600, active=True)
+        self.product.categories.add(self.category)
+        self.member = Member.objects.create(phone_number="daily", email="daily@example.com", balance=10000)
+
+    def sell(self, timestamp, count=1):
+        with freeze_time(timestamp):
+            for _ in range(count):
+                Sale.objects.create(member=self.member, product=self.product, price=600)
+
+    def get(self, view, **params):
+        request = RequestFactory().get("/admin/stregsystem/report/", params)
+        request.user = self.user
+        return view(request)
+
+    def test_daily_reads_the_rollup(self):
+        self.sell(timezone.now(), count=2)
+        self.sell(timezone.now() - datetime.timedelta(days=10))
+        self.sell(timezone.now() - datetime.timedelta(days=40))
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.get(views.daily)
+
+        self.assertContains(response, "12.00 kr")
+        self.assertContains(response, "18.00 kr")
+        sale_queries = [query["sql"] for query in context.captured_queries if "stregsystem_sale" in query["sql"]]
+        # Only the latest sales list reads the sales
+        self.assertEqual(len(sale_queries), 1)
+
+    def test_sales_api_defaults_to_the_last_30_days(self):
+        self.sell(timezone.now(), count=2)
+        self.sell(timezone.now() - datetime.timedelta(days=40))
+
+        data = json.loads(self.get(views.sales_api).content)
+
+        self.assertEqual(len(data["day"]), 30)
+        self.assertEqual(data["day"][0], str(timezone.localdate()))
+        self.assertEqual(data["sales"][0], 2)
+        self.assertEqual(data["revenue"][0], "12.00")
+        self.assertEqual(sum(data["sales"]), 2)
+
+    def test_sales_api_date_range(self):
+        self.sell(datetime.datetime(2023, 5, 2, 12, tzinfo=datetime.timezone.utc), count=3)
+
+        data = json.loads(self.get(views.sales_api, from_date="2023-05-01", to_date="2023-05-03").content)
+
+        self.assertEqual(data["day"], ["2023-05-03", "2023-05-02", "2023-05-01"])
+        self.assertEqual(data["sales"], [0, 3, 0])
+
+    def test_sales_api_invalid_range(self):
+        self.assertEqual(self.get(views.sales_api, from_date="2023-13-01").status_code, 400)
+        self.assertEqual(self.get(views.sales_api, from_date="2023-05-03", to_date="2023-05-01").status_code, 400)
+
+    def test_sales_api_caps_the_period(self):
+        self.assertEqual(self.get(views.sales_api, from_date="2023-01-01", to_date="2024-01-01").status_code, 200)
+        self.assertEqual(self.get(views.sales_api, from_date="2023-01-01", to_date="2024-01-02").status_code, 400)
+
+
+class CsvExportTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("csv", "csv@example.com", "csv"))
+        self.member = Member.objects.create(phone_number="csv", email="csv@example.com", balance=10000)
+        self.beer = Product.objects.create(name="Pilsner, dåse", price=600, active=True)
+        self.soda = Product.objects.create(name="Cola", price=400, active=True)
+        with freeze_time(datetime.datetime(2023, 5, 2, 12, tzinfo=datetime.timezone.utc)):
+            Sale.objects.create(member=self.member, product=self.beer, price=600)
+            Sale.objects.create(member=self.member, product=self.soda, price=400)
+            Payment.objects.create(member=self.member, amount=5000)
+
+    def rows(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertTrue(response.streaming)
+        return list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+
+    def test_sales_by_product_and_period(self):
+        rows = self.rows(
+            self.client.get(
+                reverse("sales_csv"),
+                {"products": str(self.beer.id), "from_date": "2023-05-01", "to_date": "2023-05-02"},
+            )
+        )
+
+        self.assertEqual(rows[0], ["Timestamp", "Product id", "Product", "Member", "Room", "Price"])
+        self.assertEqual([row[1:] for row in rows[1:]], [[str(self.beer.id), "Pilsner, dåse", "csv", "None", "600"]])
+
+    def test_sales_outside_period(self):
+        rows = self.rows(self.client.get(reverse("sales_csv"), {"from_date": "2023-05-03", "to_date": "2023-05-04"}))
+
+        self.assertEqual(len(rows), 1)
+
+    def test_sales_invalid_arguments(self):
+        self.assertEqual(self.client.get(reverse("sales_csv"), {"products": "abe"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("sales_csv"), {"from_date": "2023-13-01"}).status_code, 400)
+
+    def test_member_sales(self):
+        rows = self.rows(self.client.get(reverse("member_sales_csv", args=(self.member.id,))))
+
+        self.assertEqual([row[1] for row in rows[1:]], ["Pilsner, dåse", "Cola"])
+
+    def test_payments(self):
+        rows = self.rows(
+            self.client.get(
+                reverse("payments_csv"), {"from_date": "2023-05-01", "to_date": "2023-05-31", "member": "csv"}
+            )
+        )
+
+        self.assertEqual(rows[1][1:], ["csv", "5000", "False"])
+
+    def test_requires_staff(self):
+        self.client.logout()
+
+        self.assertEqual(self.client.get(reverse("payments_csv")).status_code, 302)
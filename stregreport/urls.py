@@ -25,4 +25,7 @@ urlpatterns = [
     re_path(r'^admin/stregsystem/report/$', views.reports),
     re_path(r'^admin/stregsystem/report/sales_api$', views.sales_api),
     re_path(r'^admin/stregsystem/report/categories/$', views.user_purchases_in_categories),
+    re_path(r'^api/reports/sales\.csv$', views.sales_csv, name="sales_csv"),
+    re_path(r'^api/reports/member/(?P<member_id>\d+)/sales\.csv$', views.member_sales_csv, name="member_sales_csv"),
+    re_path(r'^api/reports/payments\.csv$', views.payments_csv, name="payments_csv"),
 ]
@@ -1,17 +1,19 @@
 import datetime
 from functools import reduce
+from itertools import chain
 
 import pytz
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import permission_required
-from django.db.models import Count, Q, Sum
-from django.db.models.functions import TruncDay
-from django.http import JsonResponse
-from django.shortcuts import render
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.shortcuts import get_object_or_404, render
 from django.utils import timezone
 from stregreport.forms import CategoryReportForm
-from stregsystem.models import Category, Member, Product, Sale
+from stregreport.models import RankYear
+from stregsystem.models import Category, DailySales, Member, MobilePayment, Payment, Product, Sale
 from stregsystem.templatetags.stregsystem_extras import money
+from stregsystem.utils import csv_response, date_to_midnight
 
 
 @permission_required("stregsystem.access_sales_reports")
@@ -109,60 +111,94 @@ def sales_product(request, ids, from_time, to_time, error=None):
     return render(request, 'admin/stregsystem/report/sales.html', locals())
 
 
+def _csv_date_range(request):
+    """
+    Returns the period between midnight before from_date and midnight after to_date, both local dates given as
+    YYYY-MM-DD. Defaults to the first of the month until now.
+    """
+    date_format = '%Y-%m-%d'
+    today = timezone.localdate()
+    from_date = datetime.datetime.strptime(
+        request.GET.get('from_date') or today.replace(day=1).isoformat(), date_format
+    )
+    to_date = datetime.datetime.strptime(request.GET.get('to_date') or today.isoformat(), date_format)
+    return date_to_midnight(from_date), date_to_midnight(to_date + datetime.timedelta(days=1))
+
+
+@permission_required("stregsystem.access_sales_reports")
+def sales_csv(request):
+    try:
+        from_time, to_time = _csv_date_range(request)
+        ids = parse_id_string(request.GET['products']) if request.GET.get('products', '').strip() else None
+    except (ValueError, RuntimeError) as ex:
+        return HttpResponseBadRequest(str(ex))
+
+    sales = Sale.objects.filter(timestamp__gte=from_time, timestamp__lt=to_time)
+    if ids is not None:
+        sales = sales.filter(product__in=ids)
+    rows = sales.order_by('timestamp').values_list(
+        'timestamp', 'product_id', 'product__name', 'member__phone_number', 'room__name', 'price'
+    )
+    return csv_response(
+        f"sales_{from_time:%Y-%m-%d}_{to_time - datetime.timedelta(days=1):%Y-%m-%d}.csv",
+        chain([["Timestamp", "Product id", "Product", "Member", "Room", "Price"]], rows.iterator()),
+    )
+
+
+sales_csv = staff_member_required(sales_csv)
+
+
+@permission_required("stregsystem.access_sales_reports")
+def member_sales_csv(request, member_id):
+    member = get_object_or_404(Member, pk=member_id)
+    rows = member.sale_set.order_by('timestamp').values_list('timestamp', 'product__name', 'room__name', 'price')
+    return csv_response(
+        f"sales_{member.phone_number}.csv",
+        chain([["Timestamp", "Name", "Room", "Price"]], rows.iterator()),
+    )
+
+
+member_sales_csv = staff_member_required(member_sales_csv)
+
+
+@permission_required("stregsystem.access_sales_reports")
+def payments_csv(request):
+    try:
+        from_time, to_time = _csv_date_range(request)
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+
+    payments = Payment.objects.filter(timestamp__gte=from_time, timestamp__lt=to_time)
+    if request.GET.get('member'):
+        payments = payments.filter(member__phone_number=request.GET['member'])
+    rows = (
+        payments.annotate(is_mobilepay=Exists(MobilePayment.objects.filter(payment=OuterRef('pk'))))
+        .order_by('timestamp')
+        .values_list('timestamp', 'member__phone_number', 'amount', 'is_mobilepay')
+    )
+    return csv_response(
+        f"payments_{from_time:%Y-%m-%d}_{to_time - datetime.timedelta(days=1):%Y-%m-%d}.csv",
+        chain([["Timestamp", "Member", "Amount", "Is Mobilepay"]], rows.iterator()),
+    )
+
+
+payments_csv = staff_member_required(payments_csv)
+
+
 # renders stats for the year starting at first friday in december (year - 1) to the first friday in december (year)
 # both at 10 o'clock
 @permission_required("stregsystem.access_sales_reports")
 def ranks_for_year(request, year):
     if year <= 1900 or year > 9999:
         return render(request, 'admin/stregsystem/report/error_ranksnotfound.html', locals())
-    milk = [2, 3, 4, 5, 6, 7, 8, 9, 10, 16, 17, 18, 19, 20, 24, 25, 43, 44, 45, 1865]
-    caffeine = [11, 12, 30, 34, 37, 1787, 1790, 1791, 1795, 1799, 1800, 1803, 1804, 1837, 1864]
-    beer = [
-        13,
-        14,
-        29,
-        42,
-        47,
-        54,
-        65,
-        66,
-        1773,
-        1776,
-        1777,
-        1779,
-        1780,
-        1783,
-        1793,
-        1794,
-        1807,
-        1808,
-        1809,
-        1820,
-        1822,
-        1840,
-        1844,
-        1846,
-        1847,
-        1853,
-        1855,
-        1856,
-        1858,
-        1859,
-    ]
-    coffee = [32, 35, 36, 39]
-    vitamin = [1850, 1851, 1852, 1863, 1880]
-
     FORMAT = '%d/%m/%Y kl. %H:%M'
     last_year = year - 1
     next_year = year + 1
     from_time = fjule_party(year - 1)
     to_time = fjule_party(year)
-    kr_stat_list = sale_money_rank(from_time, to_time)
-    beer_stat_list = sale_product_rank(beer, from_time, to_time)
-    caffeine_stat_list = sale_product_rank(caffeine, from_time, to_time)
-    milk_stat_list = sale_product_rank(milk, from_time, to_time)
-    coffee_stat_list = sale_product_rank(coffee, from_time, to_time)
-    vitamin_stat_list = sale_product_rank(vitamin, from_time, to_time)
+    rank_year = RankYear.up_to_date(year, from_time, to_time)
+    kr_stat_list = rank_year.top(None)
+    category_stat_lists = [(category, rank_year.top(category)) for category in Category.objects.order_by('name')]
     from_time_string = from_time.strftime(FORMAT)
     to_time_string = to_time.strftime(FORMAT)
     current_date = timezone.now()
@@ -171,28 +207,6 @@ def ranks_for_year(request, year):
     return render(request, 'admin/stregsystem/report/ranks.html', locals())
 
 
-# gives a list of member objects, with the additional field sale__count, with the number of sales which are in the parameter id
-def sale_product_rank(ids, from_time, to_time, rank_limit=10):
-    stat_list = (
-        Member.objects.filter(sale__timestamp__gt=from_time, sale__timestamp__lte=to_time, sale__product__in=ids)
-        .annotate(Count('sale'))
-        .order_by('-sale__count', 'phone_number')[:rank_limit]
-    )
-    return stat_list
-
-
-# gives a list of member object, with the additional field sale__price__sum__formatted which is the number of money spent in the period given.
-def sale_money_rank(from_time, to_time, rank_limit=10):
-    stat_list = (
-        Member.objects.filter(active=True, sale__timestamp__gt=from_time, sale__timestamp__lte=to_time)
-        .annotate(Sum('sale__price'))
-        .order_by('-sale__price__sum', 'phone_number')[:rank_limit]
-    )
-    for member in stat_list:
-        member.sale__price__sum__formatted = money(member.sale__price__sum)
-    return stat_list
-
-
 # year of the last fjuleparty
 def last_fjule_party_year():
     current_date = timezone.now()
@@ -236,37 +250,58 @@ def first_of_month(date):
 
 @permission_required("stregsystem.access_sales_reports")
 def daily(request):
-    current_date = timezone.now().replace(hour=0, minute=0, second=0)
+    today = timezone.localdate()
     latest_sales = Sale.objects.prefetch_related('product', 'member').order_by('-timestamp')[:7]
     top_today = (
-        Product.objects.filter(sale__timestamp__gt=current_date).annotate(Count('sale')).order_by('-sale__count')[:7]
+        Product.objects.filter(dailysales__day=today).annotate(sold=Sum('dailysales__count')).order_by('-sold')[:7]
     )
 
-    startTime_day = timezone.now() - datetime.timedelta(hours=24)
-    revenue_day = (Sale.objects.filter(timestamp__gt=startTime_day).aggregate(Sum("price"))["price__sum"]) or 0.0
-    startTime_month = timezone.now() - datetime.timedelta(days=30)
-    revenue_month = (Sale.objects.filter(timestamp__gt=startTime_month).aggregate(Sum("price"))["price__sum"]) or 0.0
+    revenue_day = DailySales.objects.filter(day=today).aggregate(Sum("revenue"))["revenue__sum"] or 0.0
+    first_day_month = today - datetime.timedelta(days=29)
+    revenue_month = (
+        DailySales.objects.filter(day__gte=first_day_month).aggregate(Sum("revenue"))["revenue__sum"]
+    ) or 0.0
     top_month_category = (
-        Category.objects.filter(product__sale__timestamp__gt=startTime_month)
-        .annotate(sale=Count("product__sale"))
+        Category.objects.filter(product__dailysales__day__gte=first_day_month)
+        .annotate(sale=Sum("product__dailysales__count"))
         .order_by("-sale")[:7]
     )
 
     return render(request, 'admin/stregsystem/report/daily.html', locals())
 
 
+# Every day of the period is in the response, so the period is capped
+SALES_API_MAX_DAYS = 366
+
+
 def sales_api(request):
-    startTime_month = timezone.now() - datetime.timedelta(days=30)
+    date_format = '%Y-%m-%d'
+    try:
+        to_date = datetime.datetime.strptime(request.GET['to_date'], date_format).date()
+    except KeyError:
+        to_date = timezone.localdate()
+    except ValueError:
+        return JsonResponse({"error": "to_date must be a date like 2024-12-24"}, status=400)
+    try:
+        from_date = datetime.datetime.strptime(request.GET['from_date'], date_format).date()
+    except KeyError:
+        from_date = to_date - datetime.timedelta(days=29)
+    except ValueError:
+        return JsonResponse({"error": "from_date must be a date like 2024-12-24"}, status=400)
+    if from_date > to_date:
+        return JsonResponse({"error": "from_date must not be after to_date"}, status=400)
+    if (to_date - from_date).days >= SALES_API_MAX_DAYS:
+        return JsonResponse({"error": f"The period can be at most {SALES_API_MAX_DAYS} days"}, status=400)
+
     qs = (
-        Sale.objects.filter(timestamp__gt=startTime_month)
-        .annotate(day=TruncDay('timestamp'))
+        DailySales.objects.filter(day__gte=from_date, day__lte=to_date)
         .values('day')
-        .annotate(c=Count('*'))
-        .annotate(r=Sum('price'))
+        .annotate(c=Sum('count'))
+        .annotate(r=Sum('revenue'))
+        .order_by()
     )
-    db_sales = {i["day"].date(): (i["c"], money(i["r"])) for i in qs}
-    base = timezone.now().date()
-    date_list = [base - datetime.timedelta(days=x) for x in range(0, 30)]
+    db_sales = {i["day"]: (i["c"], money(i["r"])) for i in qs}
+    date_list = [to_date - datetime.timedelta(days=x) for x in range((to_date - from_date).days + 1)]
 
     sales_list = []
     revenue_list = []
@@ -3,7 +3,9 @@ from django.contrib import admin
 from django.contrib import messages
 from django.contrib.admin.models import LogEntry
 from django.contrib.admin.views.autocomplete import AutocompleteJsonView
+from django.db import transaction
 
+from stregsystem import ledger
 from stregsystem.models import (
     Category,
     Member,
@@ -21,11 +23,7 @@ from stregsystem.utils import make_active_productlist_query, make_inactive_produ
 
 
 def refund(modeladmin, request, queryset):
-    for obj in queryset:
-        transaction = PayTransaction(obj.price)
-        obj.member.rollback(transaction)
-        obj.member.save()
-    queryset.delete()
+    Sale.refund(queryset, user=getattr(request, 'user', None))
 
 
 refund.short_description = "Refund selected"
@@ -73,18 +71,19 @@ class SaleAdmin(admin.ModelAdmin):
     get_room_name.short_description = "Room"
     get_room_name.admin_order_field = "room__name"
 
+    # Deleting sales refunds them. The admin logs the deletions itself.
     def delete_model(self, request, obj):
-        transaction = PayTransaction(obj.price)
-        obj.member.rollback(transaction)
-        obj.member.save()
-        super(SaleAdmin, self).delete_model(request, obj)
+        Sale.refund(Sale.objects.filter(id=obj.id))
+
+    def delete_queryset(self, request, queryset):
+        Sale.refund(queryset)
 
+    @transaction.atomic
     def save_model(self, request, obj, form, change):
         if change:
             return
-        transaction = PayTransaction(obj.price)
-        obj.member.fulfill(transaction)
-        obj.member.save()
+        # Sales added by hand are charged even if they overdraw the balance, like payments can
+        ledger.change_balance(obj.member, PayTransaction(obj.price).change())
         super(SaleAdmin, self).save_model(request, obj, form, change)
 
     def get_price_display(self, obj):
@@ -96,17 +95,6 @@ class SaleAdmin(admin.ModelAdmin):
     get_price_display.admin_order_field = "price"
 
 
-def refund(modeladmin, request, queryset):
-    for obj in queryset:
-        transaction = PayTransaction(obj.price)
-        obj.member.rollback(transaction)
-        obj.member.save()
-    queryset.delete()
-
-
-refund.short_description = "Refund selected"
-
-
 def toggle_active_selected_products(modeladmin, request, queryset):
     "toggles active on products, also removes deactivation date."
     # This is horrible since it does not use update, but update will
@@ -210,6 +198,26 @@ class MemberForm(forms.ModelForm):
         model = Member
         exclude = []
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if 'balance' in self.fields:
+            # Remember the balance the form was shown with, see balance_change
+            self.fields['balance'].show_hidden_initial = True
+
+    def balance_change(self):
+        """
+        Returns how much the balance was changed in the form, compared to the balance the form was shown with.
+        Purchases and payments may have changed the balance in the meantime, so it's the change that's saved.
+        """
+        field = self.fields['balance']
+        try:
+            shown = field.to_python(self.data.get(self['balance'].html_initial_name))
+        except forms.ValidationError:
+            shown = None
+        if shown is None:
+            shown = self['balance'].initial
+        return self.cleaned_data['balance'] - shown
+
     def clean_phone_number(self):
         phone_number = self.cleaned_data['phone_number']
         if self.instance is None or self.instance.pk is None:
@@ -247,7 +255,20 @@ class MemberAdmin(admin.ModelAdmin):
         if 'phone_number' in form.changed_data and change:
             if Member.objects.filter(phone_number=obj.phone_number).exclude(pk=obj.pk).exists():
                 messages.add_message(request, messages.WARNING, 'Det brugernavn var allerede optaget')
-        super().save_model(request, obj, form, change)
+        if not change:
+            super().save_model(request, obj, form, change)
+            return
+
+        # Saving the balance would overwrite the purchases and payments made while the form was open
+        with transaction.atomic():
+            obj.save(
+                update_fields=[
+                    field.name for field in Member._meta.concrete_fields if field.name not in ('id', 'balance')
+                ]
+            )
+            delta = form.balance_change()
+            if delta:
+                ledger.change_balance(obj, delta)
 
     def autocomplete_view(self, request):
         """
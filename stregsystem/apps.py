@@ -1,13 +1,28 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
-from stregsystem.signals import after_member_save
+from stregsystem.signals import (
+    after_member_save,
+    after_named_product_change,
+    after_product_list_change,
+    after_sale_delete,
+    after_sale_save,
+)
 
 
 class StregConfig(AppConfig):
     name = 'stregsystem'
 
     def ready(self):
-        from stregsystem.models import Member
+        from stregsystem.models import Member, NamedProduct, Product, Room, Sale
 
         post_save.connect(after_member_save, sender=Member)
+        post_save.connect(after_named_product_change, sender=NamedProduct)
+        post_delete.connect(after_named_product_change, sender=NamedProduct)
+        post_save.connect(after_sale_save, sender=Sale)
+        post_delete.connect(after_sale_delete, sender=Sale)
+        for sender in (Product, Room):
+            post_save.connect(after_product_list_change, sender=sender)
+            post_delete.connect(after_product_list_change, sender=sender)
+        m2m_changed.connect(after_product_list_change, sender=Product.rooms.through)
+        m2m_changed.connect(after_product_list_change, sender=Product.categories.through)
@@ -39,6 +39,11 @@ def alcohol_bac_degradation(time):
     return BAC_DEGRADATION_PR_HOUR * time_hours
 
 
+def alcohol_bac_decay(bac, time):
+    # A negative BAC doesn't make sense
+    return max(bac - alcohol_bac_degradation(time), 0)
+
+
 def alcohol_bac_timeline(gender, weight, now, alcohol_timeline):
     # If we didn't drink anything, we can't have any alcohol
     if len(alcohol_timeline) == 0:
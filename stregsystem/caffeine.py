@@ -21,6 +21,13 @@ def caffeine_mg_to_coffee_cups(mg: int) -> int:
     return int(mg / CAFFEINE_IN_COFFEE)
 
 
+def caffeine_decay(mg: float, time: timedelta) -> float:
+    """
+    Degrades a caffeine content in blood over the given timespan, using the same compound rule as below.
+    """
+    return max(mg * ((1 - CAFFEINE_DEGRADATION_PR_HOUR) ** (time / timedelta(hours=1))), 0)
+
+
 # calculate current caffeine in body, takes list of intakes, applies caffeine degradation by using compound interest
 def current_caffeine_in_body_compound_interest(intakes: List[Intake]) -> float:
     """
@@ -0,0 +1,34 @@
+"""
+Changes to member balances.
+
+Every balance change is a single UPDATE adding the change to the balance in the database, so concurrent purchases,
+payments and refunds of the same member never overwrite each other, and purchases don't have to lock the member row.
+Charges are conditional: the UPDATE only applies if the balance covers them.
+"""
+
+from django.db.models import F
+
+
+def apply(member_id, delta, allow_overdraft=True) -> bool:
+    """
+    Adds delta to the balance of the member. With allow_overdraft=False it's only added if the balance stays
+    non-negative. Returns whether the balance was changed.
+    """
+    from stregsystem.models import Member
+
+    members = Member.objects.filter(id=member_id)
+    if not allow_overdraft:
+        members = members.filter(balance__gte=-delta)
+    return members.update(balance=F('balance') + delta) == 1
+
+
+def change_balance(member, delta, allow_overdraft=True) -> bool:
+    """
+    Like apply, and then refreshes the balance of the member instance from the database, whether the change was
+    applied or not.
+    """
+    from stregsystem.models import Member
+
+    applied = apply(member.id, delta, allow_overdraft)
+    member.balance = Member.objects.filter(id=member.id).values_list('balance', flat=True).get()
+    return applied
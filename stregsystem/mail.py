@@ -1,11 +1,15 @@
-import smtplib
+import datetime
 import logging
 import smtplib
+import threading
+from contextlib import contextmanager
+from email.utils import parseaddr
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
 
 from django.conf import settings
+from django.db import transaction
 from django.template.loader import render_to_string
 from django.utils.html import escape
 from django.utils import timezone
@@ -15,6 +19,14 @@ from stregsystem.utils import rows_to_csv
 
 logger = logging.getLogger(__name__)
 
+# How long a worker may spend on a batch of mails before another worker picks them up
+MAIL_LEASE_TIME = datetime.timedelta(minutes=5)
+MAIL_RETRY_DELAY = datetime.timedelta(minutes=1)
+MAIL_MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+MAIL_TIMEOUT = 30
+
+_bulk_queue = threading.local()
+
 
 def send_welcome_mail(member):
     send_template_mail(
@@ -72,11 +84,14 @@ def send_userdata_mail(member):
         f'{member.phone_number} has requested their user data!',
         {"sales.csv": sales_csv.encode(), "payments.csv": payments_csv.encode(), "userdata.csv": userdata_csv.encode()},
     )
-    member.save()
     return True
 
 
 def send_template_mail(member, target_template: str, context: dict, subject: str, attachments: dict = {}):
+    if '@' not in parseaddr(member.email)[1]:
+        # The mail server would refuse it anyway, so don't keep it in the queue
+        return
+
     msg = MIMEMultipart()
     msg['From'] = 'treo@fklub.dk'
     msg['To'] = member.email
@@ -84,16 +99,104 @@ def send_template_mail(member, target_template: str, context: dict, subject: str
     html = render_to_string(f"mail/{target_template}", context)
     msg.attach(MIMEText(html, 'html'))
 
-    if hasattr(settings, 'TEST_MODE'):
-        return
-
     for name, attachment in attachments.items():
         attachment = MIMEApplication(attachment, Name=name)
         attachment['Content-Disposition'] = f'attachment; filename={name}'
         msg.attach(attachment)
 
+    queue_mail('treo@fklub.dk', member.email, subject, msg)
+
+
+def queue_mail(sender: str, recipient: str, subject: str, msg):
+    """
+    Queues the message for the sendmail command, instead of talking to the mail server while the caller holds locks.
+    Inside a transaction the mail is only queued if the transaction commits.
+    """
+    from .models import OutgoingMail
+
+    mail = OutgoingMail(sender=sender, recipient=recipient, subject=subject, message=msg.as_string())
+    if getattr(_bulk_queue, 'mails', None) is not None:
+        _bulk_queue.mails.append(mail)
+    else:
+        mail.save()
+
+
+@contextmanager
+def queue_mails_in_bulk():
+    """
+    Collects the mails queued inside the block, and inserts them in one query when it ends.
+    """
+    from .models import OutgoingMail
+
+    if getattr(_bulk_queue, 'mails', None) is not None:
+        # Already collecting in an outer block
+        yield
+        return
+    _bulk_queue.mails = []
+    try:
+        yield
+        OutgoingMail.objects.bulk_create(_bulk_queue.mails)
+    finally:
+        _bulk_queue.mails = None
+
+
+def retry_delay(attempts: int) -> datetime.timedelta:
+    # Exponential backoff: a minute, two minutes, four minutes, ... capped at six hours
+    return min(MAIL_RETRY_DELAY * 2 ** (attempts - 1), MAIL_MAX_RETRY_DELAY)
+
+
+def send_queued_mails(batch_size=100, max_attempts=8):
+    """
+    Sends a batch of the due mails in the queue over a single SMTP connection.
+    Mails which fail are retried later with backoff, until they have been attempted max_attempts times.
+
+    :return: the number of mails sent and the number of mails which failed
+    """
+    from .models import OutgoingMail
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Lease the batch, so another worker running at the same time picks other mails
+        batch = list(
+            OutgoingMail.objects.select_for_update(skip_locked=True)
+            .filter(sent=None, next_attempt__lte=now, attempts__lt=max_attempts)
+            .order_by('next_attempt')[:batch_size]
+        )
+        OutgoingMail.objects.filter(id__in=[mail.id for mail in batch]).update(next_attempt=now + MAIL_LEASE_TIME)
+    if not batch:
+        return 0, 0
+
+    sent = []
+    failed = []
+    connection = None
     try:
-        smtpObj = smtplib.SMTP('localhost', 25)
-        smtpObj.sendmail('treo@fklub.dk', member.email, msg.as_string())
-    except Exception as e:
-        logger.error(str(e))
+        connection = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT, timeout=MAIL_TIMEOUT)
+        for mail in batch:
+            try:
+                connection.sendmail(mail.sender, mail.recipient, mail.message.encode())
+                sent.append(mail)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                # The server refused this mail, the connection is still good for the rest
+                failed.append((mail, e))
+    except (OSError, smtplib.SMTPException) as e:
+        # The connection failed, retry everything that wasn't sent
+        attempted = {mail.id for mail in sent} | {mail.id for mail, _ in failed}
+        failed += [(mail, e) for mail in batch if mail.id not in attempted]
+    finally:
+        if connection is not None:
+            try:
+                connection.quit()
+            except (OSError, smtplib.SMTPException):
+                pass
+
+    OutgoingMail.objects.filter(id__in=[mail.id for mail in sent]).update(sent=timezone.now(), last_error="")
+    for mail, error in failed:
+        mail.attempts += 1
+        mail.last_error = str(error)
+        mail.next_attempt = timezone.now() + retry_delay(mail.attempts)
+        mail.save(update_fields=['attempts', 'last_error', 'next_attempt'])
+        if mail.attempts >= max_attempts:
+            logger.error(f"Giving up on mail {mail.id} to {mail.recipient}: {error}")
+        else:
+            logger.warning(f"Failed sending mail {mail.id} to {mail.recipient}, retrying later: {error}")
+    return len(sent), len(failed)
@@ -1,24 +1,45 @@
+import logging
+import time
+
 from django.contrib.auth.models import User
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, call_command
+from django.db import close_old_connections
 
 from stregsystem.models import MobilePayment
 from stregsystem.utils import make_unprocessed_member_filled_mobilepayment_query
 
 
 class Command(BaseCommand):
-    help = "Run mobilepayment matching and insert exact matches automatically"
+    help = (
+        "Run mobilepayment matching and insert exact matches automatically. "
+        "With --loop it runs as a service, importing the latest payments from MobilePay before matching them, "
+        "so deposits reach the balances of the members within --interval seconds."
+    )
+
+    logger = logging.getLogger(__name__)
+
+    # Seconds between the imports of the past days in --loop
+    historic_import_interval = 60 * 60
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true', help="Keep importing, matching and submitting instead of running once"
+        )
+        parser.add_argument('--interval', type=float, default=10, help="Seconds between the cycles of --loop")
 
     def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        if options['loop']:
+            self.run_loop(options['interval'])
+            return
+
         # if no payments to be processed exists, stop job
         if make_unprocessed_member_filled_mobilepayment_query().count() == 0:
             self.stdout.write(self.style.NOTICE("[autopayment] No payments to be auto-processed"))
             return
 
-        # if logging user does not exist, stop job
-        if User.objects.filter(username="autopayment").exists():
-            auto_user = User.objects.get(username="autopayment")
-        else:
-            self.stdout.write(self.style.ERROR("[autopayment] No user 'autopayment' exists, cannot do autopayments."))
+        auto_user = self.autopayment_user()
+        if auto_user is None:
             return
 
         # count, approve, and submit mobilepayments
@@ -30,3 +51,56 @@ class Command(BaseCommand):
         self.stdout.write(
             self.style.SUCCESS(f'[autopayment] Successfully submitted {count} mobilepayments automatically')
         )
+
+    def autopayment_user(self):
+        # if logging user does not exist, stop job
+        auto_user = User.objects.filter(username="autopayment").first()
+        if auto_user is None:
+            self.stdout.write(self.style.ERROR("[autopayment] No user 'autopayment' exists, cannot do autopayments."))
+        return auto_user
+
+    def run_loop(self, interval):
+        auto_user = self.autopayment_user()
+        if auto_user is None:
+            return
+
+        # Every cycle only reads the transaction feed, the ledgers of the past days are imported again once in a while,
+        # in case some of their payments showed up late. Mobile payments matched by hand are submitted by the
+        # mobilepaytool itself.
+        last_historic_import = None
+        while True:
+            days_back = 0
+            if last_historic_import is None or time.monotonic() - last_historic_import >= self.historic_import_interval:
+                days_back = None
+                last_historic_import = time.monotonic()
+            try:
+                self.cycle(auto_user, days_back)
+            except Exception:
+                self.logger.exception("[autopayment] Cycle failed")
+            time.sleep(interval)
+
+    def cycle(self, auto_user, days_back=0):
+        """
+        Imports the payments of the transaction feed and of the ledgers of the last days_back days, or of the default
+        number of days if it's None, and approves and submits all unprocessed mobile payments.
+        Returns the number of submitted mobile payments.
+        """
+        # The loop runs for days, so drop connections the database has closed or that are too old, like requests do
+        close_old_connections()
+        start = time.perf_counter()
+        if days_back is None:
+            call_command('importmobilepaypayments')
+        else:
+            call_command('importmobilepaypayments', days_back)
+
+        # Looking for them by status, rather than by id, also finds mobile payments a slower import committed late
+        approved = MobilePayment.approve_member_filled_mobile_payments()
+        submitted = MobilePayment.submit_processed_mobile_payments(auto_user)
+        elapsed = time.perf_counter() - start
+
+        if approved or submitted or self.verbosity > 1:
+            self.stdout.write(
+                f"[autopayment] Cycle took {elapsed * 1000:.0f} ms: {approved} mobilepayments approved, "
+                f"{submitted} submitted ({submitted / elapsed:.1f} payments/s)"
+            )
+        return submitted
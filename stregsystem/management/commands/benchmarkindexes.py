@@ -0,0 +1,111 @@
+import datetime
+import statistics
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from stregsystem.models import Member, MobilePayment, Sale
+from stregsystem.utils import make_processed_mobilepayment_query, make_unprocessed_mobilepayment_query
+
+
+class RollbackBenchmark(Exception):
+    pass
+
+
+# The indexes added for the access patterns below, as (model, columns)
+BENCHMARKED_INDEXES = [
+    (Member, ["phone_number"]),
+    (Sale, ["member_id", "timestamp"]),
+    (Sale, ["timestamp"]),
+    (MobilePayment, ["status", "payment_id"]),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the queries behind quickbuy, the member history and the sales reports, "
+        "first without and then with the member and sale indexes, printing query plans and timings. "
+        "Use --seed to fill the configured database with a production sized dataset first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help="Seed the database before benchmarking")
+        parser.add_argument('--members', type=int, default=100_000, help="Number of members to seed")
+        parser.add_argument('--sales', type=int, default=10_000_000, help="Number of sales to seed")
+        parser.add_argument('--years', type=int, default=5, help="Number of years the seeded sales span")
+        parser.add_argument('--batch-size', type=int, default=10_000, help="Rows per INSERT when seeding")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of times each query is run")
+
+    def handle(self, *args, **options):
+        if not connection.features.can_rollback_ddl:
+            raise CommandError(
+                "The benchmark drops indexes in a transaction, which {} can't roll back".format(connection.vendor)
+            )
+
+        if options['seed']:
+            call_command(
+                'generatedata',
+                members=options['members'],
+                sales=options['sales'],
+                years=options['years'],
+                batch_size=options['batch_size'],
+                stdout=self.stdout,
+            )
+
+        member = Member.objects.order_by('?').first()
+        if member is None:
+            raise CommandError("The database has no members, run with --seed")
+
+        self.stdout.write(
+            f"Database: {connection.vendor}, {Member.objects.count()} members, {Sale.objects.count()} sales"
+        )
+
+        try:
+            with transaction.atomic():
+                names = self.index_names()
+                with connection.cursor() as cursor:
+                    for name in names:
+                        cursor.execute("DROP INDEX {}".format(connection.ops.quote_name(name)))
+                self.benchmark("without indexes", member, options['repeat'])
+                raise RollbackBenchmark
+        except RollbackBenchmark:
+            pass
+        self.benchmark("with indexes", member, options['repeat'])
+
+    @staticmethod
+    def index_names():
+        names = []
+        with connection.cursor() as cursor:
+            for model, columns in BENCHMARKED_INDEXES:
+                constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                names += [
+                    name
+                    for name, constraint in constraints.items()
+                    if constraint['index'] and not constraint['unique'] and constraint['columns'] == columns
+                ]
+        return names
+
+    def benchmark(self, label, member, repeat):
+        now = timezone.now()
+        queries = {
+            "quickbuy member lookup": Member.objects.filter(phone_number=member.phone_number, active=True),
+            "member recent sales": Sale.objects.filter(member=member, timestamp__gt=now - datetime.timedelta(hours=12)),
+            "member last sales": member.sale_set.order_by('-timestamp')[:10],
+            "sales today": Sale.objects.filter(timestamp__gte=now - datetime.timedelta(days=1)),
+            "unprocessed mobilepayments": make_unprocessed_mobilepayment_query(),
+            "processed mobilepayments": make_processed_mobilepayment_query(),
+        }
+
+        self.stdout.write(self.style.MIGRATE_HEADING(label))
+        for name, queryset in queries.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - start) * 1000)
+            self.stdout.write(f"{name}: median {statistics.median(timings):.2f} ms, max {max(timings):.2f} ms")
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f"    {line}")
@@ -0,0 +1,88 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from stregsystem.models import Member, Order, PayTransaction, Product, Room, Sale
+from stregsystem.utils import bulk_create_with_ids
+
+
+class RollbackBenchmark(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks executing orders with one INSERT per sale against a single bulk INSERT. "
+        "Runs against the configured database (set ENGINE in local.cfg to compare SQLite and PostgreSQL), "
+        "and rolls back everything it writes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--counts',
+            nargs='+',
+            type=int,
+            default=[1, 10, 100],
+            help="Number of items in the benchmarked orders",
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=20,
+            help="Number of times each order is executed",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Database: {connection.vendor}")
+        self.stdout.write(f"{'items':>6} {'strategy':>8} {'median ms':>10} {'max ms':>10} {'queries':>8}")
+
+        try:
+            with transaction.atomic():
+                room = Room.objects.create(name="benchmark", description="benchmarkorders")
+                product = Product.objects.create(name="benchmark", price=1, active=True)
+                # Bulk create the member, so we don't send a welcome mail
+                (member,) = bulk_create_with_ids(
+                    Member, [Member(phone_number="benchmark", full_name="Benchmark", balance=10**9)]
+                )
+
+                for count in options['counts']:
+                    for name, execute in (("per-row", self.execute_per_row), ("bulk", Order.execute)):
+                        timings, queries = self.run(execute, member, room, product, count, options['repeat'])
+                        self.stdout.write(
+                            f"{count:>6} {name:>8} {statistics.median(timings):>10.2f} {max(timings):>10.2f} "
+                            f"{queries:>8}"
+                        )
+                raise RollbackBenchmark
+        except RollbackBenchmark:
+            pass
+
+    @staticmethod
+    def run(execute, member, room, product, count, repeat):
+        timings = []
+        queries = 0
+        for _ in range(repeat):
+            order = Order.from_products(member=member, room=room, products=[product] * count)
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                execute(order)
+                timings.append((time.perf_counter() - start) * 1000)
+            queries = len(context.captured_queries)
+        return timings, queries
+
+    @staticmethod
+    @transaction.atomic
+    def execute_per_row(order):
+        """
+        The previous implementation of Order.execute, which saves every sale on its own.
+        """
+        order.member = Member.objects.select_for_update().get(id=order.member.id)
+        order.member.fulfill(PayTransaction(amount=order.total()))
+
+        for item in order.items:
+            for i in range(item.count):
+                Sale(member=order.member, product=item.product, room=order.room, price=item.product.price).save()
+
+        order.member.save()
@@ -0,0 +1,293 @@
+import datetime
+import itertools
+import random
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from stregsystem.models import (
+    Category,
+    DailySales,
+    Member,
+    MobilePayment,
+    Payment,
+    Product,
+    Room,
+    Sale,
+    WeeklyCoffeeCount,
+)
+from stregsystem.utils import bulk_create_with_ids
+
+# Relative amount of sales in each hour of the day, and on each day of the week (monday first).
+# Sales pick up around lunch, peak in the afternoon, and the friday bar runs late.
+HOUR_WEIGHTS = [2, 1, 1, 0, 0, 0, 0, 1, 3, 6, 8, 10, 14, 12, 12, 14, 16, 16, 12, 10, 9, 8, 6, 4]
+WEEKDAY_WEIGHTS = [10, 11, 11, 12, 18, 3, 2]
+HOUR_CUM_WEIGHTS = list(itertools.accumulate(HOUR_WEIGHTS))
+
+
+@contextmanager
+def keep_timestamps(*models):
+    """
+    Lets generated rows keep their timestamp, instead of auto_now_add overwriting it with the current time.
+    """
+    fields = [model._meta.get_field('timestamp') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a synthetic dataset in the configured database: members, rooms, categories, products, "
+        "years of sales with a realistic time of day distribution, and the payments and mobile payments covering "
+        "them. Everything is inserted in bulk, and added next to the existing data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000, help="Number of members")
+        parser.add_argument('--rooms', type=int, default=2, help="Number of rooms")
+        parser.add_argument('--categories', type=int, default=8, help="Number of categories besides coffee")
+        parser.add_argument('--products', type=int, default=100, help="Number of products")
+        parser.add_argument('--sales', type=int, default=100_000, help="Number of sales")
+        parser.add_argument('--years', type=int, default=3, help="Number of years the sales span")
+        parser.add_argument(
+            '--mobilepay-share',
+            type=float,
+            default=0.5,
+            help="Share of the payments that were made through MobilePay",
+        )
+        parser.add_argument(
+            '--unprocessed-mobilepayments',
+            type=int,
+            default=100,
+            help="Number of imported mobile payments that are still waiting to be processed",
+        )
+        parser.add_argument('--batch-size', type=int, default=10_000, help="Rows per INSERT")
+        parser.add_argument('--random-seed', type=int, help="Seed for the random generator, for reproducible data")
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['random_seed'])
+        self.batch_size = options['batch_size']
+        now = timezone.now()
+        self.first_day = timezone.localdate(now) - datetime.timedelta(days=365 * options['years'])
+        self.now = now
+
+        with transaction.atomic():
+            rooms = self.generate_rooms(options['rooms'])
+            products = self.generate_products(options['products'], options['categories'], rooms)
+            member_ids = self.generate_members(options['members'])
+
+            with keep_timestamps(Sale, Payment):
+                spent = self.generate_sales(options['sales'], member_ids, products, rooms)
+                self.generate_payments(spent, options['mobilepay_share'])
+            self.generate_unprocessed_mobilepayments(options['unprocessed_mobilepayments'], member_ids)
+            self.count_coffees_this_week(member_ids)
+            # Like the coffee counts, the rollup behind the sales reports isn't built by bulk inserted sales
+            DailySales.rebuild(self.first_day)
+
+        self.stdout.write(self.style.SUCCESS("Generated the dataset"))
+
+    def days(self):
+        return [
+            self.first_day + datetime.timedelta(days=i)
+            for i in range((timezone.localdate(self.now) - self.first_day).days + 1)
+        ]
+
+    def random_timestamp(self, days, day_weights):
+        day = self.random.choices(days, cum_weights=day_weights)[0]
+        hour = self.random.choices(range(24), cum_weights=HOUR_CUM_WEIGHTS)[0]
+        timestamp = timezone.make_aware(
+            datetime.datetime.combine(
+                day,
+                datetime.time(hour, self.random.randrange(60), self.random.randrange(60), self.random.randrange(10**6)),
+            )
+        )
+        return min(timestamp, self.now)
+
+    def generate_rooms(self, count):
+        # The sale api looks rooms up by a numeric name, so use the next free numbers
+        taken = set(Room.objects.values_list('name', flat=True))
+        names = []
+        number = 1
+        while len(names) < count:
+            if str(number) not in taken:
+                names.append(str(number))
+            number += 1
+        rooms = bulk_create_with_ids(Room, [Room(name=name, description="Synthetic room") for name in names])
+        self.stdout.write(f"Generated {len(rooms)} rooms")
+        return rooms
+
+    def generate_products(self, count, category_count, rooms):
+        coffee, _ = Category.objects.get_or_create(id=settings.COFFEE_CATEGORY_ID, defaults={'name': "Kaffe"})
+        categories = bulk_create_with_ids(
+            Category, [Category(name=f"Synthetic category {i}") for i in range(category_count)]
+        )
+
+        products = []
+        for i in range(count):
+            kind = self.random.choices(["beer", "coffee", "soda", "snack"], weights=[40, 10, 25, 25])[0]
+            product = Product(
+                name=f"Synthetic {kind} {i}",
+                price=self.random.randrange(300, 3000, 50),
+                active=self.random.random() < 0.8,
+                alcohol_content_ml=self.random.uniform(10, 30) if kind == "beer" else 0.0,
+                caffeine_content_mg=self.random.randint(50, 120) if kind == "coffee" else 0,
+            )
+            # Saving one at a time records the price history, like the admin does
+            product.save()
+            product.categories.add(coffee if kind == "coffee" else self.random.choice(categories or [coffee]))
+            if rooms and self.random.random() < 0.3:
+                product.rooms.add(*self.random.sample(rooms, self.random.randint(1, len(rooms))))
+            products.append(product)
+
+        self.stdout.write(f"Generated {len(products)} products in {len(categories) + 1} categories")
+        return products
+
+    def generate_members(self, count):
+        # Phone numbers have to be unique for quickbuy, so continue after the highest member id
+        first = (Member.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        member_ids = []
+        for offset in range(0, count, self.batch_size):
+            # Bulk create the members, so we don't send welcome mails
+            members = bulk_create_with_ids(
+                Member,
+                [
+                    Member(
+                        phone_number=f"syn{first + i}",
+                        full_name=f"Synthetic Member {first + i}",
+                        year=str(self.random.randint(self.first_day.year, self.now.year)),
+                        gender=self.random.choice("MFU"),
+                        email=f"syn{first + i}@example.com",
+                        want_spam=self.random.random() < 0.5,
+                    )
+                    for i in range(offset, min(offset + self.batch_size, count))
+                ],
+            )
+            member_ids += [member.id for member in members]
+
+        self.stdout.write(f"Generated {len(member_ids)} members")
+        return member_ids
+
+    def generate_sales(self, count, member_ids, products, rooms):
+        days = self.days()
+        day_weights = list(itertools.accumulate(WEEKDAY_WEIGHTS[day.weekday()] for day in days))
+
+        # A few members buy most of the beer, and a few products make up most of the sales
+        member_weights = [self.random.paretovariate(1.5) for _ in member_ids]
+        product_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(products))))
+
+        spent = Counter()
+        for offset in range(0, count, self.batch_size):
+            sales = []
+            for member_id in self.random.choices(
+                member_ids, weights=member_weights, k=min(self.batch_size, count - offset)
+            ):
+                product = self.random.choices(products, cum_weights=product_weights)[0]
+                sales.append(
+                    Sale(
+                        member_id=member_id,
+                        product=product,
+                        room=self.random.choice(rooms) if rooms else None,
+                        price=product.price,
+                        timestamp=self.random_timestamp(days, day_weights),
+                    )
+                )
+                spent[member_id] += product.price
+            # bulk_create skips the post_save signal, so derived state isn't built sale by sale
+            Sale.objects.bulk_create(sales)
+            self.stdout.write(f"Generated {offset + len(sales)} sales", ending="\r")
+
+        self.stdout.write("")
+        return spent
+
+    def generate_payments(self, spent, mobilepay_share):
+        """
+        Generates the deposits covering what every member has spent, plus a little, and sets the balances to match.
+        """
+        # Deposits are spread evenly over the days
+        days = self.days()
+        day_weights = list(range(1, len(days) + 1))
+
+        payments = []
+        balances = {}
+        for member_id, amount in spent.items():
+            deposited = 0
+            while deposited < amount:
+                deposit = self.random.randrange(5000, 50000, 500)
+                payments.append(
+                    Payment(member_id=member_id, amount=deposit, timestamp=self.random_timestamp(days, day_weights))
+                )
+                deposited += deposit
+            balances[member_id] = deposited - amount
+
+        mobilepayments = []
+        for offset in range(0, len(payments), self.batch_size):
+            # Payment.save updates the balance one payment at a time, so insert in bulk and set the balances below
+            for payment in bulk_create_with_ids(Payment, payments[offset : offset + self.batch_size]):
+                if self.random.random() < mobilepay_share:
+                    mobilepayments.append(
+                        MobilePayment(
+                            member_id=payment.member_id,
+                            payment=payment,
+                            customer_name=f"Synthetic Member {payment.member_id}",
+                            timestamp=payment.timestamp,
+                            amount=payment.amount,
+                            transaction_id=f"syn{payment.id}",
+                            comment=f"syn{payment.member_id}",
+                            status=MobilePayment.APPROVED,
+                        )
+                    )
+        MobilePayment.objects.bulk_create(mobilepayments, batch_size=self.batch_size)
+
+        members = [Member(id=member_id, balance=balance) for member_id, balance in balances.items()]
+        Member.objects.bulk_update(members, ['balance'], batch_size=self.batch_size)
+
+        self.stdout.write(f"Generated {len(payments)} payments, {len(mobilepayments)} through MobilePay")
+
+    def generate_unprocessed_mobilepayments(self, count, member_ids):
+        mobilepayments = []
+        for i in range(count):
+            # Some comments don't match a member, those are left for the treasurer
+            member_id = self.random.choice(member_ids) if member_ids and self.random.random() < 0.8 else None
+            mobilepayments.append(
+                MobilePayment(
+                    member_id=member_id,
+                    customer_name="Synthetic Customer",
+                    timestamp=self.now - datetime.timedelta(minutes=self.random.randrange(60 * 24 * 7)),
+                    amount=self.random.randrange(5000, 50000, 500),
+                    transaction_id=f"synunset{self.now.timestamp():.0f}{i}",
+                    comment=f"syn{member_id}" if member_id else "Tak for øl",
+                    status=MobilePayment.UNSET,
+                )
+            )
+        MobilePayment.objects.bulk_create(mobilepayments, batch_size=self.batch_size)
+        self.stdout.write(f"Generated {len(mobilepayments)} unprocessed mobile payments")
+
+    def count_coffees_this_week(self, member_ids):
+        # The physiology state is built lazily, but the coffee leaderboard has to be counted up front
+        week_start = WeeklyCoffeeCount.week_start_of(self.now)
+        week_begin = timezone.make_aware(datetime.datetime.combine(week_start, datetime.time()))
+        counts = (
+            Sale.objects.filter(
+                member_id__gte=min(member_ids, default=0),
+                timestamp__gte=week_begin,
+                product__categories=settings.COFFEE_CATEGORY_ID,
+            )
+            .values('member')
+            .annotate(count=Count('id'))
+        )
+        WeeklyCoffeeCount.objects.bulk_create(
+            [WeeklyCoffeeCount(week_start=week_start, member_id=c['member'], count=c['count']) for c in counts],
+            batch_size=self.batch_size,
+        )
+        cache.delete(WeeklyCoffeeCount.LEADER_CACHE_KEY.format(week_start))
@@ -1,14 +1,15 @@
 from datetime import timedelta, date
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils.dateparse import parse_datetime
 
 from requests import HTTPError
 
-from stregsystem.models import MobilePayment
+from stregsystem.models import ImportedLedgerDate, MobilePayment
 import logging
 
-from stregsystem.utils import mobile_payment_exact_match_member, strip_emoji
+from stregsystem.utils import active_member_index, match_member_in_index, strip_emoji
 
 from stregsystem.vipps_api import AccountingAPI
 
@@ -19,6 +20,9 @@ class Command(BaseCommand):
     # Cutoff for when this iteration of the Mobilepay-API (Vipps) is deployed
     manual_cutoff_date = date(2024, 4, 9)
 
+    # Days before the ledger of a date is considered complete, late payments may still show up until then
+    ledger_settle_days = 2
+
     logger = logging.getLogger(__name__)
     days_back = None
 
@@ -28,48 +32,106 @@ class Command(BaseCommand):
             nargs='?',
             type=int,
             default=7,
-            help="Days back from today to look for MobilePay transactions (max 31 days)",
+            help="Days back from today to look for MobilePay transactions (max 31 days, 0 only reads the feed)",
         )
 
     def handle(self, *args, **options):
         self.days_back = options['days_back'] if options['days_back'] <= 31 else 7
         self.import_mobilepay_payments()
 
-    def fetch_transactions(self) -> list:
-        # Do a client side check if token is good. If not - fetch another token.
-        try:
-            assert self.days_back is not None
-
-            transactions = []
-
-            transactions.extend(AccountingAPI.get_transactions_latest_feed())
+    def fetch_historic_transactions(self):
+        """
+        Fetches the transactions of the last days_back days that haven't been imported completely yet.
+        Returns the transactions and the dates that are complete, and won't change anymore.
+        """
+        assert self.days_back is not None
 
-            for i in range(self.days_back):
-                past_date = date.today() - timedelta(days=i)
-                if past_date < self.manual_cutoff_date:
-                    break
+        transactions = []
+        complete_dates = []
+        try:
+            today = date.today()
+            past_dates = [today - timedelta(days=i) for i in range(self.days_back)]
+            past_dates = [past_date for past_date in past_dates if past_date >= self.manual_cutoff_date]
+            imported_dates = set(
+                ImportedLedgerDate.objects.filter(ledger_date__in=past_dates).values_list('ledger_date', flat=True)
+            )
+
+            historic = AccountingAPI.get_transactions_historic_many(
+                past_date for past_date in past_dates if past_date not in imported_dates
+            )
+            settled = today - timedelta(days=self.ledger_settle_days)
+            for past_date, past_transactions in historic.items():
+                transactions.extend(past_transactions)
+                # The ledgers of today and of the last few days may still change
+                if past_date < settled:
+                    complete_dates.append(past_date)
+        except HTTPError as e:
+            self.logger.error(f"Got an HTTP error when trying to fetch transactions: {e.response}")
+        except Exception as e:
+            self.logger.error(f'Got an error when trying to fetch transactions: {e}')
+        return transactions, complete_dates
 
-                transactions.extend(AccountingAPI.get_transactions_historic(past_date))
+    def import_mobilepay_payments(self):
+        members = active_member_index()
+        imported = 0
 
-            return transactions
+        try:
+            # Every page is committed before the feed moves its cursor past it
+            for transactions in AccountingAPI.iter_transactions_feed():
+                imported += self.import_transactions(transactions, members)
         except HTTPError as e:
             self.logger.error(f"Got an HTTP error when trying to fetch transactions: {e.response}")
         except Exception as e:
             self.logger.error(f'Got an error when trying to fetch transactions: {e}')
 
-    def import_mobilepay_payments(self):
-        transactions = self.fetch_transactions()
-        if len(transactions) == 0:
+        transactions, complete_dates = self.fetch_historic_transactions()
+        imported += self.import_transactions(transactions, members, complete_dates)
+
+        if imported == 0:
             self.logger.info(f'Ran, but no transactions found')
             return
-
-        for transaction in transactions:
-            self.import_mobilepay_payment(transaction)
-
         self.logger.info('Successfully ran MobilePayment API import')
 
-    def import_mobilepay_payment(self, transaction):
+    def import_transactions(self, transactions, members, complete_dates=()):
         """
+        Imports the transactions that haven't been imported yet, and marks the complete dates as imported.
+        Returns the number of imported transactions.
+        """
+        # The feed and the historic days overlap, and some transactions may have been imported already
+        trans_ids = {mobilepay_transaction['pspReference'] for mobilepay_transaction in transactions}
+        seen = set(MobilePayment.objects.filter(transaction_id__in=trans_ids).values_list('transaction_id', flat=True))
+
+        mobile_payments = []
+        for mobilepay_transaction in transactions:
+            mobile_payment = self.mobile_payment_from_transaction(mobilepay_transaction, members)
+            if mobile_payment is None:
+                continue
+            if mobile_payment.transaction_id in seen:
+                self.logger.debug(
+                    f'Skipping transaction since it already exists (PSP-Reference: {mobile_payment.transaction_id})'
+                )
+                continue
+            seen.add(mobile_payment.transaction_id)
+            mobile_payments.append(mobile_payment)
+
+        if mobile_payments or complete_dates:
+            with transaction.atomic():
+                # A concurrent import may have imported some of them in the meantime
+                MobilePayment.objects.bulk_create(mobile_payments, ignore_conflicts=True)
+                ImportedLedgerDate.objects.bulk_create(
+                    [ImportedLedgerDate(ledger_date=complete_date) for complete_date in complete_dates],
+                    ignore_conflicts=True,
+                )
+
+        for mobile_payment in mobile_payments:
+            self.logger.info(
+                f'Imported transaction id: {mobile_payment.transaction_id} for amount: {mobile_payment.amount}'
+            )
+        return len(mobile_payments)
+
+    def mobile_payment_from_transaction(self, mobilepay_transaction, members):
+        """
+        Returns the MobilePayment of a transaction, or None if it isn't a payment to import.
         Example of a transaction:
         {
             "pspReference": "32212390715",
@@ -86,42 +148,35 @@ class Command(BaseCommand):
             "maskedPhoneNo": "xxxx 1234",
             "message": "Topper"
         }
-        :param transaction:
+        :param mobilepay_transaction:
+        :param members: Index of the active members, see active_member_index
         :return:
         """
-        if transaction['entryType'] != 'capture':
-            return
+        if mobilepay_transaction['entryType'] != 'capture':
+            return None
 
-        payment_datetime = parse_datetime(transaction['time'])
+        payment_datetime = parse_datetime(mobilepay_transaction['time'])
 
         if payment_datetime.date() < self.manual_cutoff_date:
             self.logger.debug(f'Skipping transaction because it is before payment cutoff date {payment_datetime}')
-            return
-
-        trans_id = transaction['pspReference']
+            return None
 
-        if MobilePayment.objects.filter(transaction_id=trans_id).exists():
-            self.logger.debug(f'Skipping transaction since it already exists (PSP-Reference: {trans_id})')
-            return
+        trans_id = mobilepay_transaction['pspReference']
 
-        currency_code = transaction['currency']
+        currency_code = mobilepay_transaction['currency']
         if currency_code != 'DKK':
             self.logger.warning(f'Does ONLY support DKK (Transaction ID: {trans_id}), was {currency_code}')
-            return
-
-        amount = transaction['amount']
+            return None
 
-        comment = strip_emoji(transaction['message'])
-        name = transaction['name']  # Danish legal name, no reason to sanitize.
+        comment = strip_emoji(mobilepay_transaction['message'])
+        name = mobilepay_transaction['name']  # Danish legal name, no reason to sanitize.
 
-        MobilePayment.objects.create(
-            amount=amount,  # already in streg-ører
-            member=mobile_payment_exact_match_member(comment),
+        return MobilePayment(
+            amount=mobilepay_transaction['amount'],  # already in streg-ører
+            member_id=match_member_in_index(members, comment),
             comment=comment,
             customer_name=name,
             timestamp=payment_datetime,
             transaction_id=trans_id,
             status=MobilePayment.UNSET,
         )
-
-        self.logger.info(f'Imported transaction id: {trans_id} for amount: {amount}')
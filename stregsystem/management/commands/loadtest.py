@@ -0,0 +1,165 @@
+import random
+import statistics
+import time
+from collections import defaultdict
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from stregsystem.models import Member, Product, Room
+
+ENDPOINTS = ("quickbuy", "menu_sale", "api_sale")
+
+
+class RollbackLoadTest(Exception):
+    pass
+
+
+def percentile(quantiles, p):
+    return quantiles[p - 1] if quantiles else float('nan')
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays quickbuy, menu_sale and api_sale traffic, and reports latency percentiles and queries per request "
+        "for each endpoint. By default the requests go through the Django test client against the configured "
+        "database, and all purchases are rolled back afterwards. With --url they're sent to a running server instead, "
+        "where the purchases are real and query counts aren't available."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=300, help="Number of requests to send")
+        parser.add_argument(
+            '--endpoints',
+            nargs='+',
+            choices=ENDPOINTS,
+            default=list(ENDPOINTS),
+            help="Endpoints to send traffic to, picked at random for every request",
+        )
+        parser.add_argument('--room', help="Name of the room to buy in, defaults to the first numbered room")
+        parser.add_argument('--members', type=int, default=100, help="Number of members to buy as")
+        parser.add_argument('--url', help="Base url of a running stregsystem, e.g. http://localhost:8000")
+        parser.add_argument('--random-seed', type=int, help="Seed for the random generator, for reproducible traffic")
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['random_seed'])
+        room = self.find_room(options['room'])
+        members = list(Member.objects.filter(active=True, balance__gte=10_000).order_by('?')[: options['members']])
+        products = Product.active_product_list(room.id)
+        if not members or not products:
+            raise CommandError("Room {} needs active products and members with money, see generatedata".format(room))
+
+        endpoints = options['endpoints']
+        if "api_sale" in endpoints and not room.name.isdigit():
+            self.stderr.write("The sale api only knows rooms with numeric names, skipping api_sale")
+            endpoints = [endpoint for endpoint in endpoints if endpoint != "api_sale"]
+        traffic = [
+            self.request(self.random.choice(endpoints), room, members, products) for _ in range(options['requests'])
+        ]
+
+        if options['url']:
+            results = self.run_live(options['url'], room, traffic)
+        else:
+            results = self.run_in_process(traffic)
+        self.report(results)
+
+    @staticmethod
+    def find_room(name):
+        rooms = Room.objects.order_by('id')
+        try:
+            if name is not None:
+                return rooms.get(name__iexact=name)
+            return next(room for room in rooms if room.name.isdigit())
+        except (Room.DoesNotExist, StopIteration):
+            raise CommandError("No room to buy in, see generatedata")
+
+    def request(self, endpoint, room, members, products):
+        """
+        Returns the endpoint, path and arguments of a random purchase.
+        """
+        member = self.random.choice(members)
+        bought = self.random.sample(products, min(len(products), self.random.randint(1, 3)))
+        buy_string = " ".join(
+            [member.phone_number] + [f"{product.id}:{self.random.randint(1, 3)}" for product in bought]
+        )
+
+        if endpoint == "quickbuy":
+            return endpoint, reverse('quickbuy', args=(room.name,)), {'data': {'quickbuy': buy_string}}
+        elif endpoint == "menu_sale":
+            return endpoint, reverse('menu', args=(room.name, member.id)), {'data': {'product_id': bought[0].id}}
+        else:
+            return (
+                endpoint,
+                reverse('sale'),
+                {'json': {'buystring': buy_string, 'room': room.name, 'member_id': member.id}},
+            )
+
+    def run_in_process(self, traffic):
+        results = defaultdict(list)
+        client = Client()
+        try:
+            # The test client doesn't come from an allowed host. Run like production, without DEBUG, which also
+            # keeps the debug toolbar from rendering itself into (and breaking) every response of a development setup.
+            with (
+                override_settings(DEBUG=False, ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']),
+                transaction.atomic(),
+            ):
+                for endpoint, path, arguments in traffic:
+                    with CaptureQueriesContext(connection) as context:
+                        start = time.perf_counter()
+                        if 'json' in arguments:
+                            response = client.post(path, arguments['json'], content_type="application/json")
+                        else:
+                            response = client.post(path, arguments['data'])
+                        elapsed = (time.perf_counter() - start) * 1000
+                    results[endpoint].append((elapsed, len(context.captured_queries), response.status_code))
+                raise RollbackLoadTest
+        except RollbackLoadTest:
+            pass
+        return results
+
+    def run_live(self, url, room, traffic):
+        results = defaultdict(list)
+        session = requests.Session()
+        # Get a CSRF token for the forms, the sale api is exempt
+        session.get(url + reverse('menu_index', args=(room.name,))).raise_for_status()
+        csrf_token = session.cookies.get('csrftoken')
+
+        for endpoint, path, arguments in traffic:
+            start = time.perf_counter()
+            if 'json' in arguments:
+                response = session.post(url + path, json=arguments['json'])
+            else:
+                response = session.post(
+                    url + path,
+                    data={**arguments['data'], 'csrfmiddlewaretoken': csrf_token},
+                    headers={'Referer': url + path},
+                )
+            elapsed = (time.perf_counter() - start) * 1000
+            results[endpoint].append((elapsed, None, response.status_code))
+        return results
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'endpoint':>10} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+            f"{'queries':>8} {'refused':>7} {'errors':>6}"
+        )
+        for endpoint in ENDPOINTS:
+            if endpoint not in results:
+                continue
+            timings = [elapsed for elapsed, _, _ in results[endpoint]]
+            queries = [count for _, count, _ in results[endpoint] if count is not None]
+            # Members running out of money during the run get a stregforbud (402), which isn't an error
+            refused = sum(1 for _, _, status in results[endpoint] if status == 402)
+            errors = sum(1 for _, _, status in results[endpoint] if status >= 400 and status != 402)
+            quantiles = statistics.quantiles(timings, n=100, method='inclusive') if len(timings) > 1 else timings * 99
+            mean_queries = f"{statistics.mean(queries):.1f}" if queries else "-"
+            self.stdout.write(
+                f"{endpoint:>10} {len(timings):>8} {percentile(quantiles, 50):>8.2f} {percentile(quantiles, 95):>8.2f} "
+                f"{percentile(quantiles, 99):>8.2f} {max(timings):>8.2f} {mean_queries:>8} {refused:>7} {errors:>6}"
+            )
@@ -0,0 +1,24 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from stregsystem.models import DailySales
+
+
+def date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the daily sales rollup behind the sales reports from the sales, "
+        "for backfilling sales that were inserted in bulk or repairing drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from-date', type=date, help="First day to recount, as YYYY-MM-DD, defaults to the first")
+        parser.add_argument('--to-date', type=date, help="Last day to recount, as YYYY-MM-DD, defaults to the last")
+
+    def handle(self, *args, **options):
+        created = DailySales.rebuild(options['from_date'], options['to_date'])
+        self.stdout.write(self.style.SUCCESS(f"Counted {created} days of product sales"))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from stregsystem.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the bought counter of limited products from their sales, "
+        "repairing drift from sales that were deleted without being refunded."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report the counters that are off",
+        )
+
+    def handle(self, *args, **options):
+        repaired = 0
+        for product in Product.objects.filter(start_date__isnull=False).order_by('id'):
+            with transaction.atomic():
+                # Lock the product, so no sale changes the counter while we count
+                product = Product.objects.select_for_update().get(id=product.id)
+                bought = product.count_bought()
+                if bought == product.bought:
+                    continue
+
+                self.stdout.write(f"{product.id} {product.name}: counter is {product.bought}, sales are {bought}")
+                repaired += 1
+                if not options['dry_run']:
+                    product.recount_bought()
+
+        if options['dry_run']:
+            self.stdout.write(f"{repaired} counters are off")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Repaired {repaired} counters"))
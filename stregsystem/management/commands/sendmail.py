@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from stregsystem.mail import send_queued_mails
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends the queued mails in batches over a single SMTP connection per batch, "
+        "retrying failed mails with backoff. Run it from cron, or with --loop as a service."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Mails sent per SMTP connection")
+        parser.add_argument(
+            '--max-attempts', type=int, default=8, help="Attempts before a mail is given up and left in the queue"
+        )
+        parser.add_argument('--loop', action='store_true', help="Keep polling the queue instead of exiting when empty")
+        parser.add_argument('--interval', type=float, default=5, help="Seconds between polls of an empty queue")
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = send_queued_mails(options['batch_size'], options['max_attempts'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} mails, {failed} failed")
+                # A full batch means there is probably more waiting
+                if sent + failed == options['batch_size']:
+                    continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Sent {total_sent} mails, {total_failed} failed"))
@@ -1,5 +1,14 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
 from django import http
+from django.conf import settings
 from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection
+
+logger = logging.getLogger(__name__)
 
 
 class CorsMiddleware:
@@ -40,3 +49,117 @@ class CorsMiddleware:
         res['access-control-max-age'] = '86400'
 
         return res
+
+
+class QueryStats:
+    """
+    Counts the queries of a request and the time spent in the database, as a connection execute wrapper.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.count += 1
+
+
+class ViewStats:
+    """
+    The timings and query counts of the latest requests to a view.
+    """
+
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.requests = 0
+        self.over_budget = 0
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def add(self, wall_ms, db_ms, queries, over_budget):
+        self.requests += 1
+        self.over_budget += over_budget
+        self.samples.append((wall_ms, db_ms, queries))
+
+    def summary(self):
+        wall_ms, db_ms, queries = zip(*self.samples)
+        return {
+            'requests': self.requests,
+            'over_budget': self.over_budget,
+            'wall_ms': ViewStats.distribution(wall_ms),
+            'db_ms': ViewStats.distribution(db_ms),
+            'queries': ViewStats.distribution(queries),
+        }
+
+    @staticmethod
+    def distribution(values):
+        values = sorted(values)
+
+        def percentile(p):
+            return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+        return {'p50': percentile(50), 'p95': percentile(95), 'p99': percentile(99), 'max': values[-1]}
+
+
+class InstrumentationMiddleware:
+    """
+    Records the wall time, database time and query count of every request per view, keeping the latest requests of
+    each view in process, and logs a warning when a view goes over its budget in settings.VIEW_QUERY_BUDGETS.
+
+    Streaming responses, like the CSV exports, run their queries while the response is sent, so they're measured
+    until the content has been streamed.
+    """
+
+    stats = defaultdict(ViewStats)
+    lock = threading.Lock()
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, req):
+        query_stats = QueryStats()
+        start = time.perf_counter()
+        with connection.execute_wrapper(query_stats):
+            res = self.get_response(req)
+
+        if res.streaming:
+            res.streaming_content = InstrumentationMiddleware.measure_stream(
+                req, res.streaming_content, query_stats, start
+            )
+        else:
+            InstrumentationMiddleware.record(req, query_stats, start)
+
+        return res
+
+    @staticmethod
+    def measure_stream(req, content, query_stats, start):
+        try:
+            with connection.execute_wrapper(query_stats):
+                yield from content
+        finally:
+            InstrumentationMiddleware.record(req, query_stats, start)
+
+    @staticmethod
+    def record(req, query_stats, start):
+        wall_ms = (time.perf_counter() - start) * 1000
+
+        view = req.resolver_match.view_name if req.resolver_match is not None else "unresolved"
+        budget = settings.VIEW_QUERY_BUDGETS.get(view)
+        over_budget = budget is not None and query_stats.count > budget
+        if over_budget:
+            logger.warning(
+                "%s used %d queries, more than its budget of %d (%s)", view, query_stats.count, budget, req.path
+            )
+
+        with InstrumentationMiddleware.lock:
+            InstrumentationMiddleware.stats[view].add(wall_ms, query_stats.time * 1000, query_stats.count, over_budget)
+
+    @staticmethod
+    def summary():
+        with InstrumentationMiddleware.lock:
+            return {view: stats.summary() for view, stats in InstrumentationMiddleware.stats.items()}
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MemberPhysiology",
+            fields=[
+                (
+                    "member",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="stregsystem.member",
+                    ),
+                ),
+                ("timestamp", models.DateTimeField()),
+                ("bac", models.FloatField(default=0.0)),
+                ("caffeine_mg", models.FloatField(default=0.0)),
+                ("alcohol_since", models.DateTimeField(blank=True, null=True)),
+                ("caffeine_since", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
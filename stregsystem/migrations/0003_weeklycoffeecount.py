@@ -0,0 +1,63 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:15
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def count_coffees_this_week(apps, schema_editor):
+    Sale = apps.get_model("stregsystem", "Sale")
+    WeeklyCoffeeCount = apps.get_model("stregsystem", "WeeklyCoffeeCount")
+
+    today = timezone.localdate()
+    week_start = today - datetime.timedelta(days=today.weekday())
+    week_begin = timezone.make_aware(datetime.datetime.combine(week_start, datetime.time()))
+    counts = (
+        Sale.objects.filter(timestamp__gte=week_begin, product__categories=settings.COFFEE_CATEGORY_ID)
+        .values("member")
+        .annotate(count=Count("id"))
+    )
+    WeeklyCoffeeCount.objects.bulk_create(
+        [WeeklyCoffeeCount(week_start=week_start, member_id=c["member"], count=c["count"]) for c in counts]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0002_memberphysiology"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WeeklyCoffeeCount",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("week_start", models.DateField()),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "member",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.member",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("week_start", "member")},
+            },
+        ),
+        migrations.RunPython(count_coffees_this_week, migrations.RunPython.noop),
+    ]
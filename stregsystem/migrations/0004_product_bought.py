@@ -0,0 +1,32 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:21
+
+from django.db import migrations, models
+
+from stregsystem.utils import date_to_midnight
+
+
+def count_bought(apps, schema_editor):
+    Product = apps.get_model("stregsystem", "Product")
+    Sale = apps.get_model("stregsystem", "Sale")
+
+    for product in Product.objects.filter(start_date__isnull=False):
+        product.bought = Sale.objects.filter(
+            product=product, timestamp__gt=date_to_midnight(product.start_date)
+        ).count()
+        product.save(update_fields=["bought"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0003_weeklycoffeecount"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="bought",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_bought, migrations.RunPython.noop),
+    ]
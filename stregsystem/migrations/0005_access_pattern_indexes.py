@@ -0,0 +1,36 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0004_product_bought"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="member",
+            name="phone_number",
+            field=models.CharField(db_index=True, max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name="mobilepayment",
+            index=models.Index(
+                fields=["status", "payment"], name="stregsystem_status_ae64e4_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["member", "timestamp"], name="stregsystem_member__f9f6f4_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["timestamp"], name="stregsystem_timesta_3c3fba_idx"
+            ),
+        ),
+    ]
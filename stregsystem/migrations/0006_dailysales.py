@@ -0,0 +1,79 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:32
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def count_daily_sales(apps, schema_editor):
+    DailySales = apps.get_model("stregsystem", "DailySales")
+    Sale = apps.get_model("stregsystem", "Sale")
+
+    totals = (
+        Sale.objects.annotate(day=TruncDate("timestamp", tzinfo=timezone.get_current_timezone()))
+        .values("day", "product_id", "room_id")
+        .annotate(count=models.Count("id"), revenue=models.Sum("price"))
+        .order_by()
+    )
+    DailySales.objects.bulk_create((DailySales(**total) for total in totals.iterator()), batch_size=10000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0005_access_pattern_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailySales",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("count", models.IntegerField(default=0)),
+                ("revenue", models.IntegerField(default=0)),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.product",
+                    ),
+                ),
+                (
+                    "room",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="stregsystem.room",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Daily sales",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="dailysales",
+            constraint=models.UniqueConstraint(
+                fields=("day", "product", "room"), name="unique_daily_sales"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="dailysales",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("room", None)),
+                fields=("day", "product"),
+                name="unique_daily_sales_without_room",
+            ),
+        ),
+        migrations.RunPython(count_daily_sales, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:36
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0006_dailysales"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutgoingMail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sender", models.CharField(max_length=254)),
+                ("recipient", models.CharField(max_length=254)),
+                ("subject", models.CharField(blank=True, max_length=200, null=True)),
+                ("message", models.TextField()),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "next_attempt",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                ("attempts", models.IntegerField(default=0)),
+                ("last_error", models.TextField(blank=True)),
+                ("sent", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="outgoingmail",
+            index=models.Index(
+                fields=["sent", "next_attempt"], name="stregsystem_sent_404dd3_idx"
+            ),
+        ),
+    ]
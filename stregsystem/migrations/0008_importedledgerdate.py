@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-17 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stregsystem", "0007_outgoingmail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportedLedgerDate",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("ledger_date", models.DateField(unique=True)),
+                ("imported", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
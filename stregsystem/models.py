@@ -1,21 +1,39 @@
 import datetime
-from collections import Counter
+import math
+import threading
+import time
+from collections import Counter, defaultdict
 from email.utils import parseaddr
 
-from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
+from django.contrib.admin.models import LogEntry, ADDITION, CHANGE, DELETION
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core import signing
+from django.core.cache import cache
 from django.core.validators import RegexValidator
-from django.db import models, transaction
-from django.db.models import Count
+from django.conf import settings
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import DEFERRED, F
+from django.db.models.functions import RowNumber, TruncDate
 from django.utils import timezone
 
-from stregsystem.caffeine import Intake, CAFFEINE_TIME_INTERVAL, current_caffeine_in_body_compound_interest
-from stregsystem.mail import send_payment_mail
+from stregsystem import ledger
+from stregsystem.booze import Gender, alcohol_bac_decay, alcohol_bac_increase, alcohol_bac_timeline
+from stregsystem.caffeine import (
+    Intake,
+    CAFFEINE_TIME_INTERVAL,
+    caffeine_decay,
+    current_caffeine_in_body_compound_interest,
+)
+from stregsystem.mail import queue_mails_in_bulk, send_payment_mail
+from stregsystem.signals import sales_refunded
 from stregsystem.templatetags.stregsystem_extras import money
 from stregsystem.utils import (
+    bulk_create_with_ids,
     date_to_midnight,
+    make_active_productlist_query,
     make_processed_mobilepayment_query,
+    make_room_specific_query,
     make_unprocessed_member_filled_mobilepayment_query,
     MobilePaytoolException,
 )
@@ -97,6 +115,8 @@ class Order(object):
         self.room = room
         self.created_on = timezone.now()
         self.items = items or set()  # Set to none because we don't persist
+        self.sales = []  # The sales created when executing the order
+        self.physiology = None  # The physiology state of the member, if the order changed it
 
     @classmethod
     def from_products(cls, member, room, products):
@@ -117,26 +137,33 @@ class Order(object):
     def execute(self):
         transaction = PayTransaction(amount=self.total())
 
-        # Check if we have enough inventory to fulfill the order
+        # Reserve the inventory of limited products, which fails if there isn't enough to fulfill the order
         for item in self.items:
-            if item.product.start_date is not None and (item.product.bought + item.count > item.product.quantity):
+            if not item.product.reserve_stock(item.count):
                 raise NoMoreInventoryError()
 
-        # Take update lock on member row
-        self.member = Member.objects.select_for_update().get(id=self.member.id)
+        # Check the balance we know of, then charge the balance in the database,
+        # which fails if a concurrent purchase got there first. No row lock is
+        # taken, so terminals buying for the same member don't queue up.
         self.member.fulfill(transaction)
+        if not ledger.change_balance(self.member, transaction.change(), allow_overdraft=False):
+            raise StregForbudError
 
-        for item in self.items:
-            # @HACK Since we want to use the old database layout, we need to
-            # add a sale for every item and every instance of that item
-            for i in range(item.count):
-                s = Sale(member=self.member, product=item.product, room=self.room, price=item.product.price)
-                s.save()
+        # @HACK Since we want to use the old database layout, we need to
+        # add a sale for every item and every instance of that item. They are
+        # all written in a single INSERT where the database returns their ids.
+        # It never updates existing rows, so the no-update rule of Sale.save
+        # still holds.
+        self.sales = bulk_create_with_ids(
+            Sale,
+            [
+                Sale(member=self.member, product=item.product, room=self.room, price=item.product.price)
+                for item in self.items
+                for _ in range(item.count)
+            ],
+        )
 
-            # Bought (used above) is automatically calculated, so we don't need
-            # to update it
-        # We changed the user balance, so save that
-        self.member.save()
+        self.physiology = record_sales(self.member, self.sales)
 
 
 class GetTransaction(MoneyTransaction):
@@ -160,7 +187,7 @@ class Member(models.Model):  # id automatisk...
         ('F', 'Female'),
     )
     active = models.BooleanField(default=True)
-    phone_number = models.CharField(max_length=20)
+    phone_number = models.CharField(max_length=20, db_index=True)
     year = models.CharField(max_length=4, default=get_current_year)  # Put the current year as default
     full_name = models.CharField(max_length=100)  # for 'firstname'
     gender = models.CharField(max_length=1, choices=GENDER_CHOICES)
@@ -190,6 +217,7 @@ class Member(models.Model):  # id automatisk...
     def make_payment(self, amount):
         """
         Should only be called by the Payment and MobilePayment class.
+        Only changes this instance, the balance in the database is changed through stregsystem.ledger.
 
         >>> jokke = Member.objects.create(phone_number="jokke", full_name="Joakim Byg", email="treo@cs.aau.dk", year=2007)
         >>> jokke.balance
@@ -226,27 +254,26 @@ class Member(models.Model):  # id automatisk...
     def has_stregforbud(self, buy=0):
         return self.balance - buy < 0
 
-    # BAC in this method stands for "Blood alcohol content"
-    def calculate_alcohol_promille(self):
-        from stregsystem.booze import alcohol_bac_timeline, Gender
-        from datetime import timedelta
-
-        now = timezone.now()
-        # Lets assume noone is drinking 12 hours straight
-        calculation_start = now - timedelta(hours=12)
-
-        alcohol_sales = self.sale_set.filter(
-            timestamp__gt=calculation_start, product__alcohol_content_ml__gt=0.0
-        ).order_by('timestamp')
-        alcohol_timeline = [(s.timestamp, s.product.alcohol_content_ml) for s in alcohol_sales]
-
-        gender = Gender.UNKNOWN
+    def booze_gender(self):
         if self.gender == "M":
-            gender = Gender.MALE
+            return Gender.MALE
         elif self.gender == "F":
-            gender = Gender.FEMALE
+            return Gender.FEMALE
+        return Gender.UNKNOWN
+
+    def physiology(self):
+        """
+        Returns the physiology state of the member. If there is no state yet, or it isn't exact anymore, it's computed
+        from their recent sales instead, without saving it; the state is only saved when sales are recorded.
+        """
+        state = MemberPhysiology.objects.filter(member=self).first()
+        if state is None or not state.is_exact_at(timezone.now()):
+            state = MemberPhysiology.compute(self)
+        return state
 
-        bac = alcohol_bac_timeline(gender, 80, now, alcohol_timeline)
+    # BAC in this method stands for "Blood alcohol content"
+    def calculate_alcohol_promille(self, physiology=None):
+        bac = (physiology or self.physiology()).bac_at(timezone.now())
 
         # Tihi:
         drunken_bastards = {
@@ -260,34 +287,316 @@ class Member(models.Model):  # id automatisk...
 
         return bac
 
-    def calculate_caffeine_in_body(self) -> float:
-        # get list of last 24h caffeine intakes and calculate current body caffeine content
-        return current_caffeine_in_body_compound_interest(
-            [
-                Intake(x.timestamp, x.product.caffeine_content_mg)
-                for x in self.sale_set.filter(
-                    timestamp__gt=timezone.now() - CAFFEINE_TIME_INTERVAL, product__caffeine_content_mg__gt=0
-                ).order_by('timestamp')
-            ]
-        )
+    def calculate_caffeine_in_body(self, physiology=None) -> float:
+        return (physiology or self.physiology()).caffeine_at(timezone.now())
 
     def is_leading_coffee_addict(self):
-        coffee_category = [6]
+        return WeeklyCoffeeCount.leader(timezone.now()) == self.id
+
+    def category_ranks(self, from_time, to_time):
+        """
+        Returns {category id: (rank, population, count)} for every category bought from in the period, where rank is
+        the place of the member among the population of members who bought from the category, ordered by the number
+        of products bought and then phone number, and count is the number of products the member bought.
+        Rank and count are 0 if the member didn't buy from the category.
+        """
+        counts = (
+            Sale.objects.filter(timestamp__gt=from_time, timestamp__lte=to_time, product__categories__isnull=False)
+            .values('member', 'member__phone_number', category=F('product__categories'))
+            .annotate(count=models.Count('id'))
+            .order_by()
+        )
+        if not connection.features.supports_over_clause:
+            return self._category_ranks_from_counts(counts)
+
+        ranked = counts.annotate(
+            rank=models.Window(
+                RowNumber(),
+                partition_by=F('category'),
+                order_by=[F('count').desc(), F('member__phone_number').asc()],
+            ),
+            population=models.Window(models.Count('member'), partition_by=F('category')),
+        )
+        # Filtering on a window function needs an outer query, which the ORM can't express
+        sql, params = ranked.query.sql_with_params()
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {qn('category')}, "
+                f"MAX(CASE WHEN {qn('member_id')} = %s THEN {qn('rank')} ELSE 0 END), "
+                f"MAX({qn('population')}), "
+                f"MAX(CASE WHEN {qn('member_id')} = %s THEN {qn('count')} ELSE 0 END) "
+                f"FROM ({sql}) {qn('ranked')} GROUP BY {qn('category')}",
+                (self.id, self.id) + params,
+            )
+            return {category: (rank, population, count) for category, rank, population, count in cursor.fetchall()}
+
+    def _category_ranks_from_counts(self, counts):
+        by_category = defaultdict(list)
+        for row in counts:
+            by_category[row['category']].append((-row['count'], row['member__phone_number'], row['member']))
+        ranks = {}
+        for category, rows in by_category.items():
+            rows.sort()
+            ranks[category] = next(
+                ((rank, len(rows), -count) for rank, (count, _, member) in enumerate(rows, 1) if member == self.id),
+                (0, len(rows), 0),
+            )
+        return ranks
+
+
+class MemberPhysiology(models.Model):
+    """
+    The blood alcohol content and caffeine content of a member as of the timestamp.
+
+    Both degrade in closed form, so instead of replaying the sales of the last hours every time we need them, the
+    state is updated incrementally whenever the member buys something containing alcohol or caffeine, and degraded
+    to the current time when read. Like the replay, it only counts the sales of the last 12 (alcohol) and 24
+    (caffeine) hours, so once the oldest sale in the state is older than that, the sales are replayed instead.
+    """
 
+    # Lets assume noone is drinking 12 hours straight
+    ALCOHOL_TIME_INTERVAL = datetime.timedelta(hours=12)
+    # Assumed weight in kg of every member
+    WEIGHT = 80
+
+    member = models.OneToOneField(Member, on_delete=models.CASCADE, primary_key=True)
+    timestamp = models.DateTimeField()
+    bac = models.FloatField(default=0.0)
+    caffeine_mg = models.FloatField(default=0.0)
+    # The time of the oldest sale counted in bac and caffeine_mg, None if there is none
+    alcohol_since = models.DateTimeField(null=True, blank=True)
+    caffeine_since = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.member.phone_number}: {self.bac:.2f} promille, {self.caffeine_mg:.0f} mg caffeine"
+
+    def bac_at(self, time):
+        if time - self.timestamp > self.ALCOHOL_TIME_INTERVAL:
+            return 0.0
+        return alcohol_bac_decay(self.bac, time - self.timestamp)
+
+    def caffeine_at(self, time):
+        if time - self.timestamp > CAFFEINE_TIME_INTERVAL:
+            return 0.0
+        return caffeine_decay(self.caffeine_mg, time - self.timestamp)
+
+    def is_exact_at(self, time):
+        """
+        Whether the state degraded to time only counts the sales within the time intervals before time. Once the
+        oldest sale counted falls out of its interval while there's still something left of it, it isn't.
+        """
+        alcohol_exact = (
+            self.alcohol_since is None
+            or time - self.alcohol_since < self.ALCOHOL_TIME_INTERVAL
+            or self.bac_at(time) == 0
+        )
+        caffeine_exact = (
+            self.caffeine_since is None
+            or time - self.caffeine_since < CAFFEINE_TIME_INTERVAL
+            or self.caffeine_at(time) == 0
+        )
+        return alcohol_exact and caffeine_exact
+
+    @staticmethod
+    def has_intake(sales):
+        return any(sale.product.alcohol_content_ml or sale.product.caffeine_content_mg for sale in sales)
+
+    @classmethod
+    def compute(cls, member):
+        """
+        Computes the state of the member from their sales in the last 12 (alcohol) and 24 (caffeine) hours, without
+        saving it.
+        """
         now = timezone.now()
-        start_of_week = now - datetime.timedelta(days=now.weekday()) - datetime.timedelta(hours=now.hour)
-        user_with_most_coffees_bought = (
-            Member.objects.filter(
-                sale__timestamp__gt=start_of_week,
-                sale__timestamp__lte=now,
-                sale__product__categories__in=coffee_category,
+        # Fetch the sales for both in one go, and split them by their time interval afterwards
+        sales = list(
+            member.sale_set.filter(
+                models.Q(product__alcohol_content_ml__gt=0.0) | models.Q(product__caffeine_content_mg__gt=0),
+                timestamp__gt=now - max(cls.ALCOHOL_TIME_INTERVAL, CAFFEINE_TIME_INTERVAL),
             )
-            .annotate(Count('sale'))
-            .order_by('-sale__count', 'phone_number')
-            .first()
+            .select_related('product')
+            .order_by('timestamp')
+        )
+        alcohol_timeline = [
+            (s.timestamp, s.product.alcohol_content_ml)
+            for s in sales
+            if s.timestamp > now - cls.ALCOHOL_TIME_INTERVAL and (s.product.alcohol_content_ml or 0.0) > 0.0
+        ]
+        caffeine_intakes = [
+            Intake(s.timestamp, s.product.caffeine_content_mg)
+            for s in sales
+            if s.timestamp > now - CAFFEINE_TIME_INTERVAL and s.product.caffeine_content_mg > 0
+        ]
+
+        return cls(
+            member=member,
+            timestamp=now,
+            bac=alcohol_bac_timeline(member.booze_gender(), cls.WEIGHT, now, alcohol_timeline),
+            caffeine_mg=current_caffeine_in_body_compound_interest(caffeine_intakes),
+            alcohol_since=alcohol_timeline[0][0] if alcohol_timeline else None,
+            caffeine_since=caffeine_intakes[0].timestamp if caffeine_intakes else None,
+        )
+
+    @classmethod
+    def recompute(cls, member):
+        """
+        Rebuilds and saves the state of the member from their recent sales, see compute.
+        Used when there is no state yet, when sales are removed, e.g. by refunds, and when the state isn't exact.
+        """
+        state = cls.compute(member)
+        state.save()
+        return state
+
+    @classmethod
+    @transaction.atomic
+    def record_sales(cls, member, sales):
+        """
+        Adds the alcohol and caffeine of newly created sales to the state of the member.
+        Returns the updated state, or None if the sales contain neither.
+        """
+        if not cls.has_intake(sales):
+            return None
+
+        try:
+            state = cls.objects.select_for_update().get(member=member)
+        except cls.DoesNotExist:
+            # The sales are already saved, so they are included when creating the state
+            return cls.recompute(member)
+
+        sales = sorted(sales, key=lambda s: s.timestamp)
+        if sales[0].timestamp < state.timestamp:
+            # We can't add intakes before the state in closed form, so replay the sales instead
+            return cls.recompute(member)
+
+        gender = member.booze_gender()
+        for sale in sales:
+            if not state.is_exact_at(sale.timestamp):
+                # The oldest sales in the state don't count anymore, and we can't take them out in closed form
+                return cls.recompute(member)
+
+            bac = state.bac_at(sale.timestamp)
+            caffeine_mg = state.caffeine_at(sale.timestamp)
+            # Nothing is left of the earlier sales, so they can't make the state inexact later
+            if bac == 0:
+                state.alcohol_since = None
+            if caffeine_mg == 0:
+                state.caffeine_since = None
+            if sale.product.alcohol_content_ml and state.alcohol_since is None:
+                state.alcohol_since = sale.timestamp
+            if sale.product.caffeine_content_mg and state.caffeine_since is None:
+                state.caffeine_since = sale.timestamp
+
+            state.bac = bac + alcohol_bac_increase(gender, cls.WEIGHT, sale.product.alcohol_content_ml or 0.0)
+            state.caffeine_mg = caffeine_mg + sale.product.caffeine_content_mg
+            state.timestamp = sale.timestamp
+        state.save()
+        return state
+
+
+class WeeklyCoffeeCount(models.Model):
+    """
+    The number of coffees bought by a member in the week starting at week_start.
+    Bumped whenever a sale of a product in the coffee category (settings.COFFEE_CATEGORY_ID) is recorded.
+    """
+
+    LEADER_CACHE_KEY = 'stregsystem.weeklycoffeecount.leader.{}'
+
+    week_start = models.DateField()
+    member = models.ForeignKey(Member, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [
+            ["week_start", "member"],
+        ]
+
+    def __str__(self):
+        return f"{self.week_start}: {self.member.phone_number} ({self.count})"
+
+    @staticmethod
+    def week_start_of(time) -> datetime.date:
+        date = timezone.localtime(time).date()
+        return date - datetime.timedelta(days=date.weekday())
+
+    @classmethod
+    def leader(cls, time):
+        """
+        Returns the id of the member who has bought the most coffee in the week of the given time, or None.
+        """
+        week_start = cls.week_start_of(time)
+        key = cls.LEADER_CACHE_KEY.format(week_start)
+        leader = cache.get(key)
+        if leader is None:
+            # Cache the absence of a leader as 0, since None means a cache miss
+            leader = (
+                cls.objects.filter(week_start=week_start, count__gt=0)
+                .order_by('-count', 'member__phone_number')
+                .values_list('member_id', flat=True)
+                .first()
+            ) or 0
+            cache.set(key, leader)
+        return leader or None
+
+    @staticmethod
+    def coffee_sales(sales):
+        coffee_product_ids = set(
+            Product.categories.through.objects.filter(
+                product_id__in={sale.product_id for sale in sales}, category_id=settings.COFFEE_CATEGORY_ID
+            ).values_list('product_id', flat=True)
         )
+        return [sale for sale in sales if sale.product_id in coffee_product_ids]
 
-        return user_with_most_coffees_bought == self
+    @classmethod
+    @transaction.atomic
+    def record_sales(cls, member, sales):
+        weeks = Counter(cls.week_start_of(sale.timestamp) for sale in cls.coffee_sales(sales))
+        for week_start, count in weeks.items():
+            updated = cls.objects.filter(week_start=week_start, member=member).update(count=F('count') + count)
+            if not updated:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(week_start=week_start, member=member, count=count)
+                except IntegrityError:
+                    # Someone else created the row in the meantime
+                    cls.objects.filter(week_start=week_start, member=member).update(count=F('count') + count)
+            cache.delete(cls.LEADER_CACHE_KEY.format(week_start))
+
+    @classmethod
+    def recompute(cls, member, week_starts):
+        """
+        Recounts the coffees of the member in the given weeks from their sales.
+        """
+        for week_start in week_starts:
+            week_begin = timezone.make_aware(datetime.datetime.combine(week_start, datetime.time()))
+            count = member.sale_set.filter(
+                timestamp__gte=week_begin,
+                timestamp__lt=week_begin + datetime.timedelta(days=7),
+                product__categories=settings.COFFEE_CATEGORY_ID,
+            ).count()
+            cls.objects.update_or_create(week_start=week_start, member=member, defaults={'count': count})
+            cache.delete(cls.LEADER_CACHE_KEY.format(week_start))
+
+
+def record_sales(member, sales):
+    """
+    Updates the state derived from the sales of a member, after the sales have been created.
+    Returns the physiology state of the member if the sales changed it, or None.
+    """
+    physiology = MemberPhysiology.record_sales(member, sales)
+    WeeklyCoffeeCount.record_sales(member, sales)
+    Product.record_sales(sales)
+    DailySales.record_sales(sales)
+    return physiology
+
+
+def record_refunded_sales(member, sales):
+    """
+    Updates the state derived from the sales of a member, after the sales have been deleted.
+    """
+    MemberPhysiology.recompute(member)
+    WeeklyCoffeeCount.recompute(member, {WeeklyCoffeeCount.week_start_of(sale.timestamp) for sale in sales})
+    DailySales.record_refunded_sales(sales)
 
 
 class Payment(models.Model):  # id automatisk...
@@ -306,30 +615,60 @@ class Payment(models.Model):  # id automatisk...
         if self.id:
             return  # update -- should not be allowed
         else:
-            # TODO: Make atomic
             self.member.make_payment(self.amount)
             super(Payment, self).save(*args, **kwargs)
-            self.member.save()
+            ledger.change_balance(self.member, self.amount)
             if self.member.email != "" and self.amount != 0:
                 if '@' in parseaddr(self.member.email)[1] and self.member.want_spam:
                     send_payment_mail(self.member, self.amount, mbpayment.comment if mbpayment else None)
 
-    def log_from_mobile_payment(self, processed_mobile_payment, admin_user: User):
-        LogEntry.objects.log_action(
+    @classmethod
+    @transaction.atomic
+    def save_batch(cls, payments, mobile_payments=None):
+        """
+        Saves new payments in bulk, like a batch of deposits after a party.
+        The balance of every member is changed by a single update however many payments they have in the batch, the
+        payments are inserted together, and the payment mails are queued together.
+        If the payments are made from mobile_payments, one for each payment, their comments are put in the mails like
+        save(mbpayment=...) does.
+        Returns the payments with their ids set.
+        """
+        deltas = Counter()
+        for payment in payments:
+            deltas[payment.member_id] += payment.amount
+        for member_id, delta in deltas.items():
+            if delta:
+                ledger.apply(member_id, delta)
+        payments = bulk_create_with_ids(Payment, payments)
+
+        members = Member.objects.in_bulk(deltas.keys())
+        with queue_mails_in_bulk():
+            for i, payment in enumerate(payments):
+                member = payment.member = members[payment.member_id]
+                if payment.amount != 0 and '@' in parseaddr(member.email)[1] and member.want_spam:
+                    comment = mobile_payments[i].comment if mobile_payments is not None else None
+                    send_payment_mail(member, payment.amount, comment)
+        return payments
+
+    def log_entry_from_mobile_payment(self, processed_mobile_payment, admin_user: User):
+        """
+        Returns the unsaved log entry of a payment created from a mobile payment, to be saved with bulk_create.
+        """
+        return LogEntry(
             user_id=admin_user.pk,
             content_type_id=ContentType.objects.get_for_model(Payment).pk,
-            object_id=self.id,
-            object_repr=str(self),
+            object_id=str(self.id),
+            object_repr=str(self)[:200],
             action_flag=ADDITION,
-            change_message=f"{''}" f"MobilePayment (transaction_id: {processed_mobile_payment.transaction_id})",
+            change_message=f"MobilePayment (transaction_id: {processed_mobile_payment.transaction_id})",
         )
 
+    @transaction.atomic
     def delete(self, *args, **kwargs):
         if self.id:
-            # TODO: Make atomic
             self.member.make_payment(-self.amount)
             super(Payment, self).delete(*args, **kwargs)
-            self.member.save()
+            ledger.change_balance(self.member, -self.amount)
         else:
             super(Payment, self).delete(*args, **kwargs)
 
@@ -337,6 +676,10 @@ class Payment(models.Model):  # id automatisk...
 class MobilePayment(models.Model):
     class Meta:
         permissions = (("mobilepaytool_access", "MobilePaytool access"),)
+        indexes = [
+            # The unprocessed and processed mobile payment queries
+            models.Index(fields=["status", "payment"]),
+        ]
 
     UNSET = 'U'
     APPROVED = 'A'
@@ -373,25 +716,28 @@ class MobilePayment(models.Model):
         if self.id and self.payment is not None:
             self.member.make_payment(-self.amount)
             super(MobilePayment, self).delete(*args, **kwargs)
-            self.member.save()
+            ledger.change_balance(self.member, -self.amount)
         else:
             super(MobilePayment, self).delete(*args, **kwargs)
 
     @staticmethod
     @transaction.atomic
-    def submit_processed_mobile_payments(admin_user: User):
-        processed_mobile_payment: MobilePayment  # annotate iterated variable (PEP 526)
-        for processed_mobile_payment in make_processed_mobilepayment_query():
-            if processed_mobile_payment.status == MobilePayment.APPROVED:
-                payment = Payment(member=processed_mobile_payment.member, amount=processed_mobile_payment.amount)
-                # Save payment and foreign key to MobilePayment field
-                payment.save()
-                payment.log_from_mobile_payment(processed_mobile_payment, admin_user)
-                processed_mobile_payment.payment = payment
-                processed_mobile_payment.save()
-
-            elif processed_mobile_payment.status == MobilePayment.IGNORED:
-                processed_mobile_payment.log_mobile_payment(admin_user, "Ignored")
+    def submit_processed_mobile_payments(admin_user: User, mobile_payments=None):
+        """
+        Creates the payments of the approved mobile payments that don't have one yet.
+        Ignored mobile payments never get a payment, so they're left alone; whoever ignored them logged it then.
+        Only the mobile payments of the queryset mobile_payments are submitted, if it's given.
+        Returns the number of created payments.
+        """
+        approved = make_processed_mobilepayment_query().filter(status=MobilePayment.APPROVED).select_related('member')
+        if mobile_payments is not None:
+            approved = approved.filter(pk__in=mobile_payments.values('pk'))
+        # Lock the rows, so a mobile payment submitted concurrently by the mobilepaytool doesn't get two payments
+        approved = list(approved.select_for_update(of=('self',)))
+
+        LogEntry.objects.bulk_create(MobilePayment.create_payments(approved, admin_user))
+        MobilePayment.objects.bulk_update(approved, ['payment'])
+        return len(approved)
 
     @staticmethod
     @transaction.atomic
@@ -399,7 +745,7 @@ class MobilePayment(models.Model):
         """
         Takes a cleaned_form from a MobilePayToolFormSet and processes them.
         The return value is the number of rows procesed.
-        If one of the MobilePayments have been altered compared to the data, a RuntimeError will be raised.
+        If one of the MobilePayments have been altered compared to the data, a MobilePaytoolException will be raised.
         """
         cleaned_data = []
 
@@ -414,10 +760,15 @@ class MobilePayment(models.Model):
 
         # Find the id's of the remaining cleaned data.
         mobile_payment_ids = [row['id'].id for row in cleaned_data]
+        # Lock the rows, so they can't be processed by autopayment between the check below and the update.
+        # The log entries of ignored rows name their members.
+        database_mobile_payments = (
+            MobilePayment.objects.select_for_update(of=('self',)).select_related('member').in_bulk(mobile_payment_ids)
+        )
         # Count how many id of the id's who are set to status "unset".
-        database_mobile_payment_count = MobilePayment.objects.filter(
-            id__in=mobile_payment_ids, status=MobilePayment.UNSET
-        ).count()
+        database_mobile_payment_count = sum(
+            1 for mp in database_mobile_payments.values() if mp.status == MobilePayment.UNSET
+        )
         # If there's a discrepancy in the number of rows, the user must have an outdated image. Throw an error.
         if len(mobile_payment_ids) != database_mobile_payment_count:
             # get database mobilepayments matching cleaned ids and having been processed while form has been active
@@ -427,47 +778,82 @@ class MobilePayment(models.Model):
                 )
             )
 
+        approved = []
+        log_entries = []
         for row in cleaned_data:
-            processed_mobile_payment = MobilePayment.objects.get(id=row['id'].id)
+            processed_mobile_payment = database_mobile_payments[row['id'].id]
+            processed_mobile_payment.status = row['status']
             # If approved, we need to create a payment and relate said payment to the mobilepayment.
             if row['status'] == MobilePayment.APPROVED:
-                payment_amount = processed_mobile_payment.amount
-                member = Member.objects.get(id=row['member'].id)
-
-                payment = Payment(member=member, amount=payment_amount)
-                payment.log_from_mobile_payment(processed_mobile_payment, admin_user)
-                payment.save(mbpayment=processed_mobile_payment)
-
-                processed_mobile_payment.payment = payment
-                processed_mobile_payment.member = member
-                processed_mobile_payment.log_mobile_payment(admin_user, "Approved")
+                processed_mobile_payment.member = row['member']
+                approved.append(processed_mobile_payment)
             # If ignored, we need to log who did it.
             elif row['status'] == MobilePayment.IGNORED:
-                processed_mobile_payment.log_mobile_payment(admin_user, "Ignored")
+                log_entries.append(processed_mobile_payment.log_entry(admin_user, "Ignored"))
 
-            processed_mobile_payment.status = row['status']
-            processed_mobile_payment.save()
+        log_entries += MobilePayment.create_payments(approved, admin_user, with_comments=True)
+        log_entries += [mp.log_entry(admin_user, "Approved") for mp in approved]
+        LogEntry.objects.bulk_create(log_entries)
+        MobilePayment.objects.bulk_update(database_mobile_payments.values(), ['status', 'member', 'payment'])
 
         # Return how many records were modified.
         return len(mobile_payment_ids)
 
-    def log_mobile_payment(self, admin_user: User, msg):
-        LogEntry.objects.log_action(
+    @staticmethod
+    def create_payments(approved_mobile_payments, admin_user: User, with_comments=False):
+        """
+        Creates the payments of approved mobile payments with Payment.save_batch, and sets them on the mobile payments,
+        which must be saved afterwards. Returns the unsaved log entries of the payments, which like the mobile payments
+        need the ids save_batch sets on every backend.
+        With with_comments the payment mails include the comments of the mobile payments.
+        """
+        payments = Payment.save_batch(
+            [Payment(member_id=mp.member_id, amount=mp.amount) for mp in approved_mobile_payments],
+            approved_mobile_payments if with_comments else None,
+        )
+        for mp, payment in zip(approved_mobile_payments, payments):
+            mp.payment = payment
+        return [
+            payment.log_entry_from_mobile_payment(mp, admin_user)
+            for mp, payment in zip(approved_mobile_payments, payments)
+        ]
+
+    def log_entry(self, admin_user: User, msg):
+        """
+        Returns an unsaved log entry of a change of the mobile payment, to be saved with bulk_create.
+        """
+        return LogEntry(
             user_id=admin_user.pk,
             content_type_id=ContentType.objects.get_for_model(MobilePayment).pk,
-            object_id=self.id,
-            object_repr=str(self),
+            object_id=str(self.id),
+            object_repr=str(self)[:200],
             action_flag=CHANGE,
             change_message=msg,
         )
 
     @staticmethod
-    @transaction.atomic
-    def approve_member_filled_mobile_payments():
-        for payment in make_unprocessed_member_filled_mobilepayment_query():
-            if payment.status == MobilePayment.UNSET:
-                payment.status = MobilePayment.APPROVED
-                payment.save()
+    def approve_member_filled_mobile_payments(mobile_payments=None):
+        """
+        Approves the unprocessed mobile payments of at least 50 kr. with a member, in a single update.
+        Only the mobile payments of the queryset mobile_payments are approved, if it's given.
+        Returns the number of approved mobile payments.
+        """
+        unprocessed = make_unprocessed_member_filled_mobilepayment_query()
+        if mobile_payments is not None:
+            unprocessed = unprocessed.filter(pk__in=mobile_payments.values('pk'))
+        return unprocessed.update(status=MobilePayment.APPROVED)
+
+
+class ImportedLedgerDate(models.Model):
+    """
+    A complete day of the MobilePay ledger, whose transactions have all been imported, so it's never fetched again.
+    """
+
+    ledger_date = models.DateField(unique=True)
+    imported = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.ledger_date)
 
 
 class Category(models.Model):
@@ -493,6 +879,12 @@ class Room(models.Model):
 
 
 class Product(models.Model):  # id automatisk...
+    # Like the alias map, other processes only see changes when their cached lists time out.
+    # Purchases are still checked against the stock in Order.execute, so a stale list can't oversell.
+    PRODUCT_LIST_VERSION_CACHE_KEY = 'stregsystem.product.list_version'
+    PRODUCT_LIST_CACHE_KEY = 'stregsystem.product.list.{}'
+    PRODUCT_LIST_CACHE_TIMEOUT = 5 * 60
+
     name = models.CharField(max_length=64)
     price = models.IntegerField()  # penge, oere...
     active = models.BooleanField()
@@ -503,10 +895,19 @@ class Product(models.Model):  # id automatisk...
     rooms = models.ManyToManyField(Room, blank=True)
     alcohol_content_ml = models.FloatField(default=0.0, null=True)
     caffeine_content_mg = models.IntegerField(default=0)
+    # Number of sales since start_date, maintained when selling and refunding. Always 0 for unlimited products.
+    bought = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return active_str(self.active) + " " + self.name + " (" + money(self.price) + ")"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        product = super().from_db(db, field_names, values)
+        # Remember the start_date in the database, so save can tell if it changed without fetching it again
+        product._db_start_date = dict(zip(field_names, values)).get('start_date', DEFERRED)
+        return product
+
     def save(self, *args, **kwargs):
         price_changed = True
         if self.id:
@@ -515,19 +916,79 @@ class Product(models.Model):  # id automatisk...
                 price_changed = oldprice != self.price
             except OldPrice.DoesNotExist:  # der findes varer hvor der ikke er nogen "tidligere priser"
                 pass
+        start_date_changed = False
+        if not self._state.adding:
+            old_start_date = getattr(self, '_db_start_date', DEFERRED)
+            if old_start_date is DEFERRED:
+                old_start_date = Product.objects.filter(id=self.id).values_list('start_date', flat=True).first()
+            start_date_changed = old_start_date != self.start_date
+            if old_start_date is not None and 'update_fields' not in kwargs:
+                # The bought counter of a limited product is updated concurrently by sales, so never write back our
+                # possibly stale copy. It's always 0 for unlimited products.
+                kwargs['update_fields'] = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name != 'bought'
+                ]
         super(Product, self).save(*args, **kwargs)
+        self._db_start_date = self.start_date
         if price_changed:
             OldPrice.objects.create(product=self, price=self.price)
+        if start_date_changed:
+            self.recount_bought()
 
-    @property
-    def bought(self):
+    def count_bought(self):
+        """
+        Counts the sales of a limited product since its start_date, which the bought field is a counter of.
+        """
         # @INCOMPLETE: If it's an unlimited item we just don't care about the
         # bought count - Jesper 27/09-2017
         if self.start_date is None:
             return 0
-        return self.sale_set.filter(timestamp__gt=date_to_midnight(self.start_date)).aggregate(bought=Count("id"))[
-            "bought"
-        ]
+        return self.sale_set.filter(timestamp__gt=date_to_midnight(self.start_date)).count()
+
+    def recount_bought(self):
+        self.bought = self.count_bought()
+        Product.objects.filter(id=self.id).update(bought=self.bought)
+
+    def reserve_stock(self, count):
+        """
+        Adds count to the bought counter of a limited product, if there's enough left in stock.
+        The check and the update is a single UPDATE, so concurrent purchases can't oversell, and the row stays locked
+        until the surrounding transaction is done.
+        :return: whether the stock could be reserved
+        """
+        # Purchases before the start_date don't count towards the stock, see _count_bought_sales
+        if self.start_date is None or timezone.now() <= date_to_midnight(self.start_date):
+            return True
+        reserved = Product.objects.filter(id=self.id, bought__lte=F('quantity') - count).update(
+            bought=F('bought') + count
+        )
+        if reserved:
+            self.bought += count
+        return bool(reserved)
+
+    @classmethod
+    def _count_bought_sales(cls, sales):
+        # Sales before the start_date don't count towards the stock
+        counts = Counter()
+        products = {}
+        for sale in sales:
+            product = sale.product
+            if product.start_date is not None and sale.timestamp > date_to_midnight(product.start_date):
+                counts[product.id] += 1
+                products.setdefault(product.id, product)
+        return counts, products
+
+    @classmethod
+    def add_bought(cls, sales):
+        """
+        Counts sales created outside of Order.execute, which reserves its stock itself.
+        """
+        counts, products = cls._count_bought_sales(sales)
+        for product_id, count in counts.items():
+            cls.objects.filter(id=product_id).update(bought=F('bought') + count)
+            products[product_id].bought += count
 
     def is_active(self):
         expired = self.deactivate_date is not None and self.deactivate_date <= timezone.now()
@@ -540,14 +1001,103 @@ class Product(models.Model):  # id automatisk...
 
         return self.active and not expired and not out_of_stock
 
+    @classmethod
+    def active_product_list(cls, room_id) -> list:
+        """
+        Returns the products currently for sale in the room.
+        The list is cached per room until a product, room or product mapping changes, a limited product sells out,
+        or one of the listed products reaches its deactivate_date.
+        """
+        version = cache.get_or_set(cls.PRODUCT_LIST_VERSION_CACHE_KEY, time.time_ns, None)
+        key = cls.PRODUCT_LIST_CACHE_KEY.format(room_id)
+        products = cache.get(key, version=version)
+        if products is None:
+            now = timezone.now()
+            products = list(make_active_productlist_query(cls.objects).filter(make_room_specific_query(room_id)))
+            timeout = cls.PRODUCT_LIST_CACHE_TIMEOUT
+            for product in products:
+                if product.deactivate_date is not None:
+                    timeout = min(timeout, math.ceil((product.deactivate_date - now).total_seconds()))
+            cache.set(key, products, max(timeout, 1), version=version)
+        return products
+
+    @classmethod
+    def invalidate_active_product_lists(cls):
+        # Bumping the version orphans the lists of every room at once, they'll be evicted by their timeout
+        try:
+            cache.incr(cls.PRODUCT_LIST_VERSION_CACHE_KEY)
+        except ValueError:
+            cache.set(cls.PRODUCT_LIST_VERSION_CACHE_KEY, time.time_ns(), None)
+
+    @classmethod
+    def record_sales(cls, sales):
+        """
+        Invalidates the product lists if the sales made a limited product sell out.
+        """
+        limited_products = {sale.product for sale in sales if sale.product.start_date is not None}
+        if any(product.quantity <= product.bought for product in limited_products):
+            cls.invalidate_active_product_lists()
+
+    @classmethod
+    def remove_bought_sales(cls, sales):
+        """
+        Puts deleted sales back in stock with one update per product, like remove_bought does for a single sale.
+        The products of the sales must be loaded.
+        """
+        counts, _ = cls._count_bought_sales(sales)
+        for product_id, count in counts.items():
+            cls.objects.filter(id=product_id).update(bought=F('bought') - count)
+        if counts:
+            cls.invalidate_active_product_lists()
+
+    @classmethod
+    def remove_bought(cls, sale):
+        """
+        Puts a deleted sale back in stock, if it's of a limited product and counted towards its stock, and invalidates
+        the product lists if it was. Runs for every deleted sale, however it's deleted, so it doesn't fetch the product;
+        when the product is already loaded, sales that don't count towards the stock don't cost a query.
+        """
+        if Sale.product.is_cached(sale):
+            cls.remove_bought_sales([sale])
+            return
+
+        # The sale counts if it's after midnight at the start of the start_date, see _count_bought_sales
+        local_timestamp = timezone.localtime(sale.timestamp)
+        if local_timestamp.time() == datetime.time():
+            counted = models.Q(start_date__lt=local_timestamp.date())
+        else:
+            counted = models.Q(start_date__lte=local_timestamp.date())
+        if cls.objects.filter(counted, id=sale.product_id).update(bought=F('bought') - 1):
+            cls.invalidate_active_product_lists()
+
 
 class NamedProduct(models.Model):
+    # Other processes only see changes when their cached alias map times out, so keep this short
+    ALIAS_MAP_CACHE_KEY = 'stregsystem.namedproduct.alias_map'
+    ALIAS_MAP_CACHE_TIMEOUT = 5 * 60
+
     name = models.CharField(max_length=50, unique=True, validators=[RegexValidator(regex=r'^[^\d:\-_][\w\-]+$')])
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='named_id')
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def alias_map(cls) -> dict:
+        """
+        Returns a dict mapping every alias to the id of its product.
+        The map is cached, and invalidated whenever a NamedProduct is saved or deleted.
+        """
+        aliases = cache.get(cls.ALIAS_MAP_CACHE_KEY)
+        if aliases is None:
+            aliases = dict(cls.objects.order_by('pk').values_list('name', 'product_id'))
+            cache.set(cls.ALIAS_MAP_CACHE_KEY, aliases, cls.ALIAS_MAP_CACHE_TIMEOUT)
+        return aliases
+
+    @classmethod
+    def invalidate_alias_map(cls):
+        cache.delete(cls.ALIAS_MAP_CACHE_KEY)
+
     def map_str(self):
         return self.name + " -> " + str(self.product.id)
 
@@ -561,7 +1111,14 @@ class OldPrice(models.Model):  # gamle priser, skal huskes; til regnskab/statist
         return self.product.name + ": " + money(self.price) + " (" + str(self.changed_on) + ")"
 
 
+# Set while Sale.refund deletes sales, see Sale.refunding_in_bulk
+_bulk_refund = threading.local()
+
+
 class Sale(models.Model):
+    # How long after a purchase the terminal can undo it
+    UNDO_TIME = datetime.timedelta(minutes=5)
+
     member = models.ForeignKey(Member, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     room = models.ForeignKey(Room, on_delete=models.CASCADE, null=True)
@@ -572,6 +1129,12 @@ class Sale(models.Model):
         index_together = [
             ["product", "timestamp"],
         ]
+        indexes = [
+            # Sales of a member, newest first: history, BAC, caffeine and the multibuy hint
+            models.Index(fields=["member", "timestamp"]),
+            # Sales in a time range: daily and the sales api
+            models.Index(fields=["timestamp"]),
+        ]
 
         permissions = (("access_sales_reports", "Can access sales reports"),)
 
@@ -598,6 +1161,186 @@ class Sale(models.Model):
         else:
             raise RuntimeError("You can't delete a sale that hasn't happened")
 
+    @staticmethod
+    def undo_token(sales) -> str:
+        """
+        Returns a signed token the terminal can undo the sales with, until UNDO_TIME has passed.
+        """
+        return signing.dumps([sale.id for sale in sales], salt="stregsystem.Sale.undo_token")
+
+    @staticmethod
+    def from_undo_token(token):
+        """
+        Returns the ids of the sales the undo token was made for. Raises signing.BadSignature if the token is forged or
+        has expired.
+        """
+        return signing.loads(token, salt="stregsystem.Sale.undo_token", max_age=Sale.UNDO_TIME)
+
+    @staticmethod
+    def refunding_in_bulk() -> bool:
+        """
+        Whether Sale.refund is deleting sales, which the post_delete receivers leave to it.
+        """
+        return getattr(_bulk_refund, 'active', False)
+
+    @classmethod
+    @transaction.atomic
+    def refund(cls, sales, user=None):
+        """
+        Refunds the sales of the queryset in bulk, and returns the refunded sales.
+        The balance of every member is credited by a single update however many of their sales are refunded, the
+        sales are deleted together, and the refund is logged as one LogEntry when it's made by a user.
+        """
+        # Lock the sales, so a concurrent refund of the same sales can't credit them again
+        sales = list(sales.select_for_update(of=('self',)).select_related('member', 'product').order_by('id'))
+        if not sales:
+            return []
+
+        sales_by_member = defaultdict(list)
+        for sale in sales:
+            sales_by_member[sale.member_id].append(sale)
+        for member_id, member_sales in sales_by_member.items():
+            ledger.apply(member_id, sum(sale.price for sale in member_sales))
+        sale_ids = [sale.id for sale in sales]
+        # The stock and the other bookkeeping of the deleted sales is done for all of them together below, instead of
+        # by the post_delete receivers of every sale
+        _bulk_refund.active = True
+        try:
+            cls.objects.filter(id__in=sale_ids).delete()
+        finally:
+            _bulk_refund.active = False
+        Product.remove_bought_sales(sales)
+        sales_refunded.send(sender=cls, sales=sales)
+
+        balances = dict(Member.objects.filter(id__in=sales_by_member.keys()).values_list('id', 'balance'))
+        for member_id, member_sales in sales_by_member.items():
+            for sale in member_sales:
+                sale.member.balance = balances[member_id]
+            # The refunded sales shouldn't count towards the state of the members anymore
+            record_refunded_sales(member_sales[0].member, member_sales)
+
+        if user is not None:
+            LogEntry.objects.log_action(
+                user_id=user.pk,
+                content_type_id=ContentType.objects.get_for_model(Sale).pk,
+                object_id=None,
+                object_repr=f"Refund of {len(sales)} sales",
+                action_flag=DELETION,
+                change_message=f"Refunded sales {', '.join(map(str, sale_ids))} "
+                f"for {money(sum(sale.price for sale in sales))} kr.",
+            )
+        return sales
+
+
+class DailySales(models.Model):
+    """
+    The number of sales of a product in a room on a day, and the revenue from them.
+    Bumped whenever sales are recorded, and decremented when they're refunded, so the sales reports don't have to
+    scan the sales. Days are in the local time zone.
+    """
+
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, null=True)
+    count = models.IntegerField(default=0)
+    revenue = models.IntegerField(default=0)  # penge, oere...
+
+    class Meta:
+        verbose_name_plural = "Daily sales"
+        constraints = [
+            models.UniqueConstraint(fields=["day", "product", "room"], name="unique_daily_sales"),
+            # A unique constraint treats every NULL room as distinct, so the sales without a room need one of their own
+            models.UniqueConstraint(
+                fields=["day", "product"], condition=models.Q(room=None), name="unique_daily_sales_without_room"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.day}: {self.product_id} in {self.room_id} ({self.count}, {money(self.revenue)})"
+
+    @staticmethod
+    def _group(sales):
+        totals = {}
+        for sale in sales:
+            key = (timezone.localdate(sale.timestamp), sale.product_id, sale.room_id)
+            count, revenue = totals.get(key, (0, 0))
+            totals[key] = (count + 1, revenue + sale.price)
+        return totals
+
+    @classmethod
+    @transaction.atomic
+    def record_sales(cls, sales):
+        for (day, product_id, room_id), (count, revenue) in cls._group(sales).items():
+            rows = cls.objects.filter(day=day, product_id=product_id, room_id=room_id)
+            updated = rows.update(count=F('count') + count, revenue=F('revenue') + revenue)
+            if not updated:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(
+                            day=day, product_id=product_id, room_id=room_id, count=count, revenue=revenue
+                        )
+                except IntegrityError:
+                    # Someone else created the row in the meantime
+                    rows.update(count=F('count') + count, revenue=F('revenue') + revenue)
+
+    @classmethod
+    def record_refunded_sales(cls, sales):
+        for (day, product_id, room_id), (count, revenue) in cls._group(sales).items():
+            cls.objects.filter(day=day, product_id=product_id, room_id=room_id).update(
+                count=F('count') - count, revenue=F('revenue') - revenue
+            )
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, from_day=None, to_day=None, batch_size=10_000):
+        """
+        Recounts the days from from_day to to_day, both included, from the sales. Returns the number of rows created.
+        """
+        days = cls.objects.all()
+        sales = Sale.objects.all()
+        if from_day is not None:
+            days = days.filter(day__gte=from_day)
+            sales = sales.filter(timestamp__gte=date_to_midnight(from_day))
+        if to_day is not None:
+            days = days.filter(day__lte=to_day)
+            sales = sales.filter(timestamp__lt=date_to_midnight(to_day + datetime.timedelta(days=1)))
+        days.delete()
+
+        totals = (
+            sales.annotate(day=TruncDate('timestamp', tzinfo=timezone.get_current_timezone()))
+            .values('day', 'product_id', 'room_id')
+            .annotate(count=models.Count('id'), revenue=models.Sum('price'))
+            .order_by()
+        )
+        created = cls.objects.bulk_create((cls(**total) for total in totals.iterator()), batch_size=batch_size)
+        return len(created)
+
+
+class OutgoingMail(models.Model):
+    """
+    A mail waiting to be sent by the sendmail command.
+    Mails are queued in the transaction of whatever caused them, so they're only sent if it commits.
+    """
+
+    sender = models.CharField(max_length=254)
+    recipient = models.CharField(max_length=254)
+    subject = models.CharField(max_length=200, blank=True, null=True)
+    message = models.TextField()  # The complete MIME message
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The queue of the worker: unsent mails, due first
+            models.Index(fields=["sent", "next_attempt"]),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient}: {self.subject} ({'sent' if self.sent else f'{self.attempts} attempts'})"
+
 
 # XXX
 class News(models.Model):
@@ -1,3 +1,9 @@
+from django.dispatch import Signal
+
+# Sent by Sale.refund with the refunded sales, which it deletes without the post_delete bookkeeping of every sale
+sales_refunded = Signal()
+
+
 def after_member_save(sender, instance, created, **kwargs):
     from .mail import send_welcome_mail
 
@@ -7,3 +13,36 @@ def after_member_save(sender, instance, created, **kwargs):
         return
 
     send_welcome_mail(instance)
+
+
+def after_named_product_change(sender, instance, **kwargs):
+    sender.invalidate_alias_map()
+
+
+def after_product_list_change(sender, **kwargs):
+    from .models import Product
+
+    Product.invalidate_active_product_lists()
+
+
+def after_sale_save(sender, instance, created, **kwargs):
+    from .models import Product, record_sales
+
+    # Fixtures are loaded row by row, so the rest of the data the bookkeeping reads may not be there yet
+    if kwargs.get('raw'):
+        return
+    if not created:
+        return
+
+    Product.add_bought([instance])
+    record_sales(instance.member, [instance])
+
+
+def after_sale_delete(sender, instance, **kwargs):
+    from .models import Product, Sale
+
+    # Refunds put their sales back in stock themselves
+    if Sale.refunding_in_bulk():
+        return
+    # Deleted members and everything else deleting sales put them back in stock here
+    Product.remove_bought(instance)
@@ -27,19 +27,12 @@ def product_id_and_alias_string(product_id):
     from stregsystem.models import NamedProduct
     from random import choice
 
-    # get aliases for id
-    aliases = NamedProduct.objects.filter(product__exact=product_id)
-
-    if aliases.exists():
-        res = str(product_id) + " / "
-        if aliases.count() > 1:
-            # pick random alias
-
-            alias: NamedProduct = choice(aliases)
-            return res + str(alias)
-        else:
-            # else we've got one alias
-            return res + str(aliases.first())
+    # get aliases for id, from the cached alias map instead of querying for every listed product
+    aliases = [name for name, aliased_id in NamedProduct.alias_map().items() if aliased_id == product_id]
+
+    if aliases:
+        # pick random alias, if there's more than one
+        return str(product_id) + " / " + choice(aliases)
     else:
         #
         return str(product_id)
@@ -1,30 +1,50 @@
 # -*- coding: utf-8 -*-
 import datetime
+import http.server
+import importlib.util
+import io
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import urllib.parse
 from collections import Counter
 from copy import deepcopy
-from unittest.mock import patch
+from unittest.mock import ANY, Mock, patch
 
 import pytz
+from django.contrib.admin.models import DELETION, LogEntry
 from django.contrib.auth.models import User
 from django.contrib.messages import get_messages
+from django.core import signing
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Sum
 from django.forms import model_to_dict
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from freezegun import freeze_time
 
 import stregsystem.parser as parser
-from stregsystem import admin
+from stregsystem import admin, ledger, vipps_api
 from stregsystem import views as stregsystem_views
 from stregsystem.admin import CategoryAdmin, ProductAdmin, MemberForm
 from stregsystem.booze import ballmer_peak
 from stregsystem.caffeine import CAFFEINE_DEGRADATION_PR_HOUR, CAFFEINE_IN_COFFEE
 from stregsystem.models import (
     Category,
+    DailySales,
     GetTransaction,
+    ImportedLedgerDate,
     Member,
+    MemberPhysiology,
     NoMoreInventoryError,
     Order,
     OrderItem,
@@ -38,10 +58,20 @@ from stregsystem.models import (
     price_display,
     MobilePayment,
     NamedProduct,
+    OutgoingMail,
+    record_refunded_sales,
+)
+from stregsystem.templatetags.stregsystem_extras import caffeine_emoji_render, money
+from stregsystem.vipps_api import AccountingAPI
+from stregsystem.utils import (
+    mobile_payment_exact_match_member,
+    rows_to_csv,
+    stream_csv,
+    strip_emoji,
+    MobilePaytoolException,
 )
-from stregsystem.templatetags.stregsystem_extras import caffeine_emoji_render
-from stregsystem.utils import mobile_payment_exact_match_member, strip_emoji, MobilePaytoolException
 from stregsystem.mail import data_sent
+from stregsystem.middleware import InstrumentationMiddleware
 
 
 def assertCountEqual(case, *args, **kwargs):
@@ -51,6 +81,11 @@ def assertCountEqual(case, *args, **kwargs):
         case.assertItemsEqual(*args, **kwargs)
 
 
+def without_bulk_insert_returning():
+    # Makes the database behave like MySQL or SQLite before 3.35, which don't return the ids of a bulk INSERT
+    return patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False)
+
+
 class ModelMiscTests(TestCase):
     def test_price_display_none(self):
         v = price_display(None)
@@ -407,6 +442,198 @@ class SaleViewTests(TestCase):
         self.assertEqual(sale_hints, "{} {}:{}".format("<span class=\"phone_number\">jokke</span>", coke.id, 2))
 
 
+class ResolveBoughtProductsTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room")
+        self.other_room = Room.objects.create(name="other room")
+        self.beer = Product.objects.create(name="øl", price=900, active=True)
+        self.flan = Product.objects.create(name="flan", price=200, active=True)
+        self.flan.rooms.add(self.room)
+        self.cocio = Product.objects.create(name="cocio", price=700, active=True)
+        self.cocio.rooms.add(self.other_room)
+        self.inactive = Product.objects.create(name="gammel øl", price=900, active=False)
+
+    def test_resolves_in_single_query(self):
+        bought_ids = [self.beer.id] * 20 + [self.flan.id]
+        with self.assertNumQueries(1):
+            msg, status, products = stregsystem_views._resolve_bought_products(bought_ids, timezone.now(), self.room)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(products, [self.beer] * 20 + [self.flan])
+
+    def test_reports_first_invalid_id(self):
+        bought_ids = [self.beer.id, self.cocio.id, self.inactive.id]
+        msg, status, result = stregsystem_views._resolve_bought_products(bought_ids, timezone.now(), self.room)
+
+        self.assertEqual(status, 400)
+        self.assertEqual(result, self.cocio.id)
+
+    def test_expired_product_is_invalid(self):
+        self.beer.deactivate_date = timezone.now() - datetime.timedelta(hours=1)
+        self.beer.save()
+
+        msg, status, result = stregsystem_views._resolve_bought_products([self.beer.id], timezone.now(), self.room)
+
+        self.assertEqual(status, 400)
+        self.assertEqual(result, self.beer.id)
+
+
+class NamedProductAliasMapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.beer = Product.objects.create(name="øl", price=900, active=True)
+        self.flan = Product.objects.create(name="flan", price=200, active=True)
+        NamedProduct.objects.create(name="beer", product=self.beer)
+
+    def test_pre_process_expands_aliases(self):
+        self.assertEqual(
+            stregsystem_views._pre_process("jokke beer:2 {} flan".format(self.flan.id)),
+            "jokke {}:2 {} flan".format(self.beer.id, self.flan.id),
+        )
+
+    def test_pre_process_no_queries_when_cached(self):
+        NamedProduct.alias_map()
+
+        with self.assertNumQueries(0):
+            stregsystem_views._pre_process("jokke beer beer:3 1 2 3")
+
+    def test_alias_map_invalidated_on_save(self):
+        NamedProduct.alias_map()
+
+        NamedProduct.objects.create(name="flan", product=self.flan)
+
+        self.assertEqual(NamedProduct.alias_map(), {"beer": self.beer.id, "flan": self.flan.id})
+
+    def test_alias_map_invalidated_on_delete(self):
+        NamedProduct.alias_map()
+
+        NamedProduct.objects.get(name="beer").delete()
+
+        self.assertEqual(NamedProduct.alias_map(), {})
+
+    def test_dump_named_items(self):
+        response = self.client.get(reverse('named_products'))
+
+        self.assertEqual(response.json(), {"beer": self.beer.id})
+
+
+class PostPurchaseContextTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name="1", description="room")
+        self.member = Member.objects.create(phone_number="jokke", full_name="J", balance=100000, gender='M')
+        self.beer = Product.objects.create(name="øl", price=900, active=True, alcohol_content_ml=20)
+
+    def quickbuy_queries(self, buy_string):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse('quickbuy', args=(self.room.name,)), {"quickbuy": buy_string})
+        self.assertTemplateUsed(response, "stregsystem/index_sale.html")
+        return len(context.captured_queries)
+
+    def test_quickbuy_query_count_independent_of_item_count(self):
+        # The first purchase builds the physiology state, so leave it out
+        self.quickbuy_queries("jokke {}".format(self.beer.id))
+
+        single = self.quickbuy_queries("jokke {}".format(self.beer.id))
+        many = self.quickbuy_queries("jokke {}:10".format(self.beer.id))
+
+        self.assertEqual(single, many)
+
+    def test_quickbuy_query_count(self):
+        # The first purchase builds the physiology state, so leave it out
+        self.quickbuy_queries("jokke {}".format(self.beer.id))
+
+        # Looking up the room, news (twice), member and products, the order in its savepoints, and the multibuy hint.
+        # The physiology state updated by the order isn't fetched again.
+        with self.assertNumQueries(21):
+            self.quickbuy_queries("jokke {}:3".format(self.beer.id))
+
+    def test_physiology_computed_in_one_query(self):
+        Sale.objects.create(member=self.member, product=self.beer, price=900)
+
+        with self.assertNumQueries(1):
+            physiology = MemberPhysiology.compute(self.member)
+
+        self.assertGreater(physiology.bac, 0)
+
+    def test_quickbuy_shows_new_balance(self):
+        response = self.client.post(
+            reverse('quickbuy', args=(self.room.name,)), {"quickbuy": "jokke {}:2".format(self.beer.id)}
+        )
+
+        self.assertEqual(response.context["member_balance"], money(100000 - 2 * 900))
+        self.assertFalse(response.context["member_has_low_balance"])
+
+    def test_multibuy_hint_single_query(self):
+        with freeze_time(timezone.datetime(2018, 1, 1)) as frozen_time:
+            for i in range(10):
+                Sale.objects.create(member=self.member, product=self.beer, price=900)
+                frozen_time.tick()
+
+        with self.assertNumQueries(1):
+            give_multibuy_hint, sale_hints = stregsystem_views._multibuy_hint(
+                timezone.datetime(2018, 1, 1, tzinfo=pytz.UTC), self.member
+            )
+
+        self.assertTrue(give_multibuy_hint)
+        self.assertEqual(sale_hints, "<span class=\"phone_number\">jokke</span> {}:10".format(self.beer.id))
+
+
+class InstrumentationMiddlewareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        InstrumentationMiddleware.stats.clear()
+        self.room = Room.objects.create(name="room", description="room")
+
+    def test_records_view_stats(self):
+        self.client.get(reverse('menu_index', args=(self.room.name,)))
+        self.client.get(reverse('menu_index', args=(self.room.name,)))
+
+        stats = InstrumentationMiddleware.summary()['menu_index']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['over_budget'], 0)
+        self.assertGreater(stats['queries']['max'], 0)
+        self.assertGreaterEqual(stats['wall_ms']['p50'], stats['db_ms']['p50'])
+
+    @override_settings(VIEW_QUERY_BUDGETS={'menu_index': 0})
+    def test_warns_over_budget(self):
+        with self.assertLogs('stregsystem.middleware', level='WARNING'):
+            self.client.get(reverse('menu_index', args=(self.room.name,)))
+
+        self.assertEqual(InstrumentationMiddleware.summary()['menu_index']['over_budget'], 1)
+
+    def test_records_streaming_response_once_streamed(self):
+        User.objects.create_superuser('superuser', 'test@example.com', "hunter2")
+        self.client.login(username="superuser", password="hunter2")
+        Sale.objects.create(
+            member=Member.objects.create(phone_number="+4511223344"),
+            product=Product.objects.create(name="beer", price=600, active=True),
+            price=600,
+        )
+
+        response = self.client.get(reverse('sales_csv'))
+        self.assertNotIn('sales_csv', InstrumentationMiddleware.summary())
+        with CaptureQueriesContext(connection) as context:
+            b"".join(response.streaming_content)
+
+        stats = InstrumentationMiddleware.summary()['sales_csv']
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreaterEqual(stats['queries']['max'], len(context.captured_queries))
+        self.assertGreater(len(context.captured_queries), 0)
+
+    def test_stats_staff_only(self):
+        response = self.client.get(reverse('request_stats'))
+        self.assertEqual(response.status_code, 302)
+
+        User.objects.create_superuser('superuser', 'test@example.com', "hunter2")
+        self.client.login(username="superuser", password="hunter2")
+        self.client.get(reverse('menu_index', args=(self.room.name,)))
+        response = self.client.get(reverse('request_stats'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['menu_index']['requests'], 1)
+
+
 class UserInfoViewTests(TestCase):
     def setUp(self):
         self.room = Room.objects.create(name="test")
@@ -539,6 +766,39 @@ class OrderTest(TestCase):
 
         fulfill.assert_called_once_with(PayTransaction(20))
 
+    def test_order_execute_creates_sale_per_item(self):
+        order = Order.from_products(self.member, self.room, [self.product] * 3)
+
+        order.execute()
+
+        self.assertEqual(len(order.sales), 3)
+        self.assertEqual(Sale.objects.filter(member=self.member, product=self.product, room=self.room).count(), 3)
+        self.assertEqual(Member.objects.get(pk=self.member.pk).balance, 70)
+
+    def test_order_execute_query_count_independent_of_item_count(self):
+        self.member.balance = 10000
+        self.member.save()
+        # The first sale of the day creates the rows of the daily sales rollup, the rest update them
+        Order.from_products(self.member, self.room, [self.product]).execute()
+
+        with CaptureQueriesContext(connection) as single:
+            Order.from_products(self.member, self.room, [self.product]).execute()
+        with CaptureQueriesContext(connection) as many:
+            Order.from_products(self.member, self.room, [self.product] * 50).execute()
+
+        self.assertEqual(len(single.captured_queries), len(many.captured_queries))
+
+    def test_order_execute_sets_sale_ids_without_bulk_insert_returning(self):
+        order = Order.from_products(self.member, self.room, [self.product] * 3)
+
+        with without_bulk_insert_returning():
+            order.execute()
+
+        self.assertCountEqual(
+            [sale.id for sale in order.sales], Sale.objects.filter(member=self.member).values_list('id', flat=True)
+        )
+        self.assertEqual(len({sale.id for sale in order.sales}), 3)
+
     @patch('stregsystem.models.Member.fulfill')
     def test_order_execute_single_no_remaining(self, fulfill):
         self.product.sale_set.create(price=100, member=self.member)
@@ -569,6 +829,32 @@ class OrderTest(TestCase):
 
         fulfill.was_not_called()
 
+    def test_order_execute_counts_bought(self):
+        self.member.balance = 1000
+        self.member.save()
+        self.product.start_date = datetime.date(year=2017, month=1, day=1)
+        self.product.quantity = 3
+        self.product.save()
+
+        Order.from_products(self.member, self.room, [self.product] * 2).execute()
+
+        self.assertEqual(self.product.bought, 2)
+        self.assertEqual(Product.objects.get(id=self.product.id).bought, 2)
+
+    def test_order_execute_out_of_stock_keeps_bought(self):
+        self.member.balance = 1000
+        self.member.save()
+        self.product.start_date = datetime.date(year=2017, month=1, day=1)
+        self.product.quantity = 3
+        self.product.save()
+        self.product.sale_set.create(price=10, member=self.member)
+
+        with self.assertRaises(NoMoreInventoryError):
+            Order.from_products(self.member, self.room, [self.product] * 3).execute()
+
+        self.assertEqual(Product.objects.get(id=self.product.id).bought, 1)
+        self.assertEqual(self.product.sale_set.count(), 1)
+
     @patch('stregsystem.models.Member.can_fulfill')
     def test_order_execute_no_money(self, can_fulfill):
         can_fulfill.return_value = False
@@ -624,6 +910,118 @@ class PaymentTests(TestCase):
         with self.assertRaises(ValueError):
             payment.delete()
 
+    def test_save_batch_balances(self):
+        other = Member.objects.create(phone_number="+4533333333", balance=-500)
+        # Separate instances of the same member, like the batch payment formset gives
+        payments = [
+            Payment(member=Member.objects.get(id=self.member.id), amount=1000),
+            Payment(member=other, amount=2000),
+            Payment(member=Member.objects.get(id=self.member.id), amount=-300),
+        ]
+
+        Payment.save_batch(payments)
+
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, 800)
+        self.assertEqual(Member.objects.get(id=other.id).balance, 1500)
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertTrue(all(payment.id for payment in payments))
+
+    def test_save_batch_sets_ids_without_bulk_insert_returning(self):
+        with without_bulk_insert_returning():
+            payments = Payment.save_batch([Payment(member=self.member, amount=100) for _ in range(3)])
+
+        self.assertEqual(
+            [payment.id for payment in payments], list(Payment.objects.order_by('id').values_list('id', flat=True))
+        )
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, self.member.balance + 300)
+
+    def test_save_batch_queries_independent_of_payments(self):
+        members = [Member.objects.create(phone_number=str(i), email=f"{i}@example.com") for i in range(3)]
+        OutgoingMail.objects.all().delete()
+
+        with CaptureQueriesContext(connection) as few:
+            Payment.save_batch([Payment(member=member, amount=100) for member in members])
+        with CaptureQueriesContext(connection) as many:
+            Payment.save_batch([Payment(member=member, amount=100) for member in members * 20])
+
+        self.assertEqual(len(few.captured_queries), len(many.captured_queries))
+        self.assertEqual(OutgoingMail.objects.count(), 63)
+
+    def test_save_batch_mails_like_save(self):
+        spammed = Member.objects.create(phone_number="spam", email="spam@example.com")
+        unspammed = Member.objects.create(phone_number="nospam", email="nospam@example.com", want_spam=False)
+        OutgoingMail.objects.all().delete()
+
+        Payment.save_batch(
+            [
+                Payment(member=spammed, amount=1000),
+                Payment(member=spammed, amount=0),
+                Payment(member=unspammed, amount=1000),
+            ]
+        )
+
+        self.assertEqual(list(OutgoingMail.objects.values_list('recipient', flat=True)), ["spam@example.com"])
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(phone_number="ledger", balance=1000)
+        self.room = Room.objects.create(name="ledgerroom")
+        self.product = Product.objects.create(name="øl", price=600, active=True)
+
+    def stale(self):
+        return Member.objects.get(id=self.member.id)
+
+    def test_purchases_with_stale_members_are_both_charged(self):
+        first, second = self.stale(), self.stale()
+        Payment(member=self.stale(), amount=1000).save()
+
+        Order.from_products(first, self.room, [self.product]).execute()
+        Order.from_products(second, self.room, [self.product]).execute()
+
+        self.assertEqual(self.stale().balance, 800)
+        self.assertEqual(second.balance, 800)
+
+    def test_purchase_fails_when_database_balance_is_short(self):
+        self.product.start_date = datetime.date(2017, 1, 1)
+        self.product.quantity = 10
+        self.product.save()
+        stale = self.stale()
+        Order.from_products(self.stale(), self.room, [self.product]).execute()
+
+        with self.assertRaises(StregForbudError):
+            Order.from_products(stale, self.room, [self.product]).execute()
+
+        self.assertEqual(self.stale().balance, 400)
+        self.assertEqual(stale.balance, 400)
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(Product.objects.get(id=self.product.id).bought, 1)
+
+    def test_refund_of_sales_with_stale_members(self):
+        Order.from_products(self.stale(), self.room, [self.product]).execute()
+        Payment(member=self.stale(), amount=1200).save()
+        Order.from_products(self.stale(), self.room, [self.product]).execute()
+
+        admin.refund(None, None, Sale.objects.all())
+
+        self.assertEqual(self.stale().balance, 2200)
+
+    def test_payment_and_delete_with_stale_members(self):
+        first = Payment(member=self.stale(), amount=500)
+        first.save()
+        Payment(member=self.stale(), amount=200).save()
+
+        first.delete()
+
+        self.assertEqual(self.stale().balance, 1200)
+        self.assertEqual(first.member.balance, 1200)
+
+    def test_conditional_apply(self):
+        self.assertFalse(ledger.apply(self.member.id, -1001, allow_overdraft=False))
+        self.assertTrue(ledger.apply(self.member.id, -1000, allow_overdraft=False))
+        self.assertTrue(ledger.apply(self.member.id, -1000))
+        self.assertEqual(self.stale().balance, -1000)
+
 
 class ProductTests(TestCase):
     def setUp(self):
@@ -700,6 +1098,281 @@ class ProductTests(TestCase):
 
         self.assertFalse(product.is_active())
 
+    def test_bought_not_counted_for_unlimited(self):
+        product = Product.objects.create(active=True, price=100)
+        product.sale_set.create(price=100, member=self.jeff)
+
+        self.assertEqual(Product.objects.get(id=product.id).bought, 0)
+
+    def test_bought_not_overwritten_by_stale_save(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=2, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        stale = Product.objects.get(id=product.id)
+        product.sale_set.create(price=100, member=self.jeff)
+
+        stale.name = "flan"
+        stale.save()
+
+        self.assertEqual(Product.objects.get(id=product.id).bought, 1)
+
+    def test_bought_recounted_on_start_date_change(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=2, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product.sale_set.create(price=100, member=self.jeff)
+
+        product.start_date = timezone.localdate() + datetime.timedelta(days=1)
+        product.save()
+
+        self.assertEqual(product.bought, 0)
+        self.assertEqual(Product.objects.get(id=product.id).bought, 0)
+
+    def test_bought_decremented_on_refund(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=1, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        sale = product.sale_set.create(price=100, member=self.jeff)
+        sale.delete()
+
+        record_refunded_sales(self.jeff, [sale])
+
+        self.assertTrue(Product.objects.get(id=product.id).is_active())
+        self.assertEqual(Product.objects.get(id=product.id).bought, 0)
+
+    def test_bought_decremented_once_on_bulk_refund(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=5, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        sales = [product.sale_set.create(price=100, member=self.jeff) for _ in range(3)]
+
+        Sale.refund(Sale.objects.filter(id__in=[sales[0].id, sales[1].id]))
+
+        self.assertEqual(Product.objects.get(id=product.id).bought, 1)
+
+    def test_bought_decremented_when_member_is_deleted(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=5, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        other = Member.objects.create(phone_number="other")
+        product.sale_set.create(price=100, member=self.jeff)
+        product.sale_set.create(price=100, member=other)
+
+        other.delete()
+
+        self.assertEqual(Product.objects.get(id=product.id).bought, 1)
+
+    def test_bought_not_decremented_for_sales_before_start_date(self):
+        product = Product.objects.create(active=True, price=100, quantity=5)
+        sale = product.sale_set.create(price=100, member=self.jeff)
+        product.start_date = timezone.localdate() + datetime.timedelta(days=1)
+        product.save()
+        Product.objects.filter(id=product.id).update(bought=1)
+
+        sale.delete()
+
+        self.assertEqual(Product.objects.get(id=product.id).bought, 1)
+
+    def test_purchases_before_start_date_reserve_no_stock(self):
+        self.jeff.balance = 1000
+        self.jeff.save()
+        room = Room.objects.create(name="stockroom")
+        product = Product.objects.create(
+            active=True, price=100, quantity=1, start_date=timezone.localdate() + datetime.timedelta(days=1)
+        )
+
+        first = Order.from_products(self.jeff, room, [product])
+        first.execute()
+        Order.from_products(self.jeff, room, [product]).execute()
+
+        self.assertEqual(Product.objects.get(id=product.id).bought, 0)
+        self.assertEqual(product.count_bought(), 0)
+        Sale.refund(Sale.objects.filter(id=first.sales[0].id))
+        self.assertEqual(Product.objects.get(id=product.id).bought, 0)
+
+    def test_remove_bought_of_unlimited_product_is_free(self):
+        sale = Product.objects.create(active=True, price=100).sale_set.create(price=100, member=self.jeff)
+
+        with self.assertNumQueries(0):
+            Product.remove_bought(sale)
+
+    def test_save_does_not_fetch_start_date(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=5, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product = Product.objects.get(id=product.id)
+
+        # The last price, the update and the price history
+        with self.assertNumQueries(3):
+            product.name = "flan"
+            product.save()
+
+    def test_recountbought_repairs_drift(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=5, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product.sale_set.create(price=100, member=self.jeff)
+        Product.objects.filter(id=product.id).update(bought=4)
+
+        call_command('recountbought', stdout=io.StringIO())
+
+        self.assertEqual(Product.objects.get(id=product.id).bought, 1)
+
+
+class ActiveProductListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name="room", description="room")
+        self.jeff = Member.objects.create(phone_number="+4533334444")
+        self.beer = Product.objects.create(name="øl", price=900, active=True)
+        self.flan = Product.objects.create(name="flan", price=200, active=True)
+
+    def test_list_cached(self):
+        Product.active_product_list(self.room.id)
+
+        with self.assertNumQueries(0):
+            products = Product.active_product_list(self.room.id)
+
+        self.assertCountEqual(products, [self.beer, self.flan])
+
+    def test_index_no_product_queries_when_cached(self):
+        NamedProduct.objects.create(name="beer", product=self.beer)
+        self.client.get(reverse('menu_index', args=(self.room.name,)))
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('menu_index', args=(self.room.name,)))
+
+        self.assertContains(response, "{} / beer".format(self.beer.id))
+        self.assertFalse(any("stregsystem_product" in query['sql'] for query in context.captured_queries))
+        self.assertFalse(any("stregsystem_namedproduct" in query['sql'] for query in context.captured_queries))
+
+    def test_invalidated_on_product_save(self):
+        Product.active_product_list(self.room.id)
+
+        self.flan.active = False
+        self.flan.save()
+
+        self.assertEqual(Product.active_product_list(self.room.id), [self.beer])
+
+    def test_invalidated_on_room_change(self):
+        other_room = Room.objects.create(name="other room", description="other room")
+        Product.active_product_list(self.room.id)
+
+        self.flan.rooms.add(other_room)
+
+        self.assertEqual(Product.active_product_list(self.room.id), [self.beer])
+
+    def test_invalidated_when_sold_out(self):
+        limited = Product.objects.create(
+            name="julebryg", price=900, active=True, quantity=2, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        limited.sale_set.create(price=900, member=self.jeff)
+        self.assertIn(limited, Product.active_product_list(self.room.id))
+
+        limited.sale_set.create(price=900, member=self.jeff)
+
+        self.assertNotIn(limited, Product.active_product_list(self.room.id))
+
+    def test_expires_at_deactivate_date(self):
+        self.flan.deactivate_date = timezone.now() + datetime.timedelta(minutes=1)
+        self.flan.save()
+        self.assertIn(self.flan, Product.active_product_list(self.room.id))
+
+        with freeze_time(timezone.now() + datetime.timedelta(minutes=2)):
+            self.assertEqual(Product.active_product_list(self.room.id), [self.beer])
+
+
+class DailySalesTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(phone_number="daily", email="daily@example.com", balance=10000)
+        self.room = Room.objects.create(name="dailyroom")
+        self.beer = Product.objects.create(name="Pilsner", price=600, active=True)
+        self.soda = Product.objects.create(name="Cola", price=400, active=True)
+
+    def rollup(self):
+        return set(DailySales.objects.values_list('day', 'product_id', 'room_id', 'count', 'revenue'))
+
+    def test_order_is_rolled_up(self):
+        Order.from_products(self.member, self.room, [self.beer, self.beer, self.soda]).execute()
+
+        today = timezone.localdate()
+        self.assertEqual(
+            self.rollup(), {(today, self.beer.id, self.room.id, 2, 1200), (today, self.soda.id, self.room.id, 1, 400)}
+        )
+
+    def test_sales_are_rolled_up_by_local_day(self):
+        # Past midnight in Copenhagen, but still the day before in UTC
+        with freeze_time(datetime.datetime(2024, 3, 1, 23, 30, tzinfo=datetime.timezone.utc)):
+            Sale.objects.create(member=self.member, product=self.beer, price=600)
+        with freeze_time(datetime.datetime(2024, 3, 1, 22, 30, tzinfo=datetime.timezone.utc)):
+            Sale.objects.create(member=self.member, product=self.beer, price=600)
+
+        self.assertEqual(
+            self.rollup(),
+            {
+                (datetime.date(2024, 3, 2), self.beer.id, None, 1, 600),
+                (datetime.date(2024, 3, 1), self.beer.id, None, 1, 600),
+            },
+        )
+
+    def test_one_row_per_day_without_room(self):
+        Sale.objects.create(member=self.member, product=self.beer, price=600)
+        Sale.objects.create(member=self.member, product=self.beer, price=600)
+
+        self.assertEqual(self.rollup(), {(timezone.localdate(), self.beer.id, None, 2, 1200)})
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DailySales.objects.create(day=timezone.localdate(), product=self.beer, room=None)
+
+    def test_refund_is_subtracted(self):
+        order = Order.from_products(self.member, self.room, [self.beer, self.beer])
+        order.execute()
+
+        admin.refund(None, None, Sale.objects.filter(id=order.sales[0].id))
+
+        self.assertEqual(self.rollup(), {(timezone.localdate(), self.beer.id, self.room.id, 1, 600)})
+
+    def test_rebuild_matches_recorded(self):
+        Order.from_products(self.member, self.room, [self.beer, self.soda]).execute()
+        with freeze_time(timezone.now() - datetime.timedelta(days=3)):
+            Sale.objects.create(member=self.member, product=self.beer, room=self.room, price=600)
+        recorded = self.rollup()
+        DailySales.objects.update(count=0, revenue=0)
+
+        out = io.StringIO()
+        call_command('rebuilddailysales', stdout=out)
+
+        self.assertEqual(self.rollup(), recorded)
+        self.assertIn("Counted 3", out.getvalue())
+
+    def test_rebuild_only_touches_the_range(self):
+        with freeze_time(timezone.now() - datetime.timedelta(days=3)):
+            Sale.objects.create(member=self.member, product=self.beer, price=600)
+        Sale.objects.create(member=self.member, product=self.beer, price=600)
+        DailySales.objects.update(count=5)
+
+        today = timezone.localdate()
+        DailySales.rebuild(today, today)
+
+        self.assertEqual(
+            self.rollup(),
+            {(today - datetime.timedelta(days=3), self.beer.id, None, 5, 600), (today, self.beer.id, None, 1, 600)},
+        )
+
+
+class CsvTests(TestCase):
+    rows = [["Timestamp", "Name", "Price"], [datetime.date(2023, 5, 2), 'Pilsner, "dåse"', 600], [None, "", 0]]
+
+    def test_rows_to_csv(self):
+        self.assertEqual(
+            rows_to_csv(self.rows), 'Timestamp,Name,Price\r\n2023-05-02,"Pilsner, ""dåse""",600\r\nNone,,0\r\n'
+        )
+
+    def test_stream_csv_matches_rows_to_csv(self):
+        lines = stream_csv(iter(self.rows))
+
+        self.assertEqual(next(lines), "Timestamp,Name,Price\r\n")
+        self.assertEqual("Timestamp,Name,Price\r\n" + "".join(lines), rows_to_csv(self.rows))
+
 
 class SaleTests(TestCase):
     def setUp(self):
@@ -738,6 +1411,101 @@ class SaleTests(TestCase):
 
         self.assertIsNone(sale.id)
 
+    def test_refund_credits_each_member_once(self):
+        other = Member.objects.create(phone_number="+4533333333", balance=100)
+        admin_user = User.objects.create_superuser('refunder', 'refunder@example.com', 'hunter2')
+        for member in (self.member, self.member, self.member, other):
+            Sale.objects.create(member=member, product=self.product, price=100)
+
+        with CaptureQueriesContext(connection) as context:
+            refunded = Sale.refund(Sale.objects.all(), user=admin_user)
+        updates = [query for query in context.captured_queries if 'UPDATE "stregsystem_member"' in query['sql']]
+
+        self.assertEqual(len(refunded), 4)
+        self.assertEqual(len(updates), 2)
+        self.assertFalse(Sale.objects.exists())
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, 400)
+        self.assertEqual(Member.objects.get(id=other.id).balance, 200)
+        self.assertEqual(refunded[0].member.balance, 400)
+        log_entry = LogEntry.objects.get()
+        self.assertEqual(log_entry.user, admin_user)
+        self.assertEqual(log_entry.action_flag, DELETION)
+        self.assertIn("4.00 kr.", log_entry.change_message)
+
+    def test_refund_queries_independent_of_sales(self):
+        limited = Product.objects.create(
+            name="limited", price=100, active=True, start_date=datetime.date(2000, 1, 1), quantity=1000
+        )
+        # The first refund of the week creates the member's coffee count
+        Sale.refund(Sale.objects.filter(id=Sale.objects.create(member=self.member, product=limited, price=100).id))
+
+        for count in (3, 30):
+            sales = [Sale.objects.create(member=self.member, product=limited, price=100) for _ in range(count)]
+
+            # Selecting, crediting, deleting, the stock, the member state, the daily sales and the rank years
+            with self.assertNumQueries(17):
+                Sale.refund(Sale.objects.filter(id__in=[sale.id for sale in sales]))
+
+        self.assertEqual(Product.objects.get(id=limited.id).bought, 0)
+        self.assertFalse(Sale.objects.exists())
+
+    def test_refund_nothing(self):
+        self.assertEqual(Sale.refund(Sale.objects.all()), [])
+        self.assertFalse(LogEntry.objects.exists())
+
+    def buy_through_api(self):
+        Room.objects.create(name="1")
+        self.member.balance = 10000
+        self.member.save()
+        response = self.client.post(
+            reverse('sale'),
+            {'buystring': f"{self.member.phone_number} {self.product.id}:2", 'room': "1", 'member_id': self.member.id},
+            content_type="application/json",
+        )
+        return response.json()['values']['order']
+
+    def undo(self, undo_token):
+        return self.client.post(reverse('undo_sale'), {'undo_token': undo_token}, content_type="application/json")
+
+    def test_undo_sale_through_api(self):
+        order = self.buy_through_api()
+
+        response = self.undo(order['undo_token'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['values']['sales'], order['sales'])
+        self.assertEqual(response.json()['values']['member_balance'], "100.00")
+        self.assertFalse(Sale.objects.exists())
+
+    def test_undo_sale_only_once(self):
+        order = self.buy_through_api()
+
+        self.assertEqual(self.undo(order['undo_token']).status_code, 200)
+        self.assertEqual(self.undo(order['undo_token']).status_code, 400)
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, 10000)
+
+    def test_undo_sale_needs_a_valid_token(self):
+        other = Member.objects.create(phone_number="+4533333333", balance=100)
+        sale = Sale.objects.create(member=other, product=self.product, price=1)
+
+        without_token = self.client.post(
+            reverse('undo_sale'), {'member_id': other.id, 'sales': [sale.id]}, content_type="application/json"
+        )
+        forged = self.undo(signing.dumps([sale.id], salt="something else"))
+
+        self.assertEqual(without_token.status_code, 400)
+        self.assertEqual(forged.status_code, 400)
+        self.assertTrue(Sale.objects.filter(id=sale.id).exists())
+
+    def test_undo_old_sale(self):
+        order = self.buy_through_api()
+
+        with freeze_time(timezone.now() + Sale.UNDO_TIME + datetime.timedelta(seconds=1)):
+            response = self.undo(order['undo_token'])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Sale.objects.count(), 2)
+
 
 class MemberTests(TestCase):
     def test_fulfill_pay_transaction(self):
@@ -853,6 +1621,75 @@ class MemberTests(TestCase):
         with freeze_time(timezone.datetime(year=2000, month=1, day=1, hour=0, minute=50)) as ft:
             self.assertAlmostEqual(1.15, user.calculate_alcohol_promille(), places=2)
 
+    def test_promille_from_order(self):
+        user = Member.objects.create(phone_number="+4522222222", gender='M', balance=1000)
+        room = Room.objects.create(name="room")
+        # (330 ml * 4.6%) = 15.18
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+
+        Order.from_products(user, room, [alcoholic_drink] * 2).execute()
+
+        self.assertAlmostEqual(0.43, user.calculate_alcohol_promille(), places=2)
+
+    def test_promille_does_not_scan_sales(self):
+        user = Member.objects.create(phone_number="+4522222222", gender='M')
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+        for _ in range(5):
+            user.sale_set.create(product=alcoholic_drink, price=alcoholic_drink.price)
+
+        with self.assertNumQueries(1):
+            user.calculate_alcohol_promille()
+
+    def test_promille_recomputed_on_refund(self):
+        user = Member.objects.create(phone_number="+4522222222", gender='M')
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+        user.sale_set.create(product=alcoholic_drink, price=alcoholic_drink.price)
+        user.sale_set.create(product=alcoholic_drink, price=alcoholic_drink.price)
+
+        admin.refund(None, None, Sale.objects.filter(id=user.sale_set.first().id))
+
+        self.assertAlmostEqual(0.21, user.calculate_alcohol_promille(), places=2)
+
+    def test_promille_only_counts_last_12_hours(self):
+        user = Member.objects.create(phone_number="+4522222222", gender='M')
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+        start = timezone.datetime(year=2000, month=1, day=1, hour=12, tzinfo=pytz.UTC)
+        with freeze_time(start):
+            for _ in range(10):
+                user.sale_set.create(product=alcoholic_drink, price=alcoholic_drink.price)
+        with freeze_time(start + datetime.timedelta(hours=6)):
+            user.sale_set.create(product=alcoholic_drink, price=alcoholic_drink.price)
+
+        # Only the last beer counts, and it's long gone
+        with freeze_time(start + datetime.timedelta(hours=13)):
+            self.assertEqual(0.0, user.calculate_alcohol_promille())
+            # Reading doesn't save anything
+            self.assertEqual(MemberPhysiology.objects.get(member=user).timestamp, start + datetime.timedelta(hours=6))
+
+            user.sale_set.create(product=alcoholic_drink, price=alcoholic_drink.price)
+            self.assertAlmostEqual(0.21, user.calculate_alcohol_promille(), places=2)
+
+    def test_physiology_is_not_saved_when_read(self):
+        user = Member.objects.create(phone_number="+4522222222", gender='M')
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+        user.sale_set.create(product=alcoholic_drink, price=alcoholic_drink.price)
+        MemberPhysiology.objects.all().delete()
+
+        self.assertAlmostEqual(0.21, user.calculate_alcohol_promille(), places=2)
+        self.assertFalse(MemberPhysiology.objects.exists())
+
+    def test_raw_sale_save_skips_bookkeeping(self):
+        # Fixtures are loaded with raw saves
+        user = Member.objects.create(phone_number="+4522222222", gender='M')
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+
+        Sale(member=user, product=alcoholic_drink, price=alcoholic_drink.price, timestamp=timezone.now()).save_base(
+            raw=True
+        )
+
+        self.assertFalse(MemberPhysiology.objects.exists())
+        self.assertFalse(DailySales.objects.exists())
+
     def test_send_userdata(self):
         user = Member.objects.create()
         room = Room.objects.create()
@@ -864,6 +1701,81 @@ class MemberTests(TestCase):
         self.assertNotEqual(data_sent[user.id], t)
 
 
+class MemberCategoryRanksTests(TestCase):
+    def setUp(self):
+        self.beer = Category.objects.create(name="Øl")
+        self.soda = Category.objects.create(name="Sodavand")
+        self.pilsner = Product.objects.create(name="Pilsner", price=600, active=True)
+        self.pilsner.categories.add(self.beer)
+        self.cola = Product.objects.create(name="Cola", price=400, active=True)
+        self.cola.categories.add(self.soda)
+        self.room = Room.objects.create(name="rankroom")
+        self.members = [
+            Member.objects.create(phone_number=phone_number, email=f"{phone_number}@example.com")
+            for phone_number in ("b", "a", "c")
+        ]
+        self.from_time = timezone.now() - datetime.timedelta(days=1)
+        self.to_time = timezone.now() + datetime.timedelta(days=1)
+
+    def sell(self, member, product, count):
+        for _ in range(count):
+            Sale.objects.create(member=member, product=product, price=product.price)
+
+    def test_ranks_by_count_then_phone_number(self):
+        b, a, c = self.members
+        self.sell(b, self.pilsner, 2)
+        self.sell(a, self.pilsner, 2)
+        self.sell(c, self.pilsner, 3)
+        self.sell(a, self.cola, 1)
+
+        self.assertEqual(
+            c.category_ranks(self.from_time, self.to_time), {self.beer.id: (1, 3, 3), self.soda.id: (0, 1, 0)}
+        )
+        self.assertEqual(a.category_ranks(self.from_time, self.to_time)[self.beer.id], (2, 3, 2))
+        self.assertEqual(b.category_ranks(self.from_time, self.to_time)[self.beer.id], (3, 3, 2))
+        self.assertEqual(a.category_ranks(self.from_time, self.to_time)[self.soda.id], (1, 1, 1))
+        self.assertEqual(b.category_ranks(self.from_time, self.to_time)[self.soda.id], (0, 1, 0))
+
+    def test_ranks_without_window_functions(self):
+        b, a, c = self.members
+        self.sell(b, self.pilsner, 2)
+        self.sell(a, self.pilsner, 2)
+        self.sell(c, self.cola, 3)
+        expected = {member: member.category_ranks(self.from_time, self.to_time) for member in self.members}
+
+        with patch.object(connection.features, 'supports_over_clause', False):
+            for member in self.members:
+                self.assertEqual(member.category_ranks(self.from_time, self.to_time), expected[member])
+
+    def test_ranks_only_count_the_period(self):
+        b, a, c = self.members
+        with freeze_time(self.from_time - datetime.timedelta(days=1)):
+            self.sell(b, self.pilsner, 2)
+        self.sell(a, self.pilsner, 1)
+
+        self.assertEqual(b.category_ranks(self.from_time, self.to_time), {self.beer.id: (0, 1, 0)})
+
+    def test_userrank_queries_independent_of_categories(self):
+        b, a, c = self.members
+        self.sell(b, self.pilsner, 1)
+        url = reverse('userrank', args=(self.room.name, b.id))
+        self.client.get(url)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        for i in range(10):
+            product = Product.objects.create(name=f"Product {i}", price=100, active=True)
+            product.categories.add(Category.objects.create(name=f"Category {i}"))
+            self.sell(a, product, 1)
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get(url)
+
+        self.assertEqual(len(response.context['rankings']), 12)
+        self.assertEqual(response.context['rankings'][self.beer][0], (1, 1))
+        self.assertNotEqual(response.context['rankings'][self.beer][1], 0)
+        self.assertEqual(response.context['rankings'][self.soda], ((0, 0), 0))
+
+
 class BallmerPeakTests(TestCase):
     def test_close_to_maximum(self):
         bac = 1.337 + 0.049
@@ -951,6 +1863,71 @@ class MemberAdminTests(TestCase):
         self.assertEqual(1, len(messages))
         self.assertEqual("+4533334444", Member.objects.filter(pk=2).get().phone_number)
 
+    def test_save_keeps_concurrent_balance_changes(self):
+        self.client.login(username="superuser", password="very_secure")
+        shown = model_to_dict(self.jeff2)
+        # A purchase while the admin has the member open
+        ledger.apply(self.jeff2.id, -500)
+
+        shown['full_name'] = "jeff jeffersen"
+        self.client.post(
+            reverse('admin:stregsystem_member_change', kwargs={'object_id': 2}),
+            {**shown, 'initial-balance': shown['balance']},
+        )
+
+        jeff2 = Member.objects.get(pk=2)
+        self.assertEqual(jeff2.full_name, "jeff jeffersen")
+        self.assertEqual(jeff2.balance, -500)
+
+    def test_balance_edit_is_applied_as_a_change(self):
+        self.client.login(username="superuser", password="very_secure")
+        shown = model_to_dict(self.jeff2)
+        ledger.apply(self.jeff2.id, -500)
+
+        self.client.post(
+            reverse('admin:stregsystem_member_change', kwargs={'object_id': 2}),
+            {**shown, 'balance': shown['balance'] + 1000, 'initial-balance': shown['balance']},
+        )
+
+        self.assertEqual(Member.objects.get(pk=2).balance, 500)
+
+    def test_change_form_shows_initial_balance(self):
+        self.client.login(username="superuser", password="very_secure")
+
+        response = self.client.get(reverse('admin:stregsystem_member_change', kwargs={'object_id': 2}))
+
+        self.assertContains(response, 'name="initial-balance"')
+
+
+class SaleAdminTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('superuser', 'test@example.com', "hunter2")
+        self.client.login(username="superuser", password="hunter2")
+        self.member = Member.objects.create(phone_number="+4522222222", balance=100)
+        self.product = Product.objects.create(name="øl", price=600, active=True)
+        self.room = Room.objects.create(name="adminroom")
+
+    def test_added_sale_may_overdraw(self):
+        response = self.client.post(
+            reverse('admin:stregsystem_sale_add'),
+            {'member': self.member.id, 'product': self.product.id, 'room': self.room.id, 'price': 600},
+        )
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, -500)
+        self.assertEqual(Sale.objects.filter(member=self.member).count(), 1)
+
+    def test_deleting_selected_sales_refunds_them(self):
+        sales = [Sale.objects.create(member=self.member, product=self.product, price=600) for _ in range(2)]
+
+        self.client.post(
+            reverse('admin:stregsystem_sale_changelist'),
+            {'action': 'delete_selected', '_selected_action': [sale.id for sale in sales], 'post': 'yes'},
+        )
+
+        self.assertFalse(Sale.objects.exists())
+        self.assertEqual(Member.objects.get(id=self.member.id).balance, 1300)
+
 
 class ProductActivatedListFilterTests(TestCase):
     def setUp(self):
@@ -1326,6 +2303,41 @@ class MobilePaymentTests(TestCase):
         # mobilepayment count should remain unchanged
         self.assertEqual(MobilePayment.objects.count(), 6)
 
+    def csv_lines(self, comments, first_id=0):
+        header = "Dato;Navn;Beløb;Tidspunkt;Kunde;Tlf;Besked;Transaktions-ID"
+        return [header] + [
+            f"2019-11-30;F-Klubben;50,00;2019-11-30T12:00:00+01:00;Kunde;;{comment};TX{first_id + i}"
+            for i, comment in enumerate(comments)
+        ]
+
+    def test_csv_import_queries_independent_of_rows(self):
+        from stregsystem.utils import parse_csv_and_create_mobile_payments
+
+        # Small enough for a single insert on SQLite, which limits the number of parameters of a query
+        lines = self.csv_lines(["jdoe", "marx", "nobody"] * 33)
+        with self.assertNumQueries(3):
+            self.assertEqual(parse_csv_and_create_mobile_payments(lines), (99, 0))
+        self.assertEqual(parse_csv_and_create_mobile_payments(lines), (0, 99))
+
+        imported = MobilePayment.objects.filter(transaction_id__startswith="TX")
+        self.assertEqual(imported.get(transaction_id="TX1").amount, 5000)
+        self.assertEqual(imported.filter(member__phone_number="marx").count(), 33)
+        self.assertEqual(imported.filter(member=None).count(), 33)
+
+    def test_csv_import_duplicates_within_file(self):
+        from stregsystem.utils import parse_csv_and_create_mobile_payments
+
+        lines = self.csv_lines(["jdoe"])
+        self.assertEqual(parse_csv_and_create_mobile_payments(lines + lines[1:]), (1, 1))
+
+    def test_csv_import_matches_case_insensitively(self):
+        from stregsystem.utils import parse_csv_and_create_mobile_payments
+
+        parse_csv_and_create_mobile_payments(self.csv_lines([" JDoe ", "jdoe indbetaling"]))
+
+        self.assertEqual(MobilePayment.objects.get(transaction_id="TX0").member.phone_number, "jdoe")
+        self.assertIsNone(MobilePayment.objects.get(transaction_id="TX1").member)
+
     def test_member_exact_matching(self):
         for matched_member in MobilePayment.objects.filter(member__isnull=False):
             self.assertEqual(matched_member.member, Member.objects.get(pk=matched_member.member.pk))
@@ -1526,6 +2538,96 @@ class MobilePaymentTests(TestCase):
                 self.assertEqual(e.inconsistent_transaction_ids, ["241E027449465355", "016E027417049990"])
                 raise e
 
+    def test_autopayment_without_bulk_insert_returning(self):
+        with without_bulk_insert_returning():
+            MobilePayment.approve_member_filled_mobile_payments()
+            submitted = MobilePayment.submit_processed_mobile_payments(self.autopayment_user)
+
+        approved = MobilePayment.objects.filter(status=MobilePayment.APPROVED)
+        self.assertEqual(approved.count(), submitted)
+        self.assertFalse(approved.filter(payment__isnull=True).exists())
+        self.assertEqual(
+            set(LogEntry.objects.filter(content_type__model='payment').values_list('object_id', flat=True)),
+            {str(mp.payment_id) for mp in approved},
+        )
+
+    def test_mobilepaytool_submission_without_bulk_insert_returning(self):
+        form_data = deepcopy(self.fixture_form_data_marx_jdoe_approved)
+        form_data[3]['member'] = Member.objects.get(phone_number="marx")
+        form_data[4]['member'] = Member.objects.get(phone_number="jdoe")
+
+        with without_bulk_insert_returning():
+            self.assertEqual(MobilePayment.process_submitted_mobile_payments(form_data, self.super_user), 2)
+
+        for transaction_id, amount in (("241E027449465355", 20000), ("016E027417049990", 15000)):
+            self.assertEqual(MobilePayment.objects.get(transaction_id=transaction_id).payment.amount, amount)
+
+    def test_mobilepaytool_ignoring_queries_independent_of_rows(self):
+        member = Member.objects.get(phone_number="marx")
+
+        def ignore(count):
+            form_data = []
+            for _ in range(count):
+                mobile_payment = MobilePayment.objects.create(
+                    member=member,
+                    amount=100,
+                    comment="marx",
+                    timestamp=timezone.now(),
+                    transaction_id=f"ignored{MobilePayment.objects.count()}",
+                )
+                form_data.append({'id': mobile_payment, 'member': member, 'status': MobilePayment.IGNORED})
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(MobilePayment.process_submitted_mobile_payments(form_data, self.super_user), count)
+            return len(queries.captured_queries)
+
+        # The first submission looks up the content types of the log entries
+        ignore(1)
+        self.assertEqual(ignore(1), ignore(10))
+
+    @patch('stregsystem.models.send_payment_mail')
+    def test_mobilepaytool_submission(self, send_payment_mail):
+        form_data = deepcopy(self.fixture_form_data_marx_jdoe_approved)
+        # A cleaned form has the members themselves
+        form_data[3]['member'] = Member.objects.get(phone_number="marx")
+        form_data[4]['member'] = Member.objects.get(phone_number="jdoe")
+        form_data[1]['status'] = MobilePayment.IGNORED
+        form_data[2]['status'] = MobilePayment.APPROVED
+        form_data[2]['member'] = Member.objects.get(phone_number="tables")
+
+        self.assertEqual(MobilePayment.process_submitted_mobile_payments(form_data, self.super_user), 4)
+
+        for phone_number, amount in (("marx", 20000), ("jdoe", 15000), ("tables", 50000)):
+            self.assertEqual(
+                Member.objects.get(phone_number=phone_number).balance, self.members[phone_number]['balance'] + amount
+            )
+        tables_payment = MobilePayment.objects.get(transaction_id="232E027452733676")
+        self.assertEqual(tables_payment.status, MobilePayment.APPROVED)
+        self.assertEqual(tables_payment.member.phone_number, "tables")
+        self.assertEqual(tables_payment.payment.amount, 50000)
+        ignored = MobilePayment.objects.get(transaction_id="232E027452733666")
+        self.assertEqual(ignored.status, MobilePayment.IGNORED)
+        self.assertIsNone(ignored.payment)
+
+        # The receipts quote what was written, as they did when the payments were saved one by one
+        self.assertCountEqual(
+            [(call.args[0].phone_number, call.args[2]) for call in send_payment_mail.call_args_list],
+            [("marx", "marx"), ("jdoe", "jdoe"), ("tables", "tables eksdee")],
+        )
+        self.assertEqual(
+            Counter(LogEntry.objects.filter(user=self.super_user).values_list('change_message', flat=True)),
+            Counter(
+                {
+                    "Approved": 3,
+                    "Ignored": 1,
+                    "MobilePayment (transaction_id: 241E027449465355)": 1,
+                    "MobilePayment (transaction_id: 016E027417049990)": 1,
+                    "MobilePayment (transaction_id: 232E027452733676)": 1,
+                }
+            ),
+        )
+        payment_log = LogEntry.objects.get(change_message="MobilePayment (transaction_id: 232E027452733676)")
+        self.assertEqual(payment_log.object_id, str(tables_payment.payment.id))
+
 
 class AutoPaymentTests(TestCase):
     def setUp(self):
@@ -1596,6 +2698,102 @@ class AutoPaymentTests(TestCase):
         approved = MobilePayment.objects.get(transaction_id='156E027485173229')
         self.assertEqual(approved.status, MobilePayment.APPROVED)
 
+    def create_mobile_payment(self, transaction_id, amount=5000):
+        return MobilePayment.objects.create(
+            amount=amount,
+            comment='tester',
+            timestamp=timezone.now(),
+            transaction_id=transaction_id,
+            member=mobile_payment_exact_match_member('tester'),
+        )
+
+    def test_approve_in_one_update(self):
+        self.create_mobile_payment('1')
+        self.create_mobile_payment('2')
+        self.create_mobile_payment('3', amount=4999)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(MobilePayment.approve_member_filled_mobile_payments(), 2)
+
+    def test_submit_queries_independent_of_mobile_payments(self):
+        for i in range(3):
+            self.create_mobile_payment(f'few{i}')
+        MobilePayment.approve_member_filled_mobile_payments()
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(MobilePayment.submit_processed_mobile_payments(self.autopayment_user), 3)
+
+        for i in range(30):
+            self.create_mobile_payment(f'many{i}')
+        MobilePayment.approve_member_filled_mobile_payments()
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(MobilePayment.submit_processed_mobile_payments(self.autopayment_user), 30)
+
+        self.assertEqual(len(few.captured_queries), len(many.captured_queries))
+        self.assertEqual(Member.objects.get(phone_number='tester').balance, 178 + 33 * 5000)
+        self.assertFalse(MobilePayment.objects.filter(status=MobilePayment.APPROVED, payment__isnull=True).exists())
+        self.assertEqual(LogEntry.objects.filter(user=self.autopayment_user).count(), 33)
+
+    @patch('stregsystem.management.commands.autopayment.close_old_connections')
+    @patch('stregsystem.management.commands.autopayment.call_command')
+    def test_loop_cycle_submits_unprocessed_mobile_payments(self, call_command, close_old_connections):
+        from stregsystem.management.commands.autopayment import Command
+
+        out = io.StringIO()
+        command = Command(stdout=out)
+        command.verbosity = 1
+        first = self.create_mobile_payment('1')
+        second = self.create_mobile_payment('2')
+
+        self.assertEqual(command.cycle(self.autopayment_user), 2)
+
+        close_old_connections.assert_called_once_with()
+        call_command.assert_called_once_with('importmobilepaypayments', 0)
+        self.assertIsNotNone(MobilePayment.objects.get(id=first.id).payment)
+        self.assertIsNotNone(MobilePayment.objects.get(id=second.id).payment)
+        self.assertEqual(Member.objects.get(phone_number='tester').balance, 178 + 2 * 5000)
+        self.assertIn("2 mobilepayments approved, 2 submitted", out.getvalue())
+
+        # Nothing new, nothing to report
+        self.assertEqual(command.cycle(self.autopayment_user), 0)
+        self.assertEqual(out.getvalue().count("Cycle took"), 1)
+
+        # A mobile payment committed late, after one with a higher id was submitted, is still found
+        late = self.create_mobile_payment('0')
+        MobilePayment.objects.filter(id=late.id).update(id=first.id - 1)
+        self.assertEqual(command.cycle(self.autopayment_user), 1)
+        self.assertIsNotNone(MobilePayment.objects.get(id=first.id - 1).payment)
+
+    @patch('stregsystem.management.commands.autopayment.close_old_connections')
+    @patch('stregsystem.management.commands.autopayment.call_command')
+    def test_loop_cycle_leaves_ignored_mobile_payments_alone(self, call_command, close_old_connections):
+        from stregsystem.management.commands.autopayment import Command
+
+        command = Command(stdout=io.StringIO())
+        command.verbosity = 1
+        ignored = self.create_mobile_payment('1')
+        MobilePayment.objects.filter(id=ignored.id).update(status=MobilePayment.IGNORED)
+
+        for _ in range(3):
+            self.assertEqual(command.cycle(self.autopayment_user), 0)
+
+        self.assertIsNone(MobilePayment.objects.get(id=ignored.id).payment)
+        self.assertFalse(LogEntry.objects.filter(user=self.autopayment_user).exists())
+
+    @patch('stregsystem.management.commands.autopayment.time')
+    def test_loop_imports_past_days_once_an_hour(self, time):
+        from stregsystem.management.commands.autopayment import Command
+
+        class StopLoop(Exception):
+            pass
+
+        time.monotonic.side_effect = [0, 10, 3600, 3600]
+        time.sleep.side_effect = [None, None, StopLoop]
+        command = Command(stdout=io.StringIO())
+        with patch.object(Command, 'cycle') as cycle, self.assertRaises(StopLoop):
+            command.run_loop(10)
+
+        self.assertEqual([call.args[1] for call in cycle.call_args_list], [None, 0, None])
+
 
 class CaffeineCalculatorTest(TestCase):
     def test_default_caffeine_is_zero(self):
@@ -1753,6 +2951,61 @@ class CaffeineCalculatorTest(TestCase):
         self.assertTrue(coffee_addict.is_leading_coffee_addict())
         self.assertFalse(average_developer.is_leading_coffee_addict())
 
+    def test_coffee_master_from_order(self):
+        cache.clear()
+        coffee_addict = Member.objects.create(phone_number="+4544443333", gender="M", balance=100)
+        average_developer = Member.objects.create(phone_number="+4533334444", gender="M", balance=50)
+        room = Room.objects.create(name="room")
+        coffee_category = Category.objects.create(name="Caffeine☕☕☕", pk=6)
+        coffee = Product.objects.create(name="Kaffe☕☕☕", price=1, caffeine_content_mg=70, active=True)
+        coffee.categories.add(coffee_category)
+
+        Order.from_products(average_developer, room, [coffee] * 2).execute()
+        Order.from_products(coffee_addict, room, [coffee] * 3).execute()
+
+        self.assertTrue(coffee_addict.is_leading_coffee_addict())
+        self.assertFalse(average_developer.is_leading_coffee_addict())
+
+    @override_settings(COFFEE_CATEGORY_ID=42)
+    def test_coffee_category_is_configurable(self):
+        cache.clear()
+        coffee_addict = Member.objects.create(phone_number="+4544443333", gender="M", balance=100)
+        coffee_category = Category.objects.create(name="Kaffe", pk=42)
+        coffee = Product.objects.create(name="Kaffe☕☕☕", price=1, caffeine_content_mg=70, active=True)
+        coffee.categories.add(coffee_category)
+
+        coffee_addict.sale_set.create(product=coffee, price=coffee.price)
+
+        self.assertTrue(coffee_addict.is_leading_coffee_addict())
+
+    def test_coffee_master_is_cached(self):
+        cache.clear()
+        coffee_addict = Member.objects.create(phone_number="+4544443333", gender="M", balance=100)
+        coffee_category = Category.objects.create(name="Caffeine☕☕☕", pk=6)
+        coffee = Product.objects.create(name="Kaffe☕☕☕", price=1, caffeine_content_mg=70, active=True)
+        coffee.categories.add(coffee_category)
+        coffee_addict.sale_set.create(product=coffee, price=coffee.price)
+        coffee_addict.is_leading_coffee_addict()
+
+        with self.assertNumQueries(0):
+            self.assertTrue(coffee_addict.is_leading_coffee_addict())
+
+    def test_coffee_master_lost_on_refund(self):
+        cache.clear()
+        coffee_addict = Member.objects.create(phone_number="+4544443333", gender="M", balance=100)
+        average_developer = Member.objects.create(phone_number="+4533334444", gender="M", balance=50)
+        coffee_category = Category.objects.create(name="Caffeine☕☕☕", pk=6)
+        coffee = Product.objects.create(name="Kaffe☕☕☕", price=1, caffeine_content_mg=70, active=True)
+        coffee.categories.add(coffee_category)
+        [coffee_addict.sale_set.create(product=coffee, price=coffee.price) for _ in range(2)]
+        average_developer.sale_set.create(product=coffee, price=coffee.price)
+        self.assertTrue(coffee_addict.is_leading_coffee_addict())
+
+        admin.refund(None, None, coffee_addict.sale_set.all())
+
+        self.assertFalse(coffee_addict.is_leading_coffee_addict())
+        self.assertTrue(average_developer.is_leading_coffee_addict())
+
     def test_if_sunday_is_in_week(self):
         coffee_addict = Member.objects.create(phone_number="+4533334444", gender="F", balance=100)
         average_developer = Member.objects.create(phone_number="my-gal", gender="F", balance=50)
@@ -1773,3 +3026,474 @@ class CaffeineCalculatorTest(TestCase):
 
             self.assertTrue(coffee_addict.is_leading_coffee_addict())
             self.assertFalse(average_developer.is_leading_coffee_addict())
+
+
+class GenerateDataTests(TestCase):
+    def test_generated_balances_match_payments_and_sales(self):
+        call_command('generatedata', members=20, products=10, sales=500, years=1, random_seed=42, stdout=io.StringIO())
+
+        self.assertEqual(Member.objects.count(), 20)
+        self.assertEqual(Sale.objects.count(), 500)
+        for member in Member.objects.all():
+            deposited = sum(member.payment_set.values_list('amount', flat=True))
+            spent = sum(member.sale_set.values_list('price', flat=True))
+            self.assertEqual(member.balance, deposited - spent)
+            self.assertGreaterEqual(member.balance, 0)
+
+    def test_generated_sales_spread_over_the_years(self):
+        call_command('generatedata', members=5, products=5, sales=200, years=2, random_seed=42, stdout=io.StringIO())
+
+        first_sale = Sale.objects.order_by('timestamp').first().timestamp
+        last_sale = Sale.objects.order_by('timestamp').last().timestamp
+        self.assertGreater(last_sale - first_sale, datetime.timedelta(days=365))
+        self.assertLessEqual(last_sale, timezone.now())
+
+    def test_generated_sales_are_rolled_up(self):
+        call_command('generatedata', members=5, products=5, sales=200, years=1, random_seed=42, stdout=io.StringIO())
+
+        self.assertEqual(DailySales.objects.aggregate(Sum('count'))['count__sum'], 200)
+        self.assertEqual(
+            DailySales.objects.aggregate(Sum('revenue'))['revenue__sum'],
+            Sale.objects.aggregate(Sum('price'))['price__sum'],
+        )
+
+    def test_generates_without_bulk_insert_returning(self):
+        with without_bulk_insert_returning():
+            call_command('generatedata', members=5, products=5, sales=50, years=1, random_seed=42, stdout=io.StringIO())
+
+        self.assertEqual(Member.objects.count(), 5)
+        self.assertFalse(Product.objects.filter(categories=None).exists())
+        self.assertTrue(MobilePayment.objects.filter(payment__isnull=False).exists())
+
+    @override_settings(DEBUG=True)
+    def test_loadtest_in_process_has_no_errors(self):
+        call_command('generatedata', members=20, products=5, sales=50, years=1, random_seed=42, stdout=io.StringIO())
+        out = io.StringIO()
+
+        call_command('loadtest', requests=30, random_seed=42, stdout=out, stderr=io.StringIO())
+
+        rows = [line.split() for line in out.getvalue().splitlines()[1:]]
+        self.assertEqual({row[0] for row in rows}, {"quickbuy", "menu_sale", "api_sale"})
+        self.assertEqual([row[-1] for row in rows], ["0", "0", "0"])
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 stub")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO", "RSET"):
+                self.reply("250 ok")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 ok")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[1].strip("<> ")
+                if address in self.server.refused:
+                    self.reply("550 no such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 ok")
+            elif verb == "DATA":
+                self.reply("354 go ahead")
+                data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                self.server.messages.append((recipients, data))
+                self.reply("250 ok")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.refused = set()
+
+
+class OutgoingMailTests(TestCase):
+    def setUp(self):
+        self.server = StubSMTPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        settings = override_settings(EMAIL_HOST="127.0.0.1", EMAIL_PORT=self.server.server_address[1])
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def create_member(self, name):
+        return Member.objects.create(phone_number=name, full_name=name, email=f"{name}@example.com")
+
+    def send(self, **options):
+        out = io.StringIO()
+        call_command('sendmail', stdout=out, **options)
+        return out.getvalue()
+
+    def test_mail_is_queued_with_the_transaction(self):
+        member = self.create_member("jokke")
+        OutgoingMail.objects.all().delete()
+
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Payment(member=member, amount=10000).save()
+                raise RuntimeError
+        self.assertFalse(OutgoingMail.objects.exists())
+
+        Payment(member=member, amount=10000).save()
+        self.assertEqual(list(OutgoingMail.objects.values_list('recipient', flat=True)), ["jokke@example.com"])
+        self.assertEqual(self.server.connections, 0)
+
+    def test_no_mail_without_address(self):
+        Member.objects.create(phone_number="nomail", email="")
+
+        self.assertFalse(OutgoingMail.objects.exists())
+
+    def test_batch_is_sent_over_one_connection(self):
+        for name in ("a", "b", "c"):
+            self.create_member(name)
+
+        self.assertIn("Sent 3 mails, 0 failed", self.send())
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            sorted(recipients for recipients, _ in self.server.messages),
+            [["a@example.com"], ["b@example.com"], ["c@example.com"]],
+        )
+        self.assertFalse(OutgoingMail.objects.filter(sent=None).exists())
+        self.assertIn("Sent 0 mails", self.send())
+
+    def test_batches(self):
+        for name in ("a", "b", "c"):
+            self.create_member(name)
+
+        self.send(batch_size=2)
+
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 3)
+
+    def test_refused_mail_is_retried_with_backoff(self):
+        self.create_member("a")
+        self.create_member("b")
+        self.server.refused.add("b@example.com")
+
+        self.assertIn("Sent 1 mails, 1 failed", self.send())
+        failed = OutgoingMail.objects.get(recipient="b@example.com")
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn("no such user", failed.last_error)
+        self.assertGreater(failed.next_attempt, timezone.now() + datetime.timedelta(seconds=50))
+
+        self.server.refused.clear()
+        self.send()
+        self.assertEqual(len(self.server.messages), 1)
+        with freeze_time(timezone.now() + datetime.timedelta(minutes=2)):
+            self.send()
+        self.assertEqual([recipients for recipients, _ in self.server.messages], [["a@example.com"], ["b@example.com"]])
+
+    def test_gives_up_after_max_attempts(self):
+        self.create_member("a")
+        self.server.refused.add("a@example.com")
+
+        now = timezone.now()
+        for attempt in range(3):
+            with freeze_time(now + datetime.timedelta(days=attempt)):
+                self.send(max_attempts=2)
+
+        mail = OutgoingMail.objects.get()
+        self.assertEqual(mail.attempts, 2)
+        self.assertIsNone(mail.sent)
+
+    def test_unreachable_server(self):
+        self.create_member("a")
+        self.server.shutdown()
+        self.server.server_close()
+
+        self.assertIn("Sent 0 mails, 1 failed", self.send())
+        self.assertEqual(OutgoingMail.objects.get().attempts, 1)
+
+
+class StubReportAPIHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open, like the real API
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        self.server.clients.add(self.client_address)
+        path, _, query = self.path.partition("?")
+        if path.endswith("/funds/feed"):
+            # The cursor is the number of the next page
+            cursor = urllib.parse.parse_qs(query, keep_blank_values=True)['cursor'][0]
+            if cursor in self.server.failing_cursors:
+                self.server.failing_cursors.remove(cursor)
+                self.reply({}, status=500)
+                return
+            page = int(cursor or 0)
+            items = self.server.feed[page] if page < len(self.server.feed) else []
+            body = {'items': items, 'cursor': str(page + 1) if items else cursor, 'tryLater': "false"}
+        elif path.endswith("/settlement/v1/ledgers"):
+            body = {'items': [{'ledgerId': "1"}]}
+        else:
+            body = {'items': self.server.days.get(path.rsplit("/", 1)[1], [])}
+        self.reply(body)
+
+    def do_POST(self):
+        self.server.paths.append(self.path)
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.reply({'access_token': f"token{len(self.server.paths)}", 'expires_in': 3600})
+
+    def reply(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubReportAPIServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubReportAPIHandler)
+        self.paths = []
+        self.clients = set()
+        self.feed = []
+        self.failing_cursors = set()
+        self.days = {}
+
+
+class ExclusiveFileLockTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "vipps-tokens.json.lock")
+
+    def test_locks_with_msvcrt_without_fcntl(self):
+        # Loads a copy of vipps_api like on Windows, where there's msvcrt instead of fcntl
+        msvcrt = Mock(LK_LOCK=1, LK_UNLCK=0)
+        spec = importlib.util.spec_from_file_location("windows_vipps_api", vipps_api.__file__)
+        windows_vipps_api = importlib.util.module_from_spec(spec)
+        with patch.dict(sys.modules, {'fcntl': None, 'msvcrt': msvcrt}):
+            spec.loader.exec_module(windows_vipps_api)
+
+        with windows_vipps_api.exclusive_file_lock(self.path):
+            msvcrt.locking.assert_called_once_with(ANY, msvcrt.LK_LOCK, 1)
+        msvcrt.locking.assert_called_with(ANY, msvcrt.LK_UNLCK, 1)
+
+    def test_lock_is_exclusive(self):
+        locked = threading.Event()
+        release = threading.Event()
+        acquired = []
+
+        def hold():
+            with vipps_api.exclusive_file_lock(self.path):
+                locked.set()
+                release.wait()
+
+        def wait():
+            # A separate open file, like another process would have
+            with vipps_api.exclusive_file_lock(self.path):
+                acquired.append(release.is_set())
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        locked.wait()
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        waiter.join(0.2)
+        release.set()
+        holder.join()
+        waiter.join()
+
+        self.assertEqual(acquired, [True])
+
+
+class ImportMobilePayPaymentsTests(TestCase):
+    def setUp(self):
+        self.server = StubReportAPIServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        # The lock file and the temporary files go next to the token file
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.tokens_file = os.path.join(directory.name, "vipps-tokens.json")
+        self.write_tokens(access_token="token", access_token_timeout=self.expires(hours=1), ledger_id=1)
+        for name, value in (
+            ('api_endpoint', f"http://127.0.0.1:{self.server.server_address[1]}"),
+            ('tokens_file', self.tokens_file),
+            ('tokens', None),
+            ('_session', None),
+        ):
+            patcher = patch.object(AccountingAPI, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.member = Member.objects.create(phone_number="topper", full_name="Jakob Topper")
+        self.today = datetime.date.today()
+
+    def expires(self, **delta):
+        return (datetime.datetime.now() + datetime.timedelta(**delta)).isoformat(timespec='milliseconds')
+
+    def write_tokens(self, **tokens):
+        with open(self.tokens_file, "w") as tokens_file:
+            json.dump(tokens, tokens_file)
+
+    def read_tokens(self):
+        with open(self.tokens_file) as tokens_file:
+            return json.load(tokens_file)
+
+    def transaction(self, reference, day, message="Topper", entry_type="capture"):
+        return {
+            'pspReference': reference,
+            'time': f"{day.isoformat()}T07:19:26.528092Z",
+            'ledgerDate': day.isoformat(),
+            'entryType': entry_type,
+            'currency': "DKK",
+            'amount': 20000,
+            'name': "Jakob Topper",
+            'message': message,
+        }
+
+    def fetched_days(self):
+        return {path.split("?")[0].rsplit("/", 1)[1] for path in self.server.paths if "/funds/dates/" in path}
+
+    def test_imports_feed_and_past_days(self):
+        yesterday = self.today - datetime.timedelta(days=1)
+        self.server.feed = [[self.transaction("1", self.today)]]
+        self.server.days = {
+            yesterday.isoformat(): [
+                self.transaction("2", yesterday, "nobody"),
+                self.transaction("3", yesterday, entry_type="payout"),
+            ],
+            self.today.isoformat(): [self.transaction("1", self.today)],
+        }
+
+        call_command('importmobilepaypayments', 5)
+
+        self.assertEqual(self.fetched_days(), {(self.today - datetime.timedelta(days=i)).isoformat() for i in range(5)})
+        self.assertEqual(MobilePayment.objects.get(transaction_id="1").member, self.member)
+        self.assertIsNone(MobilePayment.objects.get(transaction_id="2").member)
+        self.assertEqual(MobilePayment.objects.count(), 2)
+        # The days are fetched over a handful of pooled connections
+        self.assertLess(len(self.server.clients), len(self.server.paths))
+
+    def test_complete_days_are_not_fetched_again(self):
+        call_command('importmobilepaypayments', 5)
+        self.assertEqual(ImportedLedgerDate.objects.count(), 2)
+
+        self.server.paths.clear()
+        call_command('importmobilepaypayments', 5)
+
+        self.assertEqual(self.fetched_days(), {(self.today - datetime.timedelta(days=i)).isoformat() for i in range(3)})
+
+    def test_late_payments_of_yesterday_are_imported(self):
+        yesterday = self.today - datetime.timedelta(days=1)
+        call_command('importmobilepaypayments', 2)
+        self.assertFalse(ImportedLedgerDate.objects.exists())
+
+        self.server.days = {yesterday.isoformat(): [self.transaction("1", yesterday)]}
+        call_command('importmobilepaypayments', 2)
+
+        self.assertIn(yesterday.isoformat(), self.fetched_days())
+        self.assertEqual(MobilePayment.objects.get(transaction_id="1").member, self.member)
+
+    def test_zero_days_back_only_reads_the_feed(self):
+        self.server.feed = [[self.transaction("1", self.today)]]
+
+        call_command('importmobilepaypayments', 0)
+
+        self.assertEqual(self.fetched_days(), set())
+        self.assertEqual(MobilePayment.objects.get(transaction_id="1").member, self.member)
+        self.assertFalse(ImportedLedgerDate.objects.exists())
+
+    def test_known_transactions_are_skipped(self):
+        self.server.days = {self.today.isoformat(): [self.transaction("1", self.today)]}
+        call_command('importmobilepaypayments', 1)
+        self.server.feed = [[self.transaction("1", self.today)]]
+
+        # The members, and the imported days and the known transaction ids of both the feed and the past day
+        with self.assertNumQueries(4):
+            call_command('importmobilepaypayments', 1)
+
+        self.assertEqual(MobilePayment.objects.count(), 1)
+
+    def test_valid_token_is_kept_in_memory(self):
+        call_command('importmobilepaypayments', 1)
+        self.assertEqual(self.read_tokens()['cursor'], "")
+        inode = os.stat(self.tokens_file).st_ino
+
+        call_command('importmobilepaypayments', 1)
+
+        # Neither the token nor the cursor changed, so the token file wasn't replaced
+        self.assertEqual(os.stat(self.tokens_file).st_ino, inode)
+        self.assertNotIn("/miami/v1/token", self.server.paths)
+
+    def test_expired_token_is_refreshed_and_saved(self):
+        self.write_tokens(
+            client_id="id", client_secret="secret", access_token="old", access_token_timeout=self.expires(hours=-1)
+        )
+
+        call_command('importmobilepaypayments', 1)
+        call_command('importmobilepaypayments', 1)
+
+        self.assertEqual(self.server.paths.count("/miami/v1/token"), 1)
+        tokens = self.read_tokens()
+        self.assertEqual(tokens['client_id'], "id")
+        self.assertEqual(tokens['access_token'], "token1")
+        self.assertEqual(tokens['ledger_id'], 1)
+        # No temporary files are left behind
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(self.tokens_file))), ["vipps-tokens.json", "vipps-tokens.json.lock"]
+        )
+
+    def test_token_refreshed_by_another_process_is_read(self):
+        AccountingAPI.tokens = {'access_token': "old", 'access_token_timeout': self.expires(hours=-1), 'ledger_id': 1}
+
+        call_command('importmobilepaypayments', 1)
+
+        self.assertNotIn("/miami/v1/token", self.server.paths)
+        self.assertEqual(AccountingAPI.tokens['access_token'], "token")
+
+    def test_feed_cursor_is_saved_after_each_page(self):
+        self.server.feed = [[self.transaction("1", self.today)], [self.transaction("2", self.today)]]
+
+        pages = AccountingAPI.iter_transactions_feed()
+        self.assertEqual([t['pspReference'] for t in next(pages)], ["1"])
+        self.assertNotIn('cursor', self.read_tokens())
+        self.assertEqual([t['pspReference'] for t in next(pages)], ["2"])
+        self.assertEqual(self.read_tokens()['cursor'], "1")
+        self.assertEqual(list(pages), [])
+        self.assertEqual(self.read_tokens()['cursor'], "2")
+
+    def test_feed_resumes_after_failed_page(self):
+        self.server.feed = [[self.transaction("1", self.today)], [self.transaction("2", self.today)]]
+        self.server.failing_cursors.add("1")
+
+        call_command('importmobilepaypayments', 1)
+        self.assertEqual(list(MobilePayment.objects.values_list('transaction_id', flat=True)), ["1"])
+
+        self.server.paths.clear()
+        call_command('importmobilepaypayments', 1)
+
+        self.assertEqual(set(MobilePayment.objects.values_list('transaction_id', flat=True)), {"1", "2"})
+        # The second run starts after the page that was imported
+        feed_paths = [path for path in self.server.paths if "/funds/feed" in path]
+        self.assertIn("cursor=1", feed_paths[0])
@@ -1,13 +1,14 @@
 import logging
 import re
 import csv
+import io
 
 import qrcode
 import qrcode.image.svg
 from django.conf import settings
-from django.core.exceptions import ValidationError
-from django.db.models import Count, F, Q, QuerySet
-from django.http import HttpResponse
+from django.db import connection, transaction
+from django.db.models import F, Q, QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
 from django.test.runner import DiscoverRunner
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
@@ -17,35 +18,19 @@ logger = logging.getLogger(__name__)
 
 def make_active_productlist_query(queryset) -> QuerySet:
     now = timezone.now()
-    # Create a query for the set of products that MIGHT be active. Might
-    # because they can be out of stock. Which we compute later
-    active_candidates = queryset.filter(Q(active=True) & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
-    # This query selects all the candidates that are out of stock.
-    candidates_out_of_stock = (
-        active_candidates.filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
+    # Limited products are out of stock once their bought counter reaches the quantity
+    return queryset.filter(Q(active=True) & (Q(deactivate_date=None) | Q(deactivate_date__gte=now))).exclude(
+        Q(start_date__isnull=False) & Q(bought__gte=F("quantity"))
     )
-    # We can now create a query that selects all the candidates which are not
-    # out of stock.
-    return active_candidates.exclude(Q(start_date__isnull=False) & Q(id__in=candidates_out_of_stock))
 
 
 def make_inactive_productlist_query(queryset) -> QuerySet:
     now = timezone.now()
-    # Create a query of things which are definitively inactive. Some of the ones
-    # filtered here might be out of stock, but we include that later.
-    inactive_candidates = queryset.exclude(
-        Q(active=True) & (Q(deactivate_date=None) | Q(deactivate_date__gte=now))
-    ).values("id")
-    inactive_out_of_stock = (
-        queryset.filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
+    return queryset.exclude(
+        Q(active=True)
+        & (Q(deactivate_date=None) | Q(deactivate_date__gte=now))
+        & (Q(start_date__isnull=True) | Q(bought__lt=F("quantity")))
     )
-    return queryset.filter(Q(id__in=inactive_candidates) | Q(id__in=inactive_out_of_stock))
 
 
 def make_room_specific_query(room) -> QuerySet:
@@ -88,41 +73,104 @@ def date_to_midnight(date):
     return timezone.make_aware(timezone.datetime(date.year, date.month, date.day, 0, 0))
 
 
+def bulk_create_with_ids(model, objs, batch_size=None) -> list:
+    """
+    Inserts new objects like model.objects.bulk_create, and makes sure their ids are set afterwards.
+    bulk_create only sets them on backends that return the rows of a bulk INSERT, like PostgreSQL and SQLite 3.35+.
+    On other backends, like MySQL and older SQLite, the objects are inserted one at a time instead, which returns the
+    id like save does. Like bulk_create it doesn't call save or send the save signals.
+
+    :param model: model of the objects
+    :param objs: new objects, without ids
+    :param batch_size: how many objects to insert per query, if they're inserted in bulk
+    :return: the objects
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs, batch_size=batch_size)
+
+    objs = list(objs)
+    opts = model._meta
+    fields = [field for field in opts.concrete_fields if not field.primary_key]
+    using = model.objects.db
+    with transaction.atomic(using=using, savepoint=False):
+        for obj in objs:
+            (row,) = model._base_manager._insert(
+                [obj], fields=fields, returning_fields=opts.db_returning_fields, using=using
+            )
+            for value, field in zip(row, opts.db_returning_fields):
+                setattr(obj, field.attname, value)
+            obj._state.adding = False
+            obj._state.db = using
+    return objs
+
+
 def parse_csv_and_create_mobile_payments(csv_file):
-    imported_transactions, duplicate_transactions = 0, 0
-    import csv
-
-    # get csv reader and ignore header
-    reader = csv.reader(csv_file[1:], delimiter=';', quotechar='"')
-    for row in reader:
-        from stregsystem.models import MobilePayment
-
-        mobile_payment = MobilePayment(
-            member=None,
-            amount=row[2].replace(',', ''),
-            timestamp=parse_datetime(row[3]),
-            customer_name=row[4],
-            transaction_id=row[7],
-            comment=row[6],
-            payment=None,
+    """
+    Imports the lines of a MobilePay CSV export, skipping the header, and returns the number of imported and duplicate
+    transactions. The known transaction ids are fetched in one query, the comments are matched against an index of the
+    active members, and the new payments are inserted together.
+    """
+    from stregsystem.models import MobilePayment
+
+    rows = list(csv.reader(csv_file[1:], delimiter=';', quotechar='"'))
+    seen = set(
+        MobilePayment.objects.filter(transaction_id__in={row[7] for row in rows}).values_list(
+            'transaction_id', flat=True
+        )
+    )
+    members = active_member_index()
+
+    mobile_payments = []
+    for row in rows:
+        transaction_id = row[7]
+        # The transaction id must be unique, among the imported payments and within the file
+        if transaction_id in seen:
+            continue
+        seen.add(transaction_id)
+        mobile_payments.append(
+            MobilePayment(
+                member_id=match_member_in_index(members, row[6]),
+                amount=int(row[2].replace(',', '')),
+                timestamp=parse_datetime(row[3]),
+                customer_name=row[4],
+                transaction_id=transaction_id,
+                comment=row[6],
+                payment=None,
+            )
         )
-        try:
-            # unique constraint on transaction_id and payment-foreign key must hold before saving new object
-            mobile_payment.validate_unique()
+    MobilePayment.objects.bulk_create(mobile_payments)
+    return len(mobile_payments), len(rows) - len(mobile_payments)
+
+
+def active_member_index():
+    """
+    Returns a dict from the case-folded phone number of every active member to the id of the member, for matching
+    many MobilePayment comments without a query for each. Phone numbers shared by several members map to None.
+    """
+    from stregsystem.models import Member
 
-            # do case insensitive exact match on active members
-            mobile_payment.member = mobile_payment_exact_match_member(mobile_payment.comment)
-            mobile_payment.save()
-            imported_transactions += 1
-        except ValidationError:
-            duplicate_transactions += 1
-    return imported_transactions, duplicate_transactions
+    index = {}
+    for member_id, phone_number in Member.objects.filter(active=True).values_list('id', 'phone_number'):
+        key = phone_number.casefold()
+        index[key] = None if key in index else member_id
+    return index
+
+
+def match_member_in_index(index, comment):
+    """
+    Returns the id of the active member whose phone number is the comment, ignoring case, or None if there is none.
+    """
+    key = comment.strip().casefold()
+    if key in index and index[key] is None:
+        # something is very wrong, there should be no active users which are duplicates post PR #178
+        raise RuntimeError("Duplicate usernames found at MobilePayment import. Should not exist post PR #178")
+    return index.get(key)
 
 
 def mobile_payment_exact_match_member(comment):
     from stregsystem.models import Member
 
-    match = Member.objects.filter(username__iexact=comment.strip(), active=True)
+    match = Member.objects.filter(phone_number__iexact=comment.strip(), active=True)
     if match.count() == 1:
         return match.get()
     elif match.count() > 1:
@@ -164,16 +212,36 @@ class MobilePaytoolException(RuntimeError):
         self.inconsistent_transaction_ids = [x.transaction_id for x in self.racy_mbpayments]
 
 
-class fakefile:
-    data = ""
+class Echo:
+    """
+    A file-like object which hands back what is written to it, so csv.writer can produce one line at a time.
+    """
 
-    def write(self, data):
-        self.data += data
+    def write(self, value):
+        return value
 
 
 # little function to make sure the csv data always has the same format
 def rows_to_csv(rows) -> str:
-    file = fakefile()
+    file = io.StringIO()
     # Converting elements in rows to strings to ensure it can be written to the file object
-    csv.writer(file).writerows([[str(item) for item in row] for row in rows])
-    return file.data
+    csv.writer(file).writerows([str(item) for item in row] for row in rows)
+    return file.getvalue()
+
+
+def stream_csv(rows):
+    """
+    Yields the rows as lines of CSV in the format of rows_to_csv, without holding more than one row in memory.
+    """
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow([str(item) for item in row])
+
+
+def csv_response(filename, rows) -> StreamingHttpResponse:
+    """
+    Streams the rows as a CSV file download. Pass querysets through .iterator(), so they aren't cached either.
+    """
+    response = StreamingHttpResponse(stream_csv(rows), content_type="text/csv")
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
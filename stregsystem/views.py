@@ -16,7 +16,8 @@ from django import forms
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import permission_required
-from django.core import management
+from django.core import management, signing
+from django.db import transaction
 from django.db.models import Q, Count, Sum
 from django.forms import modelformset_factory
 from django.http import HttpResponsePermanentRedirect, HttpResponseBadRequest, JsonResponse
@@ -27,6 +28,7 @@ from django.views.decorators.csrf import csrf_exempt
 from stregreport.views import fjule_party
 
 from stregsystem import parser
+from stregsystem.middleware import InstrumentationMiddleware
 from stregsystem.models import (
     Member,
     Payment,
@@ -43,9 +45,7 @@ from stregsystem.models import (
 )
 from stregsystem.templatetags.stregsystem_extras import money
 from stregsystem.utils import (
-    make_active_productlist_query,
     qr_code,
-    make_room_specific_query,
     make_unprocessed_mobilepayment_query,
     parse_csv_and_create_mobile_payments,
     MobilePaytoolException,
@@ -64,7 +64,7 @@ def __get_news():
 
 
 def __get_productlist(room_id):
-    return make_active_productlist_query(Product.objects).filter(make_room_specific_query(room_id))
+    return Product.active_product_list(room_id)
 
 
 def roomindex(request):
@@ -83,13 +83,14 @@ def index(request, room_name):
 def _pre_process(buy_string):
     items = buy_string.split(' ')
     _items = [items[0]]
+    aliases = NamedProduct.alias_map()
 
     for item in items[1:]:
-        if type(item) is not int:
-            _item = NamedProduct.objects.filter(name=item.split(':')[0].lower() if ':' in item else item)
-            if _item:
-                item = item.replace(item.split(':')[0], str(_item.get().product.pk))
-        _items.append(str(item))
+        name, separator, count = item.partition(':')
+        product_id = aliases.get(name.lower() if separator else name)
+        if product_id is not None:
+            item = str(product_id) + separator + count
+        _items.append(item)
 
     return ' '.join(_items)
 
@@ -130,18 +131,17 @@ def sale(request, room_name):
 def _multibuy_hint(now, member):
     # Get a timestamp to fetch sales for the member for the last 60 sec
     earliest_recent_purchase = now - datetime.timedelta(seconds=60)
-    # get the sales with this timestamp
-    recent_purchases = Sale.objects.filter(member=member, timestamp__gt=earliest_recent_purchase)
-    number_of_recent_distinct_purchases = recent_purchases.values('timestamp').distinct().count()
+    # get the sales with this timestamp, only the columns we need and in a single query
+    recent_purchases = list(
+        Sale.objects.filter(member=member, timestamp__gt=earliest_recent_purchase)
+        .order_by('id')
+        .values_list('timestamp', 'product_id')
+    )
+    number_of_recent_distinct_purchases = len({timestamp for timestamp, _ in recent_purchases})
 
     # add hint for multibuy
     if number_of_recent_distinct_purchases > 1:
-        sale_dict = {}
-        for sale in recent_purchases:
-            if not str(sale.product.id) in sale_dict:
-                sale_dict[str(sale.product.id)] = 1
-            else:
-                sale_dict[str(sale.product.id)] = sale_dict[str(sale.product.id)] + 1
+        sale_dict = Counter(str(product_id) for _, product_id in recent_purchases)
         sale_hints = ["<span class=\"phone_number\">{}</span>".format(member.phone_number)]
         if all(sale_count == 1 for sale_count in sale_dict.values()):
             return (False, None)
@@ -161,10 +161,10 @@ def quicksale(request, room, member: Member, bought_ids):
     now = timezone.now()
 
     # Retrieve products and construct transaction
-    products: List[Product] = []
-    msg, status, result = __append_bought_ids_to_product_list(products, bought_ids, now, room)
+    msg, status, result = _resolve_bought_products(bought_ids, now, room)
     if status == 400:
         return render(request, 'stregsystem/error_productdoesntexist.html', {'failedProduct': result, 'room': room})
+    products: List[Product] = result
 
     order = Order.from_products(member=member, products=products, room=room)
 
@@ -280,35 +280,6 @@ def menu_userrank(request, room_name, member_id):
     room = Room.objects.get(name__iexact=room_name)
     member = Member.objects.get(pk=member_id, active=True)
 
-    def ranking(category_ids, from_d, to_d):
-        qs = (
-            Member.objects.filter(sale__product__in=category_ids, sale__timestamp__gt=from_d, sale__timestamp__lte=to_d)
-            .annotate(Count('sale'))
-            .order_by('-sale__count', 'phone_number')
-        )
-        if member not in qs:
-            return 0, qs.count()
-        return list(qs).index(Member.objects.get(id=member.id)) + 1, int(qs.count())
-
-    def get_product_ids_for_category(category) -> list:
-        return list(
-            Product.objects.filter(categories__exact=Category.objects.get(name__exact=category)).values_list(
-                'id', flat=True
-            )
-        )
-
-    def category_per_uni_day(category_ids, from_d, to_d):
-        qs = Member.objects.filter(
-            id=member.id,
-            sale__product__in=category_ids,
-            sale__timestamp__gt=from_d,
-            sale__timestamp__lte=to_d,
-        )
-        if member not in qs:
-            return 0
-        else:
-            return "{:.2f}".format(qs.count() / ((to_d - from_d).days * 162.14 / 365))  # university workdays in 2021
-
     # let user know when they first purchased a product
     member_first_purchase = "Ikke endnu, køb en limfjordsporter!"
     first_purchase = Sale.objects.filter(member=member_id).order_by('-timestamp')
@@ -325,19 +296,13 @@ def menu_userrank(request, room_name, member_id):
         # setup initial dates for form and results
         form = RankingDateForm(initial={'from_date': from_date, 'to_date': to_date})
 
-    # get prod_ids for each category as dict {cat: [key1, key2])}, then flatten list of singleton
-    # dicts into one dict, lastly calculate member_id rating and units/weekday for category_ids
-    rankings = {
-        key: (
-            ranking(category_ids, from_date, to_date),
-            category_per_uni_day(category_ids, from_date, to_date),
-        )
-        for key, category_ids in {
-            k: v
-            for x in map(lambda x: {x: get_product_ids_for_category(x)}, list(Category.objects.all()))
-            for k, v in x.items()
-        }.items()
-    }
+    # rank/total and units per university workday for every category
+    uni_days = (to_date - from_date).days * 162.14 / 365  # university workdays in 2021
+    category_ranks = member.category_ranks(from_date, to_date)
+    rankings = {}
+    for category in Category.objects.all():
+        rank, population, count = category_ranks.get(category.id, (0, 0, 0))
+        rankings[category] = ((rank, population), "{:.2f}".format(count / uni_days) if count else 0)
 
     return render(request, 'stregsystem/menu_userrank.html', locals())
 
@@ -355,20 +320,15 @@ def menu_sale(request, room_name, member_id, product_id=None):
                 "Cannot complete sale, get help at /dev/null or at mailto:[treo|fit]@fklub.dk"
             )
 
+        msg, status, result = _resolve_bought_products([purchase.cleaned_data['product_id']], timezone.now(), room)
         try:
-            product = Product.objects.get(
-                Q(pk=purchase.cleaned_data['product_id']),
-                Q(active=True),
-                Q(rooms__pk=room.pk) | Q(rooms=None),
-                Q(deactivate_date__gte=timezone.now()) | Q(deactivate_date__isnull=True),
-            )
+            if status == 200:
+                product = result[0]
 
-            order = Order.from_products(member=member, room=room, products=(product,))
+                order = Order.from_products(member=member, room=room, products=(product,))
 
-            order.execute()
+                order.execute()
 
-        except Product.DoesNotExist:
-            pass
         except StregForbudError:
             return render(request, 'stregsystem/error_stregforbud.html', locals())
         except NoMoreInventoryError:
@@ -389,27 +349,7 @@ def batch_payment(request):
     if request.method == "POST":
         formset = PaymentFormSet(request.POST, request.FILES)
         if formset.is_valid():
-            # @HACK For some reason django formsets get different member
-            # instances with the same values instead of the same instance. This
-            # means that if we update the member balance and save it, then
-            # repeat, the second write will overwrite the first. In case you
-            # don't know, that's not good.
-            # To work around this we have to set all the member instances to be
-            # the same if they have the same id. This is very, although
-            # slightly less, bad - Jesper Jensen 16/02-2017
-            payments = formset.save(commit=False)
-
-            # @HACK: We need to consolidate all the member so they are the same
-            # instances. We do this by just saving the first one and setting
-            # all the remaining with the same id to be that instance aswell.
-            members = {}
-            for payment in payments:
-                if payment.member.id not in members:
-                    members[payment.member.id] = payment.member
-                payment.member = members[payment.member.id]
-
-            for payment in payments:
-                payment.save()
+            Payment.save_batch(formset.save(commit=False))
 
             return render(request, "admin/stregsystem/batch_payment_done.html", {})
     else:
@@ -425,6 +365,11 @@ def batch_payment(request):
     )
 
 
+@staff_member_required()
+def request_stats(request):
+    return JsonResponse(InstrumentationMiddleware.summary())
+
+
 @staff_member_required()
 @permission_required("stregsystem.mobilepaytool_access")
 def mobilepaytool(request):
@@ -597,9 +542,7 @@ def find_user_from_id(user_id: int):
 
 
 def dump_named_items(request):
-    items = NamedProduct.objects.all()
-    items_dict = {item.name: item.product.id for item in items}
-    return JsonResponse(items_dict, json_dumps_params={'ensure_ascii': False})
+    return JsonResponse(NamedProduct.alias_map(), json_dumps_params={'ensure_ascii': False})
 
 
 @csrf_exempt
@@ -644,15 +587,56 @@ def api_sale(request):
         )
 
 
+@csrf_exempt
+def api_undo_sale(request):
+    """
+    Refunds the sales of a purchase the terminal made with the sale api, given the undo_token the sale api returned,
+    if they are no older than Sale.UNDO_TIME. Either all the sales are refunded or none of them.
+    """
+    if request.method != "POST":
+        return HttpResponseBadRequest()
+    data = json.loads(request.body)
+    undo_token = data.get('undo_token')
+
+    if not isinstance(undo_token, str):
+        return HttpResponseBadRequest("Missing undo_token")
+    try:
+        sale_ids = Sale.from_undo_token(undo_token)
+    except signing.BadSignature:
+        return HttpResponseBadRequest("Invalid or expired undo_token")
+
+    sales = Sale.objects.filter(id__in=sale_ids, timestamp__gte=timezone.now() - Sale.UNDO_TIME)
+    try:
+        with transaction.atomic():
+            refunded = Sale.refund(sales)
+            if not refunded or len(refunded) != len(sale_ids):
+                # Some of the sales are already refunded or too old
+                raise Sale.DoesNotExist
+    except Sale.DoesNotExist:
+        return HttpResponseBadRequest("Sales can't be undone")
+
+    return JsonResponse(
+        {
+            'status': 200,
+            'msg': "OK",
+            'values': {
+                'sales': [sale.id for sale in refunded],
+                'refunded': sum(sale.price for sale in refunded),
+                'member_balance': money(refunded[0].member.balance),
+            },
+        },
+        json_dumps_params={'ensure_ascii': False},
+    )
+
+
 def api_quicksale(request, room, member: Member, bought_ids):
     now = timezone.now()
 
     # Retrieve products and construct transaction
-    products: List[Product] = []
-
-    msg, status, result = __append_bought_ids_to_product_list(products, bought_ids, now, room)
+    msg, status, result = _resolve_bought_products(bought_ids, now, room)
     if status == 400:
         return msg, status, result
+    products: List[Product] = result
 
     order = Order.from_products(member=member, products=products, room=room)
 
@@ -685,6 +669,8 @@ def api_quicksale(request, room, member: Member, bought_ids):
                 'member': order.member.id,
                 'created_on': order.created_on,
                 'items': bought_ids,
+                'sales': [sale.id for sale in order.sales],
+                'undo_token': Sale.undo_token(order.sales),
             },
             'promille': promille,
             'is_ballmer_peaking': is_ballmer_peaking,
@@ -703,19 +689,26 @@ def api_quicksale(request, room, member: Member, bought_ids):
     )
 
 
-def __append_bought_ids_to_product_list(products, bought_ids, time_now, room):
-    try:
-        for i in bought_ids:
-            product = Product.objects.get(
-                Q(pk=i),
-                Q(active=True),
-                Q(deactivate_date__gte=time_now) | Q(deactivate_date__isnull=True),
-                Q(rooms__id=room.id) | Q(rooms=None),
-            )
-            products.append(product)
-    except Product.DoesNotExist:
-        return "Invalid product id", 400, i
-    return "OK", 200, None
+def _resolve_bought_products(bought_ids, time_now, room):
+    """
+    Resolves a list of bought product ids into products purchasable in the given room.
+    All distinct ids are fetched in a single query, and the returned product list keeps the order
+    (and repetitions) of bought_ids. If an id is not purchasable, the first such id is returned instead.
+    """
+    purchasable = {
+        product.id: product
+        for product in Product.objects.filter(
+            Q(pk__in=set(bought_ids)),
+            Q(active=True),
+            Q(deactivate_date__gte=time_now) | Q(deactivate_date__isnull=True),
+            Q(rooms__id=room.id) | Q(rooms=None),
+        ).distinct()
+    }
+
+    for i in bought_ids:
+        if i not in purchasable:
+            return "Invalid product id", 400, i
+    return "OK", 200, [purchasable[i] for i in bought_ids]
 
 
 def __execute_order(order):
@@ -730,21 +723,25 @@ def __execute_order(order):
 
 
 def __set_local_values(member, room, products, order, now):
-    promille = member.calculate_alcohol_promille()
+    # Order.execute leaves the updated member on the order, so the new balance is already at hand, and the
+    # physiology state it updated too, if the products had alcohol or caffeine. Otherwise it's fetched once for
+    # both the promille and the caffeine.
+    member = order.member
+    physiology = order.physiology or member.physiology()
+
+    promille = member.calculate_alcohol_promille(physiology)
     is_ballmer_peaking, bp_minutes, bp_seconds = ballmer_peak(promille)
 
-    caffeine = member.calculate_caffeine_in_body()
+    caffeine = member.calculate_caffeine_in_body(physiology)
     cups = caffeine_mg_to_coffee_cups(caffeine)
     product_contains_caffeine = any(product.caffeine_content_mg > 0 for product in products)
     is_coffee_master = member.is_leading_coffee_addict()
-
     cost = order.total
 
     give_multibuy_hint, sale_hints = _multibuy_hint(now, member)
 
-    new_balance = Member.objects.get(pk=member.id).balance
-    member_has_low_balance = new_balance <= 5000
-    member_balance = money(new_balance)
+    member_has_low_balance = member.balance <= 5000
+    member_balance = money(member.balance)
 
     # return it all
     return (
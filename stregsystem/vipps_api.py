@@ -1,12 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date
 from django.utils.dateparse import parse_datetime
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import requests
 from pathlib import Path
 
 import json
 import logging
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def exclusive_file_lock(path):
+    """
+    Holds an exclusive lock on the file at path, created if missing, until the block is done. Other processes locking
+    the same file wait for it.
+    """
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            # Released when the file is closed
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+            return
+
+        # msvcrt locks bytes from the current position, and LK_LOCK gives up with an OSError after 10 seconds
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
 
 
 class AccountingAPI(object):
@@ -15,11 +57,43 @@ class AccountingAPI(object):
     # Important to use a separate file since the tokens can change and is thus not suitable for django settings.
     tokens_file = (Path(__file__).parent / 'vipps-tokens.json').as_posix()
     tokens_file_backup = (Path(__file__).parent / 'vipps-tokens.json.bak').as_posix()
+    # The tokens are kept in memory, and only read from and written to disk under a lock, see __locked_token_storage
     tokens = None
+    _tokens_lock = threading.Lock()
 
     myshop_number = 90601
     logger = logging.getLogger(__name__)
 
+    # Number of days of historic transactions fetched at the same time
+    historic_workers = 4
+    # Keeps the connections to the API open between requests, see __session
+    _session = None
+
+    @classmethod
+    def __session(cls):
+        """
+        Returns the session all requests are sent through, so connections are pooled and reused, also by the threads
+        fetching historic transactions.
+        """
+        if cls._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=cls.historic_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            cls._session = session
+        return cls._session
+
+    @classmethod
+    @contextmanager
+    def __locked_token_storage(cls):
+        """
+        Reads the token variable from disk, holding a lock on the token file until the block is done, so no other
+        thread or process using the same token file reads or writes it in the meantime.
+        """
+        with cls._tokens_lock, exclusive_file_lock(f"{cls.tokens_file}.lock"):
+            cls.__read_token_storage()
+            yield
+
     @classmethod
     def __read_token_storage(cls):
         """
@@ -37,14 +111,22 @@ class AccountingAPI(object):
     @classmethod
     def __update_token_storage(cls):
         """
-        Saves the token variable to disk
+        Saves the token variable to disk. The tokens are written to a temporary file, which then replaces the token
+        file, so the token file is never left half written.
         """
         if cls.tokens is None:
             cls.logger.error(f"'tokens' is None. Aborted writing.")
             return
 
-        with open(cls.tokens_file, 'w') as json_file:
+        with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(cls.tokens_file), prefix='.vipps-tokens.', delete=False
+        ) as json_file:
             json.dump(cls.tokens, json_file, indent=2)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        if os.path.exists(cls.tokens_file):
+            shutil.copymode(cls.tokens_file, json_file.name)
+        os.replace(json_file.name, cls.tokens_file)
 
     @classmethod
     def __refresh_access_token(cls):
@@ -60,7 +142,7 @@ class AccountingAPI(object):
 
         auth = HTTPBasicAuth(cls.tokens['client_id'], cls.tokens['client_secret'])
 
-        response = requests.post(url, data=payload, auth=auth)
+        response = cls.__session().post(url, data=payload, auth=auth)
         response.raise_for_status()
         json_response = response.json()
         # Calculate when the token expires
@@ -72,24 +154,47 @@ class AccountingAPI(object):
     def __refresh_ledger_id(cls):
         cls.tokens['ledger_id'] = cls.get_ledger_id(cls.myshop_number)
 
+    @classmethod
+    def __access_token_expired(cls):
+        return 'access_token_timeout' not in cls.tokens or datetime.now() >= parse_datetime(
+            cls.tokens['access_token_timeout']
+        )
+
     @classmethod
     def __refresh_expired_token(cls):
         """
-        Client side check if the token has expired.
+        Client side check if the token has expired. The token file is only read when the token in memory has expired,
+        and only written when the token actually is refreshed.
         """
-        cls.__read_token_storage()
+        if cls.tokens is not None and not cls.__access_token_expired() and 'ledger_id' in cls.tokens:
+            return
 
-        if 'access_token_timeout' not in cls.tokens:
-            cls.__refresh_access_token()
+        with cls.__locked_token_storage():
+            # Another process may have refreshed the token already
+            changed = False
+            if cls.__access_token_expired():
+                cls.__refresh_access_token()
+                changed = True
 
-        expire_time = parse_datetime(cls.tokens['access_token_timeout'])
-        if datetime.now() >= expire_time:
-            cls.__refresh_access_token()
+            if 'ledger_id' not in cls.tokens:
+                cls.__refresh_ledger_id()
+                changed = True
 
-        if 'ledger_id' not in cls.tokens:
-            cls.__refresh_ledger_id()
+            if changed:
+                cls.__update_token_storage()
 
-        cls.__update_token_storage()
+    @classmethod
+    def __read_cursor(cls) -> str:
+        # Other processes move the cursor too, so the one in memory may be behind
+        with cls.__locked_token_storage():
+            return cls.tokens.get('cursor', "")
+
+    @classmethod
+    def __save_cursor(cls, cursor: str):
+        with cls.__locked_token_storage():
+            if cls.tokens.get('cursor') != cursor:
+                cls.tokens['cursor'] = cursor
+                cls.__update_token_storage()
 
     @classmethod
     def get_transactions_historic(cls, transaction_date: date) -> list:
@@ -99,7 +204,37 @@ class AccountingAPI(object):
         :return: List of transactions on that date.
         """
         cls.__refresh_expired_token()
+        return cls.__fetch_historic(transaction_date)
+
+    @classmethod
+    def get_transactions_historic_many(cls, transaction_dates) -> dict:
+        """
+        Fetches historic transactions of several dates, historic_workers dates at a time.
+        Dates that couldn't be fetched are logged and left out.
+        :param transaction_dates: The dates to look up.
+        :return: Dict from each fetched date to the list of transactions on that date.
+        """
+        transaction_dates = list(transaction_dates)
+        if not transaction_dates:
+            return {}
+        cls.__refresh_expired_token()
 
+        with ThreadPoolExecutor(max_workers=cls.historic_workers) as executor:
+            futures = {
+                transaction_date: executor.submit(cls.__fetch_historic, transaction_date)
+                for transaction_date in transaction_dates
+            }
+
+        transactions = {}
+        for transaction_date, future in futures.items():
+            try:
+                transactions[transaction_date] = future.result()
+            except Exception as e:
+                cls.logger.error(f"Got an error when trying to fetch transactions of {transaction_date}: {e}")
+        return transactions
+
+    @classmethod
+    def __fetch_historic(cls, transaction_date: date) -> list:
         ledger_date = transaction_date.strftime('%Y-%m-%d')
 
         url = f"{cls.api_endpoint}/report/v2/ledgers/{cls.tokens['ledger_id']}/funds/dates/{ledger_date}"
@@ -110,7 +245,7 @@ class AccountingAPI(object):
         headers = {
             'authorization': 'Bearer {}'.format(cls.tokens['access_token']),
         }
-        response = requests.get(url, params=params, headers=headers)
+        response = cls.__session().get(url, params=params, headers=headers)
         response.raise_for_status()
         return response.json()['items']
 
@@ -126,27 +261,27 @@ class AccountingAPI(object):
             'authorization': "Bearer {}".format(cls.tokens['access_token']),
         }
 
-        response = requests.get(url, params=params, headers=headers)
+        response = cls.__session().get(url, params=params, headers=headers)
         response.raise_for_status()
 
         return response.json()
 
     @classmethod
-    def get_transactions_latest_feed(cls) -> list:
+    def iter_transactions_feed(cls):
         """
-        Fetches transactions ahead of cursor. Used to fetch very recent transactions.
-        Moves the cursor as well.
-        :return: All transactions from the current cursor till it's emptied.
+        Fetches transactions ahead of cursor page by page. Used to fetch very recent transactions.
+        Moves the cursor past a page when the next page is asked for, so a page that wasn't handled, e.g. because the
+        import crashed, is fetched again the next time.
+        :return: Generator of the transactions of each page, from the current cursor till it's emptied.
         """
-
-        cls.__refresh_expired_token()
-
-        transactions = []
-        cursor = cls.tokens.get('cursor', "")
+        cursor = cls.__read_cursor()
 
         while True:
+            # A long feed may outlive the token
+            cls.__refresh_expired_token()
             res = cls.fetch_report_by_feed(cursor)
-            transactions.extend(res['items'])
+            if res['items']:
+                yield res['items']
 
             try_later = res['tryLater'] == "true"
 
@@ -154,14 +289,11 @@ class AccountingAPI(object):
                 break
 
             cursor = res['cursor']
+            cls.__save_cursor(cursor)
 
             if len(res['items']) == 0:
                 break
 
-        cls.tokens['cursor'] = cursor
-        cls.__update_token_storage()
-        return transactions
-
     @classmethod
     def get_ledger_info(cls, myshop_number: int):
         """
@@ -188,7 +320,7 @@ class AccountingAPI(object):
         headers = {
             'authorization': 'Bearer {}'.format(cls.tokens['access_token']),
         }
-        response = requests.get(url, params=params, headers=headers)
+        response = cls.__session().get(url, params=params, headers=headers)
         response.raise_for_status()
 
         ledger_info = response.json()["items"]
@@ -48,6 +48,9 @@ PASSWORD =
 2=127.0.0.1
 3=localhost
 
+[stregsystem]
+COFFEE_CATEGORY_ID = 6
+
 [logging]
 HANDLERS = [
     "console",
@@ -107,6 +110,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'stregsystem.middleware.CorsMiddleware',
+    'stregsystem.middleware.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -214,6 +218,19 @@ SELECT2_CSS = (
 
 TEST_RUNNER = 'stregsystem.utils.stregsystemTestRunner'
 
+# The category whose sales count towards being the coffee master of the week
+COFFEE_CATEGORY_ID = cfg.getint("stregsystem", "COFFEE_CATEGORY_ID")
+
+# Queries a view may use before InstrumentationMiddleware logs a warning, by url name.
+# Savepoints count as queries. Replaying generatedata traffic with loadtest, a purchase takes around 25 of them at the
+# 95th percentile and 39 at most, so the budgets only warn about purchases well beyond that.
+VIEW_QUERY_BUDGETS = {
+    'menu_index': 5,
+    'quickbuy': 45,
+    'menu': 40,
+    'sale': 40,
+}
+
 LOGIN_REDIRECT_URL = '/admin/login'
 LOGIN_URL = '/admin/login'
 